@@ -0,0 +1,212 @@
+"""
+The :mod:`blockscan` module finds the blocks of many song files at once with NumPy.
+
+The importer normally steps through a song file block by block: it reads a header, works out from the length
+descriptors where the contents are and where the next block starts, and only then reads the next header. Here the
+files of a batch are loaded into one buffer and the blocks of all of them are found together, one block per file in
+each step, with vectorised NumPy operations. The result is a table of every block's kind, verse number, name and
+contents, which :class:`songshowplus.SongShowPlusImport` decodes without reading the files again.
+
+Only files whose every block lies completely within the file, and which end with the four NULL bytes or at the end of
+a block, get a table. Truncated or otherwise damaged files are left to the importer, which reads them block by block as
+before, so the songs and the reported failures are exactly the same either way.
+
+NumPy is optional. Without it, the importer reads every file block by block.
+"""
+import itertools
+import logging
+
+import numpy
+
+from songshowplus import BRIDGE, CHORUS, CUSTOM_VERSE, KNOWN_BLOCKS, MAX_FILE_SIZE, SONG_NUMBER, VERSE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 512
+# Larger files are left to the importer, so a stray huge file is not loaded in one piece
+MAX_SCAN_SIZE = MAX_FILE_SIZE
+
+
+class ScannedSong(object):
+    """
+    The contents of a song file and the table of its blocks.
+    """
+
+    def __init__(self, data, table, null_terminated):
+        """
+        :param bytes data: The contents of the file.
+        :param table: One row per block: kind, verse number, offset and length of the name of a custom verse, offset
+            and length of the contents. The offsets are relative to the start of the file.
+        :param bool null_terminated: Whether the file ends with four NULL bytes, rather than at the end of a block.
+        """
+        self.data = data
+        self.table = table
+        self.null_terminated = null_terminated
+
+    def blocks(self):
+        """
+        Returns ``(block_key, verse_no, verse_name, data)`` for every block, where ``verse_no`` is ``None`` except for
+        verses, choruses and bridges, and ``verse_name`` the undecoded name of a custom verse, or ``None``.
+        """
+        data = self.data
+        for block_key, verse_no, name_offset, name_length, data_offset, data_length in self.table.tolist():
+            verse_name = data[name_offset:name_offset + name_length] if block_key == CUSTOM_VERSE else None
+            if block_key not in (VERSE, CHORUS, BRIDGE):
+                verse_no = None
+            yield block_key, verse_no, verse_name, data[data_offset:data_offset + data_length]
+
+
+def _uint32(buffer, positions):
+    """
+    Returns the little-endian 32 bit numbers at ``positions``. Positions too close to the end of the buffer, which are
+    only computed to be thrown away, read the last 4 bytes instead.
+    """
+    positions = numpy.minimum(positions, len(buffer) - 4)
+    return (buffer[positions].astype(numpy.int64) | (buffer[positions + 1].astype(numpy.int64) << 8) |
+            (buffer[positions + 2].astype(numpy.int64) << 16) | (buffer[positions + 3].astype(numpy.int64) << 24))
+
+
+def scan_blocks(buffer, starts, ends, limits=None):
+    """
+    Find the blocks of the song files in ``buffer``.
+
+    :param buffer: The contents of the files, one after the other, as a NumPy ``uint8`` array.
+    :param starts: The offset of every file in ``buffer``.
+    :param ends: The offset of the end of every file in ``buffer``.
+    :param limits: The :class:`songshowplus.ParseLimits` of the guarded parsing mode. Files which break a limit are
+        left to the importer, which reports them.
+    :return: A list with a table of the blocks of every file, as described for :class:`ScannedSong`, or ``None`` for
+        the files the importer has to read itself, and an array of whether each file ends with four NULL bytes.
+    """
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    ends = numpy.asarray(ends, dtype=numpy.int64)
+    count = len(starts)
+    # Keep 8 bytes after the last file, so reading a header never needs a bounds check of its own
+    buffer = numpy.concatenate([buffer, numpy.zeros(8, dtype=numpy.uint8)])
+    known = numpy.zeros(max(KNOWN_BLOCKS + (SONG_NUMBER,)) + 1, dtype=bool)
+    known[list(KNOWN_BLOCKS) + [SONG_NUMBER]] = True
+    max_block_size = limits.max_block_size if limits is not None else None
+
+    clean = numpy.ones(count, dtype=bool)
+    null_terminated = numpy.zeros(count, dtype=bool)
+    if limits is not None:
+        clean &= ends - starts <= limits.max_file_size
+    songs = numpy.flatnonzero(clean)
+    positions = starts[songs]
+    steps = []
+    while len(songs):
+        song_ends = ends[songs]
+        # A file which ends where a header should start is complete, as is one with a block key of 0
+        has_key = positions + 4 <= song_ends
+        block_keys = numpy.where(has_key, _uint32(buffer, positions), 0)
+        going = block_keys != 0
+        null_terminated[songs[has_key & ~going]] = True
+        songs, positions, song_ends, block_keys = songs[going], positions[going], song_ends[going], block_keys[going]
+        if not len(songs):
+            break
+        ok = positions + 8 <= song_ends
+        next_block_starts = positions + 8 + _uint32(buffer, positions + 4)
+        position = positions + 8
+        verse_nos = numpy.zeros(len(songs), dtype=numpy.int64)
+        name_offsets = numpy.zeros(len(songs), dtype=numpy.int64)
+        name_lengths = numpy.zeros(len(songs), dtype=numpy.int64)
+
+        numbered = (block_keys == VERSE) | (block_keys == CHORUS) | (block_keys == BRIDGE)
+        custom = block_keys == CUSTOM_VERSE
+        prefixed = numbered | custom
+        ok &= ~prefixed | (position + 2 <= song_ends)
+        second = numpy.minimum(position + 1, len(buffer) - 1)
+        verse_nos = numpy.where(numbered, buffer[second], verse_nos)
+        name_lengths = numpy.where(custom, buffer[second], name_lengths)
+        position = numpy.where(prefixed, position + 2, position)
+        name_offsets = numpy.where(custom, position, name_offsets)
+        position = position + name_lengths
+        if max_block_size is not None:
+            ok &= name_lengths <= max_block_size
+
+        ok &= position + 1 <= song_ends
+        descriptor_sizes = buffer[numpy.minimum(position, len(buffer) - 1)].astype(numpy.int64)
+        position = position + 1
+        song_number = block_keys == SONG_NUMBER
+        # The song number fills the length descriptor size less one bytes. A size of 0 would read up to the end.
+        ok &= ~song_number | (descriptor_sizes > 0)
+        long_length = ((descriptor_sizes == 12) | (descriptor_sizes == 20)) & ~song_number
+        short_length = ~long_length & (descriptor_sizes != 2) & (descriptor_sizes != 9) & ~song_number
+        ok &= ~long_length | (position + 4 <= song_ends)
+        ok &= ~short_length | (position + 1 <= song_ends)
+        safe_position = numpy.minimum(position, len(buffer) - 8)
+        lengths = numpy.select([song_number, long_length, descriptor_sizes == 2, descriptor_sizes == 9],
+                               [descriptor_sizes - 1, _uint32(buffer, safe_position), 1, 0],
+                               buffer[safe_position].astype(numpy.int64))
+        position = position + numpy.where(long_length, 4, numpy.where(short_length, 1, 0))
+        data_offsets = position
+        position = position + lengths
+        ok &= position <= song_ends
+        if max_block_size is not None:
+            ok &= lengths <= max_block_size
+
+        # Known blocks are followed directly by the next one, unknown ones are skipped using their header, which must
+        # not point back into the block
+        is_known = known[numpy.minimum(block_keys, len(known) - 1)] & (block_keys < len(known))
+        ok &= is_known | (next_block_starts >= position)
+        position = numpy.where(is_known, position, next_block_starts)
+
+        clean[songs[~ok]] = False
+        songs, position = songs[ok], position[ok]
+        steps.append(numpy.stack([songs, block_keys[ok], verse_nos[ok], name_offsets[ok] - starts[songs],
+                                  name_lengths[ok], data_offsets[ok] - starts[songs], lengths[ok]], axis=1))
+        positions = position
+
+    tables = [None] * count
+    if steps:
+        rows = numpy.concatenate(steps)
+        # Stable, so the blocks of each file stay in the order they were found
+        rows = rows[numpy.argsort(rows[:, 0], kind='stable')]
+        bounds = numpy.searchsorted(rows[:, 0], numpy.arange(count + 1))
+        for song in range(count):
+            if clean[song]:
+                tables[song] = rows[bounds[song]:bounds[song + 1], 1:]
+    empty = numpy.zeros((0, 6), dtype=numpy.int64)
+    tables = [table if table is not None else (empty if clean[song] else None) for song, table in enumerate(tables)]
+    return tables, null_terminated
+
+
+def _read_source(file_path):
+    """
+    Returns the contents of a song file, or ``None`` if the importer should read it itself.
+    """
+    try:
+        with file_path.open('rb') as song_file:
+            data = song_file.read(MAX_SCAN_SIZE + 1)
+    except OSError:
+        # Reported by the importer when it tries to read the file
+        return None
+    return data if len(data) <= MAX_SCAN_SIZE else None
+
+
+def scan_sources(file_paths, limits=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Read song files in batches and find their blocks.
+
+    :param file_paths: The song files, which are opened with ``open('rb')`` like a :class:`~pathlib.Path`. They can
+        be an iterator, which is only read one batch ahead.
+    :param limits: The :class:`songshowplus.ParseLimits` of the guarded parsing mode.
+    :param int batch_size: The number of files to scan at once.
+    :return: An iterator of ``(file_path, scanned_song)`` pairs, where ``scanned_song`` is a :class:`ScannedSong`,
+        or ``None`` for files the importer has to read block by block.
+    """
+    file_paths = iter(file_paths)
+    while True:
+        batch = list(itertools.islice(file_paths, batch_size))
+        if not batch:
+            break
+        contents = [_read_source(file_path) for file_path in batch]
+        sizes = [len(data) if data is not None else 0 for data in contents]
+        ends = numpy.cumsum(sizes, dtype=numpy.int64)
+        buffer = numpy.frombuffer(b''.join(data for data in contents if data is not None), dtype=numpy.uint8)
+        tables, null_terminated = scan_blocks(buffer, ends - sizes, ends, limits)
+        for file_path, data, table, null in zip(batch, contents, tables, null_terminated.tolist()):
+            if data is None or table is None:
+                yield file_path, None
+            else:
+                yield file_path, ScannedSong(data, table, null)
@@ -0,0 +1,399 @@
+"""
+The :mod:`cclicatalog` module fills in missing song metadata from a local export of the CCLI song catalog.
+
+Many SongShow Plus files have no authors, no copyright or no CCLI number. A :class:`CatalogEnricher` looks every
+imported song up in the catalog, by its CCLI number or, failing that, by its title and one of its authors, and fills in
+the fields the song is missing. Fields the song already has are never changed.
+
+The catalog is a CSV file (or tab separated) with a header row naming the columns, e.g.::
+
+    CCLI Number,Title,Authors,Copyright
+    22025,Amazing Grace,John Newton | John P. Rees,Public Domain
+
+Several authors are separated by ``|`` or ``;``. Catalogs can have millions of rows, so they are not searched. Instead
+a hashed index is built next to the catalog the first time it is used, ``catalog.csv.index``, and rebuilt whenever the
+catalog changes. It is memory-mapped, so a lookup only reads the few pages it needs::
+
+    header      magic, size and modification time of the catalog, number of slots and rows, section offsets
+    rows        one JSON object per catalog row, each on its own line
+    slots       an open addressing hash table of (key hash, row offset + 1), 0 marking an empty slot
+
+Every row is entered under its CCLI number, its normalized title, and its title together with each of its authors.
+Titles and authors are compared like OpenLP's search fields, ignoring case and punctuation, and the words of an author
+name in any order, so ``Newton, John`` finds ``John Newton``. A song without authors is only matched by title if the
+catalog has a single song of that title. The index can also be built or queried from the command line::
+
+    python ./cclicatalog.py build ../ccli_catalog.csv
+    python ./cclicatalog.py lookup ../ccli_catalog.csv 22025
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+
+from songwriters import TEMP_SUFFIX
+from utils import clean_string
+
+log = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'CCLICAT1'
+# magic, catalog size, catalog modification time, slot count, row count, offset of the slots, offset of the rows
+HEADER = struct.Struct('<8sQqQQQQ')
+SLOT = struct.Struct('<QQ')
+INDEX_SUFFIX = '.index'
+# The number of keys read or written at once while building an index
+KEY_CHUNK_SIZE = 65536
+# The header names accepted for each column, compared in lower case
+CATALOG_COLUMNS = {
+    'ccli_number': ('ccli number', 'ccli song number', 'ccli_number', 'ccli #', 'song number', 'song id', 'number'),
+    'title': ('title', 'song title'),
+    'authors': ('authors', 'author', 'author(s)', 'writers', 'songwriters'),
+    'copyright': ('copyright', 'copyrights'),
+}
+AUTHOR_SEPARATORS = re.compile(r'\s*[|;]\s*')
+DIGITS = re.compile(r'\d+')
+
+
+class CatalogError(ValueError):
+    """
+    Raised when the catalog has none of the expected columns.
+    """
+    pass
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def title_key(title):
+    """
+    Returns a title as it is compared with the catalog.
+    """
+    return ' '.join(clean_string(title or '').split())
+
+
+def author_key(author):
+    """
+    Returns an author as it is compared with the catalog, with the words of the name sorted.
+    """
+    return ' '.join(sorted(clean_string(author or '').split()))
+
+
+def number_key(ccli_number):
+    """
+    Returns the digits of a CCLI number without leading zeros, or an empty string.
+    """
+    match = DIGITS.search(str(ccli_number or ''))
+    return str(int(match.group())) if match else ''
+
+
+def _row_keys(row):
+    keys = []
+    if row['ccli_number']:
+        keys.append('n:' + row['ccli_number'])
+    title = title_key(row['title'])
+    if title:
+        keys.append('t:' + title)
+        for author in row['authors']:
+            keys.append('t:' + title + '|' + author_key(author))
+    return keys
+
+
+def read_catalog(catalog_path):
+    """
+    Returns the rows of a catalog file as dictionaries of ``ccli_number``, ``title``, ``authors`` and ``copyright``.
+
+    :raises CatalogError: If the header row names none of the columns.
+    """
+    with open(str(catalog_path), encoding='utf-8-sig', newline='') as catalog_file:
+        header_line = catalog_file.readline()
+        dialect = 'excel-tab' if '\t' in header_line else 'excel'
+        header = [name.strip().lower() for name in next(csv.reader([header_line], dialect))]
+        columns = {}
+        for field, names in CATALOG_COLUMNS.items():
+            for name in names:
+                if name in header:
+                    columns[field] = header.index(name)
+                    break
+        if 'ccli_number' not in columns and 'title' not in columns:
+            raise CatalogError('{path} has no CCLI number or title column'.format(path=catalog_path))
+
+        def column(values, field):
+            index = columns.get(field)
+            return values[index].strip() if index is not None and index < len(values) else ''
+
+        for values in csv.reader(catalog_file, dialect):
+            if not values:
+                continue
+            authors = column(values, 'authors')
+            yield {'ccli_number': number_key(column(values, 'ccli_number')), 'title': column(values, 'title'),
+                   'authors': [author for author in AUTHOR_SEPARATORS.split(authors) if author],
+                   'copyright': column(values, 'copyright')}
+
+
+def _fill_slots(slots, keys_file, slot_count):
+    """
+    Enter the ``(key hash, row offset + 1)`` pairs of a file into the open addressing table ``slots``, a view of the
+    index file as 64 bit integers.
+    """
+    mask = slot_count - 1
+    keys_file.seek(0)
+    while True:
+        keys = array('Q', keys_file.read(KEY_CHUNK_SIZE * SLOT.size))
+        if not keys:
+            break
+        for index in range(0, len(keys), 2):
+            key_hash = keys[index]
+            slot = key_hash & mask
+            while slots[2 * slot + 1]:
+                slot = (slot + 1) & mask
+            slots[2 * slot] = key_hash
+            slots[2 * slot + 1] = keys[index + 1]
+    if sys.byteorder == 'big':
+        # The index is little endian
+        for start in range(0, len(slots), KEY_CHUNK_SIZE):
+            chunk = array('Q', slots[start:start + KEY_CHUNK_SIZE].tobytes())
+            chunk.byteswap()
+            slots[start:start + len(chunk)] = memoryview(chunk)
+
+
+def build_index(catalog_path, index_path=None):
+    """
+    Build the hashed index of a catalog file.
+
+    The keys of the rows are collected in a temporary file and the slots are filled in place in the memory-mapped index
+    file, so building the index of a catalog of millions of rows does not need the whole table in memory.
+
+    :param catalog_path: The catalog file.
+    :param index_path: The index file to write. Defaults to the catalog path with ``.index`` appended. It is replaced
+        once the new index is complete.
+    :return: The number of indexed rows.
+    """
+    index_path = str(index_path or str(catalog_path) + INDEX_SUFFIX)
+    stat = os.stat(str(catalog_path))
+    temp_path = index_path + TEMP_SUFFIX
+    count = 0
+    key_count = 0
+    with open(temp_path, 'w+b') as index_file, \
+            tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(index_path))) as keys_file:
+        index_file.write(bytes(HEADER.size))
+        rows_at = index_file.tell()
+        keys = array('Q')
+        for row in read_catalog(catalog_path):
+            offset = index_file.tell() - rows_at
+            index_file.write(json.dumps(row, ensure_ascii=False).encode('utf-8') + b'\n')
+            for key in _row_keys(row):
+                keys.append(_key_hash(key))
+                keys.append(offset + 1)
+            count += 1
+            if len(keys) >= 2 * KEY_CHUNK_SIZE:
+                key_count += len(keys) // 2
+                keys.tofile(keys_file)
+                keys = array('Q')
+        key_count += len(keys) // 2
+        keys.tofile(keys_file)
+        # A power of two, at most half full, so probing stays short
+        slot_count = 1
+        while slot_count < 2 * key_count:
+            slot_count *= 2
+        # Aligned, so the slots can be viewed as 64 bit integers
+        slots_at = -(-index_file.tell() // SLOT.size) * SLOT.size
+        index_file.flush()
+        index_file.truncate(slots_at + slot_count * SLOT.size)
+        with mmap.mmap(index_file.fileno(), 0) as data:
+            with memoryview(data) as view, view[slots_at:].cast('Q') as slots:
+                _fill_slots(slots, keys_file, slot_count)
+        index_file.seek(0)
+        index_file.write(HEADER.pack(INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, slot_count, count, slots_at,
+                                     rows_at))
+    os.replace(temp_path, index_path)
+    log.info('indexed {count} catalog rows in {path}'.format(count=count, path=index_path))
+    return count
+
+
+class CatalogIndex(object):
+    """
+    Looks up songs in a memory-mapped catalog index.
+    """
+
+    def __init__(self, index_path):
+        """
+        :param index_path: The index file written by :func:`build_index`.
+        :raises ValueError: If the file is not a catalog index.
+        """
+        self.index_path = str(index_path)
+        with open(self.index_path, 'rb') as index_file:
+            self.data = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            raise ValueError('{path} is not a CCLI catalog index'.format(path=self.index_path))
+        (magic, self.catalog_size, self.catalog_mtime, self.slot_count, self.row_count, self.slots_at,
+         self.rows_at) = HEADER.unpack_from(self.data)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{path} is not a CCLI catalog index'.format(path=self.index_path))
+
+    def __len__(self):
+        return self.row_count
+
+    def close(self):
+        self.data.close()
+
+    def is_current(self, catalog_path):
+        """
+        Returns whether the index was built from the current version of a catalog file.
+        """
+        stat = os.stat(str(catalog_path))
+        return (stat.st_size, stat.st_mtime_ns) == (self.catalog_size, self.catalog_mtime)
+
+    def _row(self, offset):
+        start = self.rows_at + offset - 1
+        return json.loads(self.data[start:self.data.find(b'\n', start)].decode('utf-8'))
+
+    def _rows(self, key):
+        """
+        Returns the rows entered under a key, which may include rows of other keys with the same hash.
+        """
+        key_hash = _key_hash(key)
+        mask = self.slot_count - 1
+        slot = key_hash & mask
+        rows = []
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.data, self.slots_at + slot * SLOT.size)
+            if not offset:
+                return rows
+            if slot_hash == key_hash:
+                rows.append(self._row(offset))
+            slot = (slot + 1) & mask
+
+    def by_number(self, ccli_number):
+        """
+        Returns the catalog row of a CCLI number, or ``None``.
+        """
+        number = number_key(ccli_number)
+        if not number:
+            return None
+        for row in self._rows('n:' + number):
+            if row['ccli_number'] == number:
+                return row
+        return None
+
+    def by_title(self, title, authors=()):
+        """
+        Returns the catalog row of a song with this title and one of these authors, or without authors, the only song
+        of this title. Returns ``None`` if there is no such row.
+        """
+        title = title_key(title)
+        if not title:
+            return None
+        for author in authors:
+            author = author_key(author)
+            for row in self._rows('t:' + title + '|' + author):
+                if title_key(row['title']) == title and author in [author_key(name) for name in row['authors']]:
+                    return row
+        if authors:
+            return None
+        rows = [row for row in self._rows('t:' + title) if title_key(row['title']) == title]
+        return rows[0] if len(rows) == 1 else None
+
+
+def open_catalog(catalog_path, index_path=None):
+    """
+    Returns the :class:`CatalogIndex` of a catalog file, building the index first if it is missing or out of date.
+    """
+    index_path = str(index_path or str(catalog_path) + INDEX_SUFFIX)
+    try:
+        index = CatalogIndex(index_path)
+    except (OSError, ValueError):
+        index = None
+    if index is not None and index.is_current(catalog_path):
+        return index
+    if index is not None:
+        index.close()
+    print('Indexing the CCLI catalog {path}, this is only done once'.format(path=catalog_path))
+    build_index(catalog_path, index_path)
+    return CatalogIndex(index_path)
+
+
+class CatalogEnricher(object):
+    """
+    Fills in the missing authors, copyright and CCLI numbers of songs from a catalog.
+    """
+
+    def __init__(self, index):
+        """
+        :param index: The :class:`CatalogIndex` of the catalog.
+        """
+        self.index = index
+        self.by_number = 0
+        self.by_title = 0
+        self.filled = 0
+
+    def enrich(self, song):
+        """
+        Fill in the fields a song is missing from its catalog row.
+
+        :return: Whether any field was filled in.
+        """
+        row = self.index.by_number(song.ccli_number) if song.ccli_number else None
+        if row is not None:
+            self.by_number += 1
+        else:
+            row = self.index.by_title(song.title, song.authors)
+            if row is None:
+                return False
+            self.by_title += 1
+        filled = False
+        # The list may be shared with other songs, so it is replaced rather than changed
+        if not song.authors and row['authors']:
+            song.authors = list(row['authors'])
+            filled = True
+        if not song.copyright and row['copyright']:
+            song.copyright = row['copyright']
+            filled = True
+        if not song.ccli_number and row['ccli_number']:
+            song.ccli_number = int(row['ccli_number'])
+            filled = True
+        self.filled += filled
+        return filled
+
+    def scan(self, songs):
+        """
+        Enrich every song of an iterable while passing it on, so it can be done during an export.
+        """
+        for song in songs:
+            self.enrich(song)
+            yield song
+
+    def print_summary(self):
+        print('Found {found} songs in the CCLI catalog ({number} by CCLI number, {title} by title), filled in the '
+              'metadata of {filled}'.format(found=self.by_number + self.by_title, number=self.by_number,
+                                            title=self.by_title, filled=self.filled))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index a CCLI song catalog and look songs up in it.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='Build the index of a catalog')
+    build_parser.add_argument('catalog_path', help='The catalog file, a CSV export')
+    lookup_parser = commands.add_parser('lookup', help='Look a song up by its CCLI number or title')
+    lookup_parser.add_argument('catalog_path')
+    lookup_parser.add_argument('query', help='A CCLI number or a title')
+    lookup_parser.add_argument('authors', nargs='*', help='The authors of the song, to look it up by title')
+    args = parser.parse_args()
+    if args.command == 'build':
+        print('Indexed {count} rows'.format(count=build_index(args.catalog_path)))
+    else:
+        catalog = open_catalog(args.catalog_path)
+        if args.query.isdigit():
+            found = catalog.by_number(args.query)
+        else:
+            found = catalog.by_title(args.query, args.authors)
+        print(json.dumps(found, ensure_ascii=False, indent=1) if found else 'Not found')
+        raise SystemExit(0 if found else 1)
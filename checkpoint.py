@@ -0,0 +1,248 @@
+"""
+The :mod:`checkpoint` module makes long conversions resumable.
+
+A :class:`ConversionJournal` records, for every source file whose song has been exported, the output files written
+for it and their sizes. Source files which could not be imported are recorded with the reason, so a resumed run skips
+them unless they have changed since, and reports them again. The journal is an append-only JSON Lines file which is
+synced to disk every ``flush_interval`` songs, so after a crash, reboot or Ctrl-C at most that many songs have to be
+converted again.
+
+When a run is resumed, the journal is read back and the export directory is checked before the conversion continues:
+
+* temporary files of an :class:`songwriters.AtomicWriter` are removed,
+* journaled outputs which are missing or have the wrong size are removed and their source files converted again,
+* files written after the run started but never journaled, i.e. during the interval lost in the crash, are removed.
+"""
+import json
+import logging
+import os
+import time
+
+from songimport import ImportFailure
+from songwriters import SongWriter, TEMP_SUFFIX
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 100
+
+
+class ConversionJournal(object):
+    """
+    The journal of completed source files and written outputs.
+    """
+
+    def __init__(self, journal_path, export_dir, resume=False, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """
+        :param journal_path: The path of the journal file.
+        :param export_dir: The export directory the outputs are written to.
+        :param bool resume: Continue the run recorded in an existing journal instead of starting a new one.
+        :param int flush_interval: Sync the journal to disk after this many completed songs.
+        """
+        self.journal_path = str(journal_path)
+        self.export_dir = str(export_dir)
+        self.flush_interval = flush_interval
+        self.done = {}
+        # The failures of the source files which could not be imported, and their modification time and size then
+        self.failed = {}
+        # How many of the failures passed to track have been journaled
+        self.failures_seen = 0
+        # The failures of earlier runs whose source files is_done told to skip
+        self.skipped_failures = []
+        self.started = time.time()
+        self.current_source = None
+        self.current_outputs = []
+        self.unflushed = 0
+        if resume and os.path.exists(self.journal_path):
+            self._load()
+            self._check_outputs()
+            self.journal_file = open(self.journal_path, 'a', encoding='utf-8')
+        else:
+            self.journal_file = open(self.journal_path, 'w', encoding='utf-8')
+            self._append({'started': self.started, 'export_dir': self.export_dir})
+            self.flush()
+
+    def _append(self, entry):
+        self.journal_file.write(json.dumps(entry, ensure_ascii=False))
+        self.journal_file.write('\n')
+
+    def _load(self):
+        with open(self.journal_path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be torn if the previous run died while writing it
+                    log.warning('Ignoring a damaged journal entry')
+                    continue
+                if 'started' in entry:
+                    self.started = min(self.started, entry['started'])
+                    continue
+                # A later entry of the same source, e.g. after it was fixed and converted again, replaces the earlier
+                self.done[entry['source']] = entry['outputs']
+                if 'failure' in entry:
+                    self.failed[entry['source']] = (entry['failure'], entry.get('stat'))
+                else:
+                    self.failed.pop(entry['source'], None)
+        log.info('Resuming, {count} source files already converted, {failed} failed'.format(
+            count=len(self.done) - len(self.failed), failed=len(self.failed)))
+
+    def _check_outputs(self):
+        """
+        Remove half-written and unjournaled outputs, and forget sources whose outputs are damaged.
+        """
+        journaled = set()
+        for source, outputs in list(self.done.items()):
+            for filename, size in outputs:
+                path = os.path.join(self.export_dir, filename)
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    log.warning('Output {filename} is damaged, converting {source} again'.format(filename=filename,
+                                                                                               source=source))
+                    for other_filename, other_size in outputs:
+                        other_path = os.path.join(self.export_dir, other_filename)
+                        if os.path.isfile(other_path):
+                            os.remove(other_path)
+                    del self.done[source]
+                    break
+            else:
+                journaled.update(filename for filename, size in outputs)
+        journal_path = os.path.abspath(self.journal_path)
+        # The outputs may be sharded into subdirectories, whose journaled names are "directory/name"
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.export_dir, directory)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                name = '{directory}/{name}'.format(directory=directory, name=entry.name) if directory else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(name)
+                    continue
+                if not entry.is_file() or name in journaled or os.path.abspath(entry.path) == journal_path:
+                    continue
+                if entry.name.endswith(TEMP_SUFFIX) or entry.stat().st_mtime >= self.started:
+                    log.info('Removing unfinished output {name}'.format(name=name))
+                    os.remove(entry.path)
+
+    def is_done(self, source):
+        """
+        Returns whether the song of ``source`` has already been exported, or failed to import and has not changed
+        since.
+        """
+        source = str(source)
+        if source not in self.done:
+            return False
+        if source in self.failed:
+            failure, stat = self.failed[source]
+            if stat != _stat(source):
+                del self.done[source]
+                del self.failed[source]
+                return False
+            self.skipped_failures.append(ImportFailure(failure['file'], failure['reason'], failure.get('offset'),
+                                                       failure.get('block_key')))
+        return True
+
+    def track(self, songs, failures=None):
+        """
+        Pass the songs of an iterable on to an exporter, journaling each song's source file once the exporter has
+        moved on to the next song.
+
+        :param failures: The list the importer adds its :class:`songimport.ImportFailure` to. New failures are
+            journaled along with the songs.
+        """
+        for song in songs:
+            if failures is not None:
+                self._journal_failures(failures)
+            self.current_source = song.source_path
+            self.current_outputs = []
+            yield song
+            self.complete()
+        if failures is not None:
+            self._journal_failures(failures)
+
+    def _journal_failures(self, failures):
+        # The importer may be appending in another thread, so only the failures counted here are taken
+        count = len(failures)
+        for failure in failures[self.failures_seen:count]:
+            source = str(failure.file_path)
+            stat = _stat(source)
+            self.done[source] = []
+            self.failed[source] = (failure.to_dict(), stat)
+            self._append({'source': source, 'outputs': [], 'failure': failure.to_dict(), 'stat': stat})
+            self.unflushed += 1
+        self.failures_seen = count
+
+    def output_written(self, filename, size):
+        """
+        Record an output file of the song currently being exported.
+        """
+        self.current_outputs.append([filename, size])
+
+    def complete(self):
+        """
+        Journal the song currently being exported as done.
+        """
+        if self.current_source is None:
+            return
+        self.done[str(self.current_source)] = self.current_outputs
+        self.failed.pop(str(self.current_source), None)
+        self._append({'source': str(self.current_source), 'outputs': self.current_outputs})
+        self.current_source = None
+        self.current_outputs = []
+        self.unflushed += 1
+        if self.unflushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Sync the journal to disk.
+        """
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+        self.unflushed = 0
+
+    def close(self):
+        if self.journal_file is None:
+            return
+        self.flush()
+        self.journal_file.close()
+        self.journal_file = None
+
+
+def _stat(path):
+    """
+    Returns the modification time and size of a source file, or ``None`` if it cannot be read, e.g. a song in a pack.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class JournalingWriter(SongWriter):
+    """
+    Passes files on to another writer and records them in a :class:`ConversionJournal`, or another object with an
+    ``output_written`` method such as :class:`songwatch.OutputMap`.
+
+    The files are attributed to the song the journal is currently tracking, so they have to be written in song
+    order by the process which iterates over the songs.
+    """
+
+    def __init__(self, writer, journal):
+        self.writer = writer
+        self.journal = journal
+
+    def existing_names(self):
+        return self.writer.existing_names()
+
+    def write(self, filename, data):
+        self.writer.write(filename, data)
+        self.journal.output_written(filename, len(data))
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,489 @@
+"""
+The :mod:`converter` module converts a directory of SongShow Plus files. ``song_converter.py`` runs it with the
+settings of its configuration section, and other programs can use it the same way::
+
+    from converter import SongConverter
+
+    failures = SongConverter('../Songs', '../songs_exported', output_mode='xml').run()
+
+The ``text`` and ``xml`` output can also be written in one run, e.g. with ``output_mode='text,xml'``. Every song is then
+imported once and rendered in both formats, into the ``text`` and ``xml`` subdirectories of the export directory.
+
+Importing the module has no side effects. lxml is only loaded once a song is rendered as OpenLyrics, and the backends
+of the other output modes and options only when a run uses them.
+"""
+import copy
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+
+from checkpoint import ConversionJournal, JournalingWriter
+from filenames import FilenameIndex, clean_filename
+from parallelexport import export_parallel, render_openlyrics, render_text, render_with, text_title
+from songdiscovery import DEFAULT_INCLUDE, SongDiscovery
+from songpack import is_pack, open_pack
+from songpipeline import run_pipeline
+from songshowplus import ParseLimits, SongShowPlusImport
+from shardlayout import DEFAULT_MAX_ENTRIES, Manifest, ShardedLayout
+from songwriters import AtomicWriter, BufferedWriter
+
+log = logging.getLogger(__name__)
+
+OUTPUT_MODES = ('text', 'xml', 'openlp', 'metadata')
+# The output modes which write one file per song, several of which can be written in one run
+FILE_OUTPUT_MODES = ('text', 'xml')
+
+
+class ExportTarget(object):
+    """
+    How the songs are written in one of the file output modes. Further formats can be added to :data:`EXPORT_TARGETS`.
+    """
+
+    def __init__(self, extension, filename, render, prepare=None):
+        """
+        :param str extension: The file extension, without the leading dot.
+        :param filename: A function which returns the file name for a song, without extension.
+        :param render: A module level function which turns a song into the file contents, so it can be used by worker
+            processes.
+        :param prepare: A function which returns the song as this format shows it. It must not change the song itself,
+            which is shared with the other formats.
+        """
+        self.extension = extension
+        self.filename = filename
+        self.render = render
+        self.prepare = prepare or (lambda song: song)
+
+
+def _text_song(song):
+    text_song = copy.copy(song)
+    text_song.title = text_title(song.title)
+    return text_song
+
+
+def _text_filename(song):
+    filename = '{title}'.format(title=song.title)
+
+    if song.authors:
+        filename = filename + ' ({author})'.format(author=', '.join([author for author in song.authors]))
+
+    if song.song_book_name:
+        filename = '{songbook} - '.format(songbook=song.song_book_name) + filename
+    return filename
+
+
+def _xml_filename(song):
+    return '{title} ({author})'.format(title=song.title, author=', '.join([author for author in song.authors]))
+
+
+EXPORT_TARGETS = {
+    'text': ExportTarget('txt', _text_filename, render_text, _text_song),
+    'xml': ExportTarget('xml', _xml_filename, render_openlyrics),
+}
+
+
+class SongConverter(object):
+    """
+    Imports the song files of a directory and exports them in one of the output modes. The options are those of the
+    configuration section of ``song_converter.py``, in lower case.
+    """
+
+    def __init__(self, import_dir, export_dir, output_mode='text', pipeline=False, bundle_format=None,
+                 atomic_writes=False, fsync_batch=0, dedupe=None, search_index=False, run_report=None,
+                 memory_budget_mb=0, export_processes=1, checkpoint=None, resume=False, guarded_parsing=False,
+                 watch=False, shard_layout=None, shard_max_entries=DEFAULT_MAX_ENTRIES, block_scan=False,
+                 recursive=False, include=DEFAULT_INCLUDE, exclude=(), sort_songs=True, ccli_catalog=None):
+        """
+        :param import_dir: The directory of the ``.sbsong`` files, or a pack of them made by :mod:`songpack`.
+        :param export_dir: The directory to write to. It is created if it does not exist.
+        :param output_mode: ``text``, ``xml``, ``openlp`` or ``metadata``, or several of the file output modes ``text``
+            and ``xml`` as a comma separated string or a list, to write them in one pass.
+        :param bool pipeline: Export songs while the import is still running.
+        :param str bundle_format: ``tar``, ``tar.gz``, ``tar.bz2`` or ``tar.xz`` to write one archive.
+        :param bool atomic_writes: Write each file under a temporary name and rename it once complete.
+        :param int fsync_batch: With ``atomic_writes``, sync the files to disk after this many files.
+        :param str dedupe: ``report`` to list duplicate songs, ``collapse`` to only export one song of each group.
+        :param bool search_index: Also build ``songs.index``.
+        :param run_report: The path of a JSON report to write at the end.
+        :param int memory_budget_mb: Keep only about this many MB of songs in memory.
+        :param int export_processes: Render the ``xml`` output in this many worker processes.
+        :param checkpoint: The path of a journal of the converted files, to allow resuming.
+        :param bool resume: With ``checkpoint``, continue an interrupted run.
+        :param bool guarded_parsing: Check every size and offset read from the song files.
+        :param bool watch: Keep running and convert songs again when they are added, changed or deleted.
+        :param str shard_layout: ``hash``, ``book`` or ``letter`` to spread the files over subdirectories and write a
+            ``manifest.json`` of where each song went.
+        :param int shard_max_entries: With ``shard_layout``, the maximum number of files in one subdirectory.
+        :param bool block_scan: Find the blocks of the song files in batches with NumPy, if it is installed.
+        :param bool recursive: Also convert the song files in the subfolders of the import directory.
+        :param include: The patterns of the names of the song files.
+        :param exclude: The patterns of the names or relative paths of the files and folders to skip.
+        :param bool sort_songs: Convert the song files in the order of their names, folder by folder.
+        :param ccli_catalog: The path of a CSV export of the CCLI song catalog to fill in missing authors, copyright
+            and CCLI numbers from.
+        """
+        if isinstance(output_mode, str):
+            output_modes = [mode.strip() for mode in output_mode.split(',')]
+        else:
+            output_modes = list(output_mode)
+        for mode in output_modes:
+            if mode not in OUTPUT_MODES:
+                raise ValueError('Unknown output mode {mode}'.format(mode=mode))
+        if len(output_modes) > 1 and not all(mode in FILE_OUTPUT_MODES for mode in output_modes):
+            raise ValueError('Only the output modes {modes} can be combined'.format(modes=', '.join(FILE_OUTPUT_MODES)))
+        self.import_dir = Path(import_dir)
+        self.export_dir = Path(export_dir)
+        self.output_modes = output_modes
+        self.output_mode = ','.join(output_modes)
+        self.pipeline = pipeline
+        self.bundle_format = bundle_format
+        self.atomic_writes = atomic_writes
+        self.fsync_batch = fsync_batch
+        self.dedupe = dedupe
+        self.search_index = search_index
+        self.run_report = run_report
+        self.memory_budget_mb = memory_budget_mb
+        self.export_processes = export_processes
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.guarded_parsing = guarded_parsing
+        self.watch = watch
+        self.block_scan = block_scan
+        self.recursive = recursive
+        self.include = include
+        self.exclude = exclude
+        self.sort_songs = sort_songs
+        self.ccli_catalog = ccli_catalog
+        self.layout = ShardedLayout(shard_layout, shard_max_entries) if shard_layout else None
+        self.manifest = None
+        # The runreport.RunReport of the current run, if RUN_REPORT is set
+        self.report = None
+        self.importer = None
+        self.watcher = None
+
+    def discovery(self):
+        """
+        Returns a :class:`songdiscovery.SongDiscovery` of the song files in the import directory.
+        """
+        return SongDiscovery(self.import_dir, self.include, self.exclude, self.recursive, self.sort_songs)
+
+    def find_songs(self):
+        """
+        Returns the paths of the song files in the import directory, which are found while the import runs. If the
+        import directory is a pack made by :mod:`songpack`, returns its songs instead, selected the same way.
+        """
+        if is_pack(self.import_dir):
+            return open_pack(self.import_dir).song_files(self.discovery())
+        return iter(self.discovery())
+
+    def _directory(self, song, names, parent=''):
+        """
+        Returns the subdirectory of ``parent`` to write a song to, with ``shard_layout``.
+        """
+        if self.layout is None:
+            return ''
+        return self.layout.directory(song, names, parent)
+
+    def export_songs_txt(self, song_list, writer=None, names=None):
+        log.debug('started text export')
+        self.export_songs_files(song_list, writer, names, ['text'])
+
+    def export_songs_xml(self, song_list, writer=None, names=None):
+        log.debug('started OpenLyricsExport')
+        self.export_songs_files(song_list, writer, names, ['xml'])
+
+    def export_songs_files(self, song_list, writer=None, names=None, modes=None):
+        """
+        Export songs in one or more file output modes, one file per song and mode.
+
+        Every song is handed to each mode in turn, so it is only imported once, and the modes share its verses, verse
+        plan and shard directory. Adding a mode only adds the time to render it.
+
+        :param modes: The output modes, from :data:`EXPORT_TARGETS`. With more than one, the files of each mode are
+            written to a subdirectory of the export directory named after it. Defaults to the converter's output modes.
+        """
+        if modes is None:
+            modes = self.output_modes
+        if writer is None:
+            writer = BufferedWriter(self.export_dir)
+        if names is None:
+            names = FilenameIndex(self.export_dir, writer.existing_names())
+        parents = modes if len(modes) > 1 else ['']
+
+        # The source of every file handed to the workers and not yet reported
+        sources = {}
+
+        def named_songs():
+            for song in song_list:
+                directory = None
+                paths = {}
+                for mode, parent in zip(modes, parents):
+                    target = EXPORT_TARGETS[mode]
+                    target_song = target.prepare(song)
+                    filename = clean_filename(target.filename(target_song))
+
+                    print('Now exporting song: {filename}'.format(filename=filename))
+                    if directory is None:
+                        directory = self._directory(song, names, parent)
+                    # Shorten the name for some filesystems and make sure we're not overwriting an existing file
+                    filename_with_ext = names.reserve(filename, target.extension,
+                                                      '/'.join(part for part in (parent, directory) if part))
+                    paths[mode] = filename_with_ext
+                    if self.report:
+                        sources[filename_with_ext] = song.source_path
+                    yield filename_with_ext, (target.render, target_song)
+                if self.manifest is not None:
+                    self.manifest.add(song, paths if len(modes) > 1 else paths[modes[0]])
+
+        # A journal attributes the files to the songs in the order they are written, which the workers do not keep
+        if self.export_processes > 1 and 'xml' in modes and not isinstance(writer, JournalingWriter):
+            # File names are assigned here, in song order, so the result does not depend on the workers
+            timed = None
+            if self.report:
+                def timed(filename, seconds, size):
+                    self.report.file_exported(sources.pop(filename), filename, seconds, size)
+            export_parallel(named_songs(), render_with, writer, self.export_processes, timed=timed)
+            return
+        for filename_with_ext, (render, song) in named_songs():
+            started = time.perf_counter()
+            data = render(song)
+            writer.write(filename_with_ext, data)
+            if self.report:
+                self.report.file_exported(sources.pop(filename_with_ext), filename_with_ext,
+                                          time.perf_counter() - started, len(data))
+
+    def export_songs_openlp(self, song_list, writer=None, names=None):
+        from openlpdb import OpenLPSongDatabase
+
+        log.debug('started OpenLP database export')
+        if names is None:
+            names = FilenameIndex.from_directory(self.export_dir)
+
+        db_path = self.export_dir / names.reserve('songs', 'sqlite')
+        with OpenLPSongDatabase(db_path) as database:
+            for song in song_list:
+                print('Now exporting song: {title}'.format(title=song.title))
+                database.add(song)
+        if self.report:
+            self.report.file_written(os.path.getsize(str(db_path)))
+
+    def export_songs_metadata(self, song_list, writer=None, names=None):
+        from metadataexport import ColumnarExport, JsonLinesExport
+
+        log.debug('started metadata export')
+        if names is None:
+            names = FilenameIndex.from_directory(self.export_dir)
+
+        exports = [JsonLinesExport(self.export_dir / names.reserve('songs', 'jsonl')),
+                   ColumnarExport(self.export_dir / names.reserve('songs', 'columns'))]
+        for song in song_list:
+            print('Now exporting song: {title}'.format(title=song.title))
+            for export in exports:
+                export.add(song)
+        for export in exports:
+            export.close()
+            if self.report:
+                self.report.file_written(os.path.getsize(str(export.path)))
+
+    def stop(self):
+        """
+        Stop a running conversion after the current song, e.g. from another thread.
+        """
+        if self.importer is not None:
+            self.importer.stop_import()
+        if self.watcher is not None:
+            self.watcher.stop()
+
+    def _interrupted(self, signum, frame):
+        # Finish the songs imported so far, so the journal is complete. A second Ctrl-C aborts right away.
+        print('Stopping after the current song, press Ctrl-C again to abort')
+        self.stop()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    def run(self, song_list=None):
+        """
+        Convert the songs.
+
+        :param song_list: The paths of the song files to convert. Defaults to all song files in the import directory.
+        :return: The :class:`songimport.ImportFailure` of every file which could not be imported.
+        """
+        if song_list is None:
+            song_list = self.find_songs()
+        if not os.path.exists(self.export_dir):
+            os.makedirs(self.export_dir)
+        single_files = not self.bundle_format and all(mode in FILE_OUTPUT_MODES for mode in self.output_modes)
+
+        self.manifest = None
+        if self.layout and not single_files:
+            log.warning('SHARD_LAYOUT only works with one file per song, ignoring it')
+        elif self.layout:
+            # Read before a journal removes files it does not know about, which include the manifest
+            self.manifest = Manifest(self.export_dir, self.layout, self.import_dir)
+
+        journal = None
+        if self.checkpoint and not single_files:
+            log.warning('CHECKPOINT only works with one file per song, ignoring it')
+        elif self.checkpoint:
+            journal = ConversionJournal(self.checkpoint, self.export_dir, self.resume)
+            song_list = (song_path for song_path in song_list if not journal.is_done(song_path))
+
+        self.watcher = None
+        if self.watch and not single_files:
+            log.warning('WATCH only works with one file per song, ignoring it')
+        elif self.watch and is_pack(self.import_dir):
+            log.warning('WATCH needs a folder of song files, not a pack, ignoring it')
+        elif self.watch:
+            from songwatch import OutputMap, SongWatcher
+            # Changes made while the first conversion runs are picked up afterwards
+            self.watcher = SongWatcher(self.import_dir, discovery=self.discovery())
+            output_map = OutputMap()
+
+        if self.memory_budget_mb:
+            from songstore import SpillingSongStore
+            song_store = SpillingSongStore(self.memory_budget_mb * 1024 * 1024)
+        else:
+            song_store = []
+        run_report = None
+        if self.run_report:
+            from runreport import RunReport, print_summary
+            run_report = RunReport()
+        self.report = run_report
+        self.importer = importer = SongShowPlusImport(file_paths=song_list, store=song_store, run_report=run_report,
+                                                      limits=ParseLimits() if self.guarded_parsing else None,
+                                                      block_scan=self.block_scan)
+
+        if self.bundle_format:
+            from songbundle import SongBundle
+            writer = SongBundle(self.export_dir / 'songs.{ext}'.format(ext=self.bundle_format), self.bundle_format)
+        elif self.atomic_writes or journal:
+            # With a journal, an interrupted write can only ever leave a temporary file behind
+            writer = AtomicWriter(self.export_dir, self.fsync_batch)
+        else:
+            writer = BufferedWriter(self.export_dir)
+        if journal:
+            writer = JournalingWriter(writer, journal)
+        if self.watcher:
+            writer = JournalingWriter(writer, output_map)
+
+        if len(self.output_modes) > 1:
+            export_songs = self.export_songs_files
+        elif self.output_mode == 'xml':
+            export_songs = self.export_songs_xml
+        elif self.output_mode == 'openlp':
+            export_songs = self.export_songs_openlp
+        elif self.output_mode == 'metadata':
+            export_songs = self.export_songs_metadata
+        else:
+            export_songs = self.export_songs_txt
+
+        duplicate_finder = None
+        if self.dedupe:
+            from songdedupe import DuplicateFinder, collapse_duplicates, print_duplicates
+            duplicate_finder = DuplicateFinder()
+        enricher = None
+        if self.ccli_catalog:
+            from cclicatalog import CatalogEnricher, open_catalog
+            enricher = CatalogEnricher(open_catalog(self.ccli_catalog))
+        search_index = None
+        if self.search_index:
+            from songsearch import SearchIndexBuilder
+            search_index = SearchIndexBuilder()
+
+        def export(songs):
+            # Before anything which looks at the authors, which the catalog may fill in
+            if enricher:
+                songs = enricher.scan(songs)
+            if self.dedupe == 'report':
+                songs = duplicate_finder.scan(songs)
+            if search_index:
+                songs = search_index.scan(songs)
+            # The file output modes, also into a bundle, report the time of every file they write themselves
+            if run_report and not all(mode in FILE_OUTPUT_MODES for mode in self.output_modes):
+                songs = run_report.timed(songs)
+            if journal:
+                songs = journal.track(songs, importer.failures)
+            if self.watcher:
+                songs = output_map.track(songs)
+            export_songs(songs, writer)
+
+        def convert_changes(changed, deleted):
+            # Replace the files of changed songs and remove those of deleted ones, reusing the loaded importer
+            for song_path in changed + deleted:
+                for filename in output_map.pop(song_path):
+                    if os.path.exists(self.export_dir / filename):
+                        os.remove(self.export_dir / filename)
+                    names.release(filename)
+                if self.manifest is not None:
+                    self.manifest.discard(song_path)
+            importer.import_source = changed
+            importer.store = []
+            importer.do_import()
+            songs = output_map.track(importer.store)
+            if enricher:
+                songs = enricher.scan(songs)
+            if journal:
+                songs = journal.track(songs, importer.failures)
+            export_songs(songs, writer, names)
+            writer.flush()
+            if self.manifest is not None:
+                self.manifest.write()
+            print('Updated {changed} and removed {deleted} songs'.format(changed=len(importer.store),
+                                                                          deleted=len(deleted)))
+
+        # Ctrl-C stops the run cleanly, but signal handlers can only be set from the main thread
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            previous_handler = signal.signal(signal.SIGINT, self._interrupted)
+        try:
+            # Collapsing duplicates needs the whole library before the first song can be exported
+            if self.pipeline and self.dedupe != 'collapse':
+                run_pipeline(importer, export)
+            else:
+                importer.do_import()
+                songs = song_store
+                if self.dedupe == 'collapse':
+                    for song in song_store:
+                        duplicate_finder.add(song)
+                    songs = collapse_duplicates(song_store, duplicate_finder.clusters())
+                export(songs)
+            if self.watcher and not importer.stop_import_flag:
+                writer.flush()
+                names = FilenameIndex(self.export_dir, writer.existing_names())
+                print('Watching {path} for changes, press Ctrl-C to stop'.format(path=self.import_dir))
+                self.watcher.run(convert_changes)
+        finally:
+            writer.close()
+            if journal:
+                journal.close()
+            if self.manifest is not None:
+                self.manifest.write()
+            if previous_handler is not None:
+                signal.signal(signal.SIGINT, previous_handler)
+
+        if journal and journal.skipped_failures:
+            # Skipped this time, but still part of the result
+            print('Skipped {count} song files which failed to import before'.format(
+                count=len(journal.skipped_failures)))
+            for failure in journal.skipped_failures:
+                importer.failures.append(failure)
+                if run_report:
+                    run_report.file_failed(failure)
+        if importer.stop_import_flag:
+            print('Stopped early, set RESUME = True to continue' if journal else 'Stopped early')
+        if self.memory_budget_mb:
+            song_store.close()
+        if enricher:
+            enricher.print_summary()
+            enricher.index.close()
+        if search_index:
+            index_name = FilenameIndex.from_directory(self.export_dir).reserve('songs', 'index')
+            search_index.write(self.export_dir / index_name)
+            if run_report:
+                run_report.file_written(os.path.getsize(str(self.export_dir / index_name)))
+        if duplicate_finder:
+            print_duplicates(duplicate_finder.clusters())
+        if run_report:
+            print_summary(run_report.write(self.run_report))
+        return importer.failures
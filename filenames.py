@@ -0,0 +1,109 @@
+"""
+The :mod:`filenames` module assigns collision-free output file names for the exporters.
+"""
+import os
+import re
+
+CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\x9F]')
+INVALID_FILE_CHARS = re.compile(r'[\\/:\*\?"<>\|\+\[\]%]')
+
+# Keep the full path below the 255/260 character limits of some filesystems.
+MAX_PATH_LENGTH = 250
+
+
+def clean_filename(filename):
+    """
+    Removes invalid characters from the given ``filename``.
+
+    :param str filename:  The "dirty" file name to clean.
+    :return: The cleaned string
+    :rtype: str
+    """
+    return INVALID_FILE_CHARS.sub('_', CONTROL_CHARS.sub('', filename)).strip()
+
+
+class FilenameIndex(object):
+    """
+    Keeps track of the file names used in an export directory, so clashes can be resolved without asking the
+    filesystem about every candidate name.
+
+    The index is seeded from a single listing of the directory and afterwards only updated in memory. Names are
+    compared case-insensitively, because most of the target platforms use case-insensitive filesystems.
+    """
+
+    def __init__(self, export_dir, existing_names=()):
+        """
+        :param export_dir: The directory the files will be written to. Only its length is used, to truncate names.
+        :param existing_names: File names which are already taken, as ``directory/name`` for those in subdirectories.
+        """
+        self.path_length = len(str(export_dir))
+        self.taken = set(name.lower() for name in existing_names)
+        # The last "-N" suffix handed out per base name, so repeated titles do not retry every lower number.
+        self.suffixes = {}
+        # The number of names taken per subdirectory
+        self.counts = {}
+        for name in self.taken:
+            directory = name.rpartition('/')[0]
+            self.counts[directory] = self.counts.get(directory, 0) + 1
+
+    @classmethod
+    def from_directory(cls, export_dir):
+        """
+        Create an index seeded with the files already present in ``export_dir``.
+        """
+        try:
+            existing_names = os.listdir(str(export_dir))
+        except FileNotFoundError:
+            existing_names = []
+        return cls(export_dir, existing_names)
+
+    def __contains__(self, filename):
+        return filename.lower() in self.taken
+
+    def count(self, directory=''):
+        """
+        Returns the number of names taken in a subdirectory, or in the export directory itself.
+        """
+        return self.counts.get(directory.lower(), 0)
+
+    def reserve(self, filename, extension, directory=''):
+        """
+        Reserve a unique file name.
+
+        The name is cleaned and truncated to fit the path length limit. If it is already taken, a ``-N`` suffix is
+        added, just like ``name-1.txt``, ``name-2.txt`` and so on.
+
+        :param str filename: The file name without extension.
+        :param str extension: The file extension without the leading dot.
+        :param str directory: The subdirectory of the export directory to put the file in, with ``/`` separators.
+        :return: The reserved file name, including the extension, as ``directory/name`` in a subdirectory.
+        :rtype: str
+        """
+        filename = clean_filename(filename)
+        prefix = directory + '/' if directory else ''
+        path_length = self.path_length + len(prefix)
+        filename_with_ext = '{prefix}{name}.{ext}'.format(prefix=prefix, name=filename[0:MAX_PATH_LENGTH - path_length],
+                                                          ext=extension)
+        if filename_with_ext.lower() in self.taken:
+            key = (prefix.lower() + filename.lower(), extension.lower())
+            conflicts = self.suffixes.get(key, 0)
+            short_name = filename[0:MAX_PATH_LENGTH - 3 - path_length]
+            while filename_with_ext.lower() in self.taken:
+                conflicts += 1
+                filename_with_ext = '{prefix}{name}-{extra}.{ext}'.format(prefix=prefix, name=short_name,
+                                                                          extra=conflicts, ext=extension)
+            self.suffixes[key] = conflicts
+        self.taken.add(filename_with_ext.lower())
+        self.counts[directory.lower()] = self.counts.get(directory.lower(), 0) + 1
+        return filename_with_ext
+
+    def release(self, filename_with_ext):
+        """
+        Make a reserved file name available again, e.g. after its file has been removed.
+        """
+        if filename_with_ext.lower() in self.taken:
+            directory = filename_with_ext.lower().rpartition('/')[0]
+            self.counts[directory] -= 1
+        self.taken.discard(filename_with_ext.lower())
+        # Let the next clash start counting at 1 again, so the freed "-N" name can be handed out
+        self.suffixes.clear()
@@ -0,0 +1,197 @@
+"""
+The :mod:`metadataexport` module writes one metadata record per song, for inventory and licensing reports.
+
+Two files are written side by side:
+
+* ``songs.jsonl``, JSON Lines with one object per song, streamed as the songs arrive.
+* ``songs.columns``, a compact columnar file. Every column is dictionary-encoded: the distinct values are stored once
+  and each row only stores a 32 bit index into that dictionary. List columns, such as the authors, additionally store
+  the offset of every row's first entry. A report reading one or two columns only has to read those blocks.
+
+The columnar file starts with ``COLUMNS_MAGIC``, followed by the column blocks and a JSON footer describing them. The
+file ends with the length of that footer as an unsigned 64 bit little-endian integer and ``COLUMNS_MAGIC`` again.
+"""
+import json
+import logging
+import struct
+import sys
+from array import array
+
+log = logging.getLogger(__name__)
+
+COLUMNS_MAGIC = b'SONGCOL1'
+
+# The exported fields, and whether they hold a single string or a list of strings
+FIELDS = [
+    ('title', 'string'),
+    ('alternate_title', 'string'),
+    ('authors', 'list'),
+    ('copyright', 'string'),
+    ('ccli_number', 'string'),
+    ('song_book_name', 'string'),
+    ('song_number', 'string'),
+    ('topics', 'list'),
+    ('verse_order', 'string'),
+    ('theme_name', 'string'),
+    ('comments', 'string')
+]
+
+
+def song_record(song):
+    """
+    Build the metadata record of a song. Numbers, such as the CCLI number, are exported as strings.
+
+    :param song: A :class:`utils.Song`.
+    :return: A dictionary with one entry per field in ``FIELDS``.
+    """
+    record = {}
+    for name, kind in FIELDS:
+        value = getattr(song, name)
+        if kind == 'list':
+            record[name] = [str(item) for item in value]
+        else:
+            record[name] = str(value) if value else ''
+    return record
+
+
+def _uint32_array(values=()):
+    values = array('I', values)
+    # The columns are written as 4 byte integers, which 'I' is on every platform Python supports
+    assert values.itemsize == 4
+    return values
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data):
+    values = _uint32_array()
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class JsonLinesExport(object):
+    """
+    Streams one JSON object per song into a JSON Lines file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.out_file = open(str(path), 'w', encoding='utf-8')
+
+    def add(self, song):
+        self.out_file.write(json.dumps(song_record(song), ensure_ascii=False))
+        self.out_file.write('\n')
+
+    def close(self):
+        self.out_file.close()
+
+
+class ColumnarExport(object):
+    """
+    Collects the dictionary-encoded columns in memory and writes the columnar file when closed.
+
+    Only the distinct values and four bytes per row and column are kept, so even large libraries need little memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.dictionaries = {name: {} for name, kind in FIELDS}
+        self.codes = {name: _uint32_array() for name, kind in FIELDS}
+        self.offsets = {name: _uint32_array([0]) for name, kind in FIELDS if kind == 'list'}
+
+    def _encode(self, name, value):
+        dictionary = self.dictionaries[name]
+        code = dictionary.get(value)
+        if code is None:
+            code = len(dictionary)
+            dictionary[value] = code
+        return code
+
+    def add(self, song):
+        record = song_record(song)
+        for name, kind in FIELDS:
+            if kind == 'list':
+                for value in record[name]:
+                    self.codes[name].append(self._encode(name, value))
+                self.offsets[name].append(len(self.codes[name]))
+            else:
+                self.codes[name].append(self._encode(name, record[name]))
+        self.rows += 1
+
+    def close(self):
+        columns = []
+        with open(str(self.path), 'wb') as out_file:
+            out_file.write(COLUMNS_MAGIC)
+
+            def write_block(data):
+                offset = out_file.tell()
+                out_file.write(data)
+                return [offset, len(data)]
+
+            for name, kind in FIELDS:
+                # Dictionaries preserve insertion order, so the position of a value is its code
+                column = {'name': name, 'type': kind,
+                          'dictionary': write_block(json.dumps(list(self.dictionaries[name]),
+                                                               ensure_ascii=False).encode('utf-8')),
+                          'codes': write_block(_to_bytes(self.codes[name]))}
+                if kind == 'list':
+                    column['offsets'] = write_block(_to_bytes(self.offsets[name]))
+                columns.append(column)
+            footer = json.dumps({'rows': self.rows, 'columns': columns}).encode('utf-8')
+            out_file.write(footer)
+            out_file.write(struct.pack('<Q', len(footer)))
+            out_file.write(COLUMNS_MAGIC)
+        log.info('wrote metadata of {count} songs to {path}'.format(count=self.rows, path=self.path))
+
+
+def read_columns(path, names=None):
+    """
+    Read columns from a columnar metadata file.
+
+    :param path: The path of the file.
+    :param names: The names of the columns to read. Defaults to all columns.
+    :return: A dictionary mapping each column name to a list with one value per song.
+    """
+    with open(str(path), 'rb') as in_file:
+        in_file.seek(-len(COLUMNS_MAGIC) - 8, 2)
+        footer_length, = struct.unpack('<Q', in_file.read(8))
+        if in_file.read(len(COLUMNS_MAGIC)) != COLUMNS_MAGIC:
+            raise ValueError('{path} is not a columnar metadata file'.format(path=path))
+        in_file.seek(-len(COLUMNS_MAGIC) - 8 - footer_length, 2)
+        footer = json.loads(in_file.read(footer_length).decode('utf-8'))
+
+        def read_block(block):
+            in_file.seek(block[0])
+            return in_file.read(block[1])
+
+        result = {}
+        for column in footer['columns']:
+            if names is not None and column['name'] not in names:
+                continue
+            dictionary = json.loads(read_block(column['dictionary']).decode('utf-8'))
+            codes = _from_bytes(read_block(column['codes']))
+            if column['type'] == 'list':
+                offsets = _from_bytes(read_block(column['offsets']))
+                result[column['name']] = [[dictionary[code] for code in codes[offsets[row]:offsets[row + 1]]]
+                                          for row in range(footer['rows'])]
+            else:
+                result[column['name']] = [dictionary[code] for code in codes]
+        return result
+
+
+def iter_records(path):
+    """
+    Iterate over the records of a columnar metadata file, as returned by :func:`song_record`.
+    """
+    columns = read_columns(path)
+    names = list(columns)
+    for values in zip(*[columns[name] for name in names]):
+        yield dict(zip(names, values))
@@ -0,0 +1,209 @@
+"""
+The :mod:`openlpdb` module writes songs straight into an OpenLP song database (``songs.sqlite``).
+
+The database uses the schema of OpenLP's songs plugin, so the file can replace the one in OpenLP's data folder, or be
+merged into an existing library with OpenLP's "OpenLP 2 Databases" import. OpenLP upgrades the schema to its own
+version when it opens the file.
+
+Songs are inserted in large batches, each inside a single transaction, with one prepared statement per table. The
+secondary indexes are only created once all rows are in, and the file is written under a temporary name and renamed
+once it is complete.
+"""
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+from songxml import SongXML
+from utils import clean_lyrics, clean_title
+
+log = logging.getLogger(__name__)
+
+# The version of OpenLP's songs plugin schema created below
+SCHEMA_VERSION = 6
+DEFAULT_BATCH_SIZE = 5000
+
+SCHEMA = [
+    'CREATE TABLE metadata (key VARCHAR(64) NOT NULL, value TEXT, PRIMARY KEY (key))',
+    'CREATE TABLE authors (id INTEGER NOT NULL, first_name VARCHAR(128), last_name VARCHAR(128), '
+    'display_name VARCHAR(255) NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE song_books (id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, publisher VARCHAR(128), '
+    'PRIMARY KEY (id))',
+    'CREATE TABLE songs (id INTEGER NOT NULL, title VARCHAR(255) NOT NULL, alternate_title VARCHAR(255), '
+    'lyrics TEXT NOT NULL, verse_order VARCHAR(128), copyright VARCHAR(255), comments TEXT, ccli_number VARCHAR(64), '
+    'theme_name VARCHAR(128), search_title VARCHAR(255) NOT NULL, search_lyrics TEXT NOT NULL, '
+    'create_date DATETIME, last_modified DATETIME, temporary BOOLEAN, PRIMARY KEY (id))',
+    'CREATE TABLE topics (id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, PRIMARY KEY (id))',
+    'CREATE TABLE media_files (id INTEGER NOT NULL, song_id INTEGER, file_name VARCHAR(255) NOT NULL, '
+    'type VARCHAR(64) NOT NULL, weight INTEGER, PRIMARY KEY (id), FOREIGN KEY(song_id) REFERENCES songs (id))',
+    'CREATE TABLE authors_songs (author_id INTEGER NOT NULL, song_id INTEGER NOT NULL, '
+    'author_type VARCHAR(255) NOT NULL DEFAULT \'\', PRIMARY KEY (author_id, song_id, author_type), '
+    'FOREIGN KEY(author_id) REFERENCES authors (id), FOREIGN KEY(song_id) REFERENCES songs (id))',
+    'CREATE TABLE songs_topics (song_id INTEGER NOT NULL, topic_id INTEGER NOT NULL, PRIMARY KEY (song_id, topic_id), '
+    'FOREIGN KEY(song_id) REFERENCES songs (id), FOREIGN KEY(topic_id) REFERENCES topics (id))',
+    'CREATE TABLE songs_songbooks (songbook_id INTEGER NOT NULL, song_id INTEGER NOT NULL, '
+    'entry VARCHAR(255) NOT NULL, PRIMARY KEY (songbook_id, song_id, entry), '
+    'FOREIGN KEY(songbook_id) REFERENCES song_books (id), FOREIGN KEY(song_id) REFERENCES songs (id))'
+]
+
+# Created after the bulk load, so the inserts do not have to maintain them
+INDEXES = [
+    'CREATE INDEX ix_songs_search_title ON songs (search_title)',
+    'CREATE INDEX ix_topics_name ON topics (name)',
+    'CREATE INDEX ix_authors_display_name ON authors (display_name)',
+    'CREATE INDEX ix_song_books_name ON song_books (name)'
+]
+
+INSERT_SONG = 'INSERT INTO songs (id, title, alternate_title, lyrics, verse_order, copyright, comments, ' \
+    'ccli_number, theme_name, search_title, search_lyrics, create_date, last_modified, temporary) ' \
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)'
+INSERT_AUTHOR = 'INSERT INTO authors (id, first_name, last_name, display_name) VALUES (?, ?, ?, ?)'
+INSERT_TOPIC = 'INSERT INTO topics (id, name) VALUES (?, ?)'
+INSERT_SONG_BOOK = 'INSERT INTO song_books (id, name, publisher) VALUES (?, ?, \'\')'
+INSERT_AUTHOR_SONG = 'INSERT OR IGNORE INTO authors_songs (author_id, song_id, author_type) VALUES (?, ?, \'\')'
+INSERT_SONG_TOPIC = 'INSERT OR IGNORE INTO songs_topics (song_id, topic_id) VALUES (?, ?)'
+INSERT_SONG_SONGBOOK = 'INSERT OR IGNORE INTO songs_songbooks (songbook_id, song_id, entry) VALUES (?, ?, ?)'
+
+
+class OpenLPSongDatabase(object):
+    """
+    Builds an OpenLP song database from a stream of songs.
+    """
+
+    def __init__(self, db_path, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param db_path: The path of the database to create.
+        :param int batch_size: The number of songs inserted per transaction.
+        """
+        self.db_path = str(db_path)
+        self.temp_path = self.db_path + '.partial'
+        self.batch_size = batch_size
+        self.sxml = SongXML()
+        # Authors, topics and song books are shared between songs, so their ids are handed out here
+        self.author_ids = {}
+        self.topic_ids = {}
+        self.song_book_ids = {}
+        self.song_count = 0
+        self._clear_batch()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.connection = sqlite3.connect(self.temp_path, isolation_level=None)
+        # The file only gets its final name once it is complete, so the journal is not needed
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('BEGIN')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.execute('INSERT INTO metadata (key, value) VALUES (?, ?)', ('version', str(SCHEMA_VERSION)))
+        self.connection.execute('COMMIT')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A failed export must not leave a database behind which looks complete
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def _clear_batch(self):
+        self.songs = []
+        self.authors = []
+        self.topics = []
+        self.song_books = []
+        self.authors_songs = []
+        self.songs_topics = []
+        self.songs_songbooks = []
+
+    def _get_id(self, ids, rows, name, make_row):
+        """
+        Return the id of an author, topic or song book, queueing a new row if it has not been seen before.
+        """
+        item_id = ids.get(name)
+        if item_id is None:
+            item_id = len(ids) + 1
+            ids[name] = item_id
+            rows.append(make_row(item_id, name))
+        return item_id
+
+    def add(self, song):
+        """
+        Queue a song for insertion.
+
+        :param song: A :class:`utils.Song`.
+        """
+        self.song_count += 1
+        song_id = self.song_count
+        search_title = song.search_title or clean_title(song.title, song.alternate_title)
+        search_lyrics = song.search_lyrics
+        if not search_lyrics:
+            search_lyrics = clean_lyrics([verse[1] for verse in self.sxml.get_verses(song.lyrics)])
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.songs.append((song_id, song.title, song.alternate_title, song.lyrics, song.verse_order, song.copyright,
+                           song.comments, str(song.ccli_number or ''), song.theme_name, search_title, search_lyrics,
+                           now, now))
+        for author in song.authors:
+            author_id = self._get_id(self.author_ids, self.authors, author, split_author)
+            self.authors_songs.append((author_id, song_id))
+        for topic in song.topics:
+            topic_id = self._get_id(self.topic_ids, self.topics, topic, lambda item_id, name: (item_id, name))
+            self.songs_topics.append((song_id, topic_id))
+        if song.song_book_name:
+            song_book_id = self._get_id(self.song_book_ids, self.song_books, song.song_book_name,
+                                        lambda item_id, name: (item_id, name))
+            self.songs_songbooks.append((song_book_id, song_id, str(song.song_number or '')))
+        if len(self.songs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert all queued rows in a single transaction.
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN')
+        cursor.executemany(INSERT_AUTHOR, self.authors)
+        cursor.executemany(INSERT_TOPIC, self.topics)
+        cursor.executemany(INSERT_SONG_BOOK, self.song_books)
+        cursor.executemany(INSERT_SONG, self.songs)
+        cursor.executemany(INSERT_AUTHOR_SONG, self.authors_songs)
+        cursor.executemany(INSERT_SONG_TOPIC, self.songs_topics)
+        cursor.executemany(INSERT_SONG_SONGBOOK, self.songs_songbooks)
+        cursor.execute('COMMIT')
+        log.debug('inserted {count} songs into the OpenLP database'.format(count=len(self.songs)))
+        self._clear_batch()
+
+    def close(self):
+        """
+        Insert the remaining songs, build the indexes and move the database to its final name.
+        """
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.execute('BEGIN')
+        for statement in INDEXES:
+            self.connection.execute(statement)
+        self.connection.execute('COMMIT')
+        self.connection.close()
+        self.connection = None
+        os.replace(self.temp_path, self.db_path)
+        log.info('wrote {count} songs to {path}'.format(count=self.song_count, path=self.db_path))
+
+    def abort(self):
+        """
+        Throw the unfinished database away, keeping any database of an earlier run under the final name.
+        """
+        if self.connection is None:
+            return
+        self.connection.close()
+        self.connection = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        log.info('discarded the unfinished database {path}'.format(path=self.temp_path))
+
+
+def split_author(author_id, display_name):
+    """
+    Build an ``authors`` row, splitting the name the same way OpenLP's importers do.
+    """
+    return author_id, ' '.join(display_name.split(' ')[:-1]), display_name.split(' ')[-1], display_name
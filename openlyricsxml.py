@@ -61,8 +61,10 @@ import re
 
 from lxml import etree, objectify
 
-from utils import VerseType
+from utils import VerseType, VersePlan
 from formattingtags import FormattingTags
+# SongXML used to be defined here, it is still imported for the programs which import it from this module
+from songxml import SongXML, song_verses  # noqa: F401
 
 log = logging.getLogger(__name__)
 
@@ -71,75 +73,6 @@ NSMAP = '{{' + NAMESPACE + '}}{tag}'
 NEWPAGETAG = '<p style="page-break-after: always;"/>'
 
 
-class SongXML(object):
-    """
-    This class builds and parses the XML used to describe songs.
-    """
-    log.info('SongXML Loaded')
-
-    def __init__(self):
-        """
-        Set up the default variables.
-        """
-        self.song_xml = objectify.fromstring('<song version="1.0" />')
-        self.lyrics = etree.SubElement(self.song_xml, 'lyrics')
-
-    def add_verse_to_lyrics(self, type, number, content, lang=None):
-        """
-        Add a verse to the ``<lyrics>`` tag.
-
-        :param type:  A string denoting the type of verse. Possible values are *v*, *c*, *b*, *p*, *i*, *e* and *o*.
-            Any other type is **not** allowed, this also includes translated types.
-        :param number: An integer denoting the number of the item, for example: verse 1.
-        :param content: The actual text of the verse to be stored.
-        :param lang:  The verse's language code (ISO-639). This is not required, but should be added if available.
-        """
-        verse = etree.Element('verse', type=str(type), label=str(number))
-        if lang:
-            verse.set('lang', lang)
-        verse.text = etree.CDATA(content)
-        self.lyrics.append(verse)
-
-    def extract_xml(self):
-        """
-        Extract our newly created XML song.
-        """
-        return etree.tostring(self.song_xml, encoding='UTF-8', xml_declaration=True)
-
-    def get_verses(self, xml):
-        """
-        Iterates through the verses in the XML and returns a list of verses and their attributes.
-
-        :param xml: The XML of the song to be parsed.
-
-        The returned list has the following format::
-
-            [[{'type': 'v', 'label': '1'}, u"optional slide split 1[---]optional slide split 2"],
-            [{'lang': 'en', 'type': 'c', 'label': '1'}, u"English chorus"]]
-        """
-        self.song_xml = None
-        verse_list = []
-        if xml.startswith('<?xml'):
-            xml = xml[38:]
-        try:
-            self.song_xml = objectify.fromstring(xml)
-        except etree.XMLSyntaxError:
-            log.exception('Invalid xml {text}'.format(text=xml))
-        xml_iter = self.song_xml.getiterator()
-        for element in xml_iter:
-            if element.tag == 'verse':
-                if element.text is None:
-                    element.text = ''
-                verse_list.append([element.attrib, str(element.text)])
-        return verse_list
-
-    def dump_xml(self):
-        """
-        Debugging aid to dump XML so that we can see what we have.
-        """
-        return etree.dump(self.song_xml)
-
-
 class OpenLyrics(object):
     """
     This class represents the converter for OpenLyrics XML (version 0.8) to/from a song.
@@ -223,7 +156,6 @@ class OpenLyrics(object):
         """
         Convert the song to OpenLyrics Format.
         """
-        sxml = SongXML()
         song_xml = objectify.fromstring('<song/>')
         # Append the necessary meta data to the song.
         song_xml.set('xmlns', NAMESPACE)
@@ -271,23 +203,11 @@ class OpenLyrics(object):
             tags_element.set('application', 'OpenLP')
         # Process the song's lyrics.
         lyrics = etree.SubElement(song_xml, 'lyrics')
-        verse_list = sxml.get_verses(song.lyrics)
-        # Add a suffix letter to each verse
-        verse_tags = []
-        for verse in verse_list:
-            verse_tag = verse[0]['type'][0].lower()
-            verse_number = verse[0]['label']
-            verse_def = verse_tag + verse_number
-            # Create the letter from the number of duplicates
-            verse[0][u'suffix'] = chr(97 + (verse_tags.count(verse_def) % 26))
-            verse_tags.append(verse_def)
-        # If the verse tag is a duplicate use the suffix letter
-        for verse in verse_list:
-            verse_tag = verse[0]['type'][0].lower()
-            verse_number = verse[0]['label']
-            verse_def = verse_tag + verse_number
-            if verse_tags.count(verse_def) > 1:
-                verse_def += verse[0]['suffix']
+        verse_list = song_verses(song.lyrics)
+        if song.verse_plan is None:
+            song.verse_plan = VersePlan.from_verse_list(verse_list, song.verse_order)
+        # Duplicate verse tags carry a suffix letter in the plan's labels
+        for verse, verse_def in zip(verse_list, song.verse_plan.labels):
             verse_element = self._add_text_to_element('verse', lyrics, None, verse_def)
             if 'lang' in verse[0]:
                 verse_element.set('lang', verse[0]['lang'])
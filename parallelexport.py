@@ -0,0 +1,190 @@
+"""
+The :mod:`parallelexport` module renders exported files in a pool of worker processes.
+
+Building the OpenLyrics XML is CPU bound, so on a multi-core machine the export can be spread over several processes.
+File names are still assigned by the calling process, in song order, before the songs are handed to the workers. The
+output is therefore exactly the same as that of a serial export, no matter which worker renders which song.
+
+lxml is only loaded once the first song is rendered as OpenLyrics, so a text export does not pay for it.
+"""
+import io
+import logging
+import time
+from itertools import islice
+
+from songxml import song_verses
+from utils import VersePlan
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 64
+
+# One OpenLyrics converter per process, created on first use
+_open_lyrics = None
+
+
+def prepare_renderers():
+    """
+    Create the OpenLyrics converter of this process up front, e.g. in a worker initializer, so the first song is not
+    slower.
+    """
+    global _open_lyrics
+    if _open_lyrics is None:
+        from openlyricsxml import OpenLyrics
+        _open_lyrics = OpenLyrics()
+
+
+def render_openlyrics(song):
+    """
+    Render a song into a pretty printed OpenLyrics XML file.
+
+    :param song: The song to render.
+    :return: The file contents.
+    :rtype: bytes
+    """
+    from lxml import etree
+    prepare_renderers()
+    xml = _open_lyrics.song_to_xml(song)
+    tree = etree.ElementTree(etree.fromstring(xml.encode()))
+    out_file = io.BytesIO()
+    tree.write(out_file, encoding='utf-8', xml_declaration=True, pretty_print=True)
+    return out_file.getvalue()
+
+
+def text_title(title):
+    """
+    Remove text in parens from titles. SongShow doesn't display text in parenthesis, but other apps do, so this should
+    not be present in the text export.
+    """
+    paren_start_idx = title.find('(')
+    if paren_start_idx > 0:
+        return title[0:paren_start_idx]
+    return title
+
+
+def _value(value, default_value=''):
+    if not value:
+        return default_value
+    return value
+
+
+def render_text(song):
+    """
+    Render a song into a plain text file, in a format based on MediaShout 6.x.
+
+    :param song: The song to render.
+    :return: The file contents.
+    :rtype: bytes
+    """
+    verse_list = song_verses(song.lyrics)
+    if song.verse_plan is None:
+        song.verse_plan = VersePlan.from_verse_list(verse_list, song.verse_order)
+    verse_plan = song.verse_plan
+
+    # Render the whole song into one buffer, so it is written with a single call
+    song_text = [
+        'Title: {value}\n'.format(value=song.title),
+        'Author: {value}\n'.format(value=', '.join(song.authors)),
+        'Copyright: {value}\n'.format(value=_value(song.copyright)),
+        'CCLI: {value}\n'.format(value=_value(song.ccli_number)),
+        'Hymnal: {value}\n'.format(value=_value(song.song_number)),
+        'Groups: {value}\n'.format(value=_value(song.song_book_name, 'None'))
+    ]
+
+    if len(verse_plan.play_order) > 0:
+        song_text.append('PlayOrder: {value}\n'.format(value=', '.join(verse_plan.play_order)))
+
+    song_text.append('\n')
+
+    # Print lyrics. Duplicate verse tags carry a suffix letter in the plan's names
+    for verse, verse_name in zip(verse_list, verse_plan.names):
+        song_text.append(verse_name + '\n')
+        # Lyrics already have newlines chars included
+        song_text.append(verse[1])
+        song_text.append('\n\n')
+
+    return ''.join(song_text).encode('utf-8')
+
+
+def render_with(render_and_song):
+    """
+    Render a ``(render, song)`` pair. Passed to :func:`export_parallel` with such pairs in place of the songs, it
+    renders every song with its own function, e.g. to export songs in several formats in one pass.
+    """
+    render, song = render_and_song
+    return render(song)
+
+
+def _render_chunk(render, chunk):
+    """
+    Render a chunk of ``(filename, song)`` pairs and return ``(filename, data, seconds)`` tuples, with the time it took
+    to render each file.
+    """
+    rendered = []
+    for filename, song in chunk:
+        started = time.perf_counter()
+        data = render(song)
+        rendered.append((filename, data, time.perf_counter() - started))
+    return rendered
+
+
+def _write_chunk(render, writer, chunk):
+    """
+    Render a chunk of ``(filename, song)`` pairs and write the files from within the worker. Returns
+    ``(filename, seconds, size)`` tuples, with the time it took to render and write each file.
+    """
+    written = []
+    for filename, song in chunk:
+        started = time.perf_counter()
+        data = render(song)
+        writer.write(filename, data)
+        written.append((filename, time.perf_counter() - started, len(data)))
+    writer.close()
+    return written
+
+
+def export_parallel(named_songs, render, writer, processes, chunk_size=DEFAULT_CHUNK_SIZE, timed=None):
+    """
+    Render and write songs in a pool of worker processes.
+
+    If the writer can be used from several processes at once (``writer.process_safe``), every worker writes its own
+    files. Otherwise, e.g. for a bundle or an atomic writer which syncs in batches, the workers only render and the
+    files are written by the calling process in song order.
+
+    :param named_songs: An iterable of ``(filename, song)`` pairs. It is consumed lazily, so it may be fed by a
+        pipeline.
+    :param render: A module level function which turns a song into the file contents, e.g. :func:`render_openlyrics`.
+    :param writer: The :class:`songwriters.SongWriter` to write to.
+    :param int processes: The number of worker processes.
+    :param int chunk_size: The number of songs handed to a worker at once.
+    :param timed: Called with the name, the time to render and write, and the size of every file, e.g. for a
+        :class:`runreport.RunReport`. The time does not include waiting for a worker.
+    """
+    named_songs = iter(named_songs)
+    # Only loaded here, it is not needed for a serial export
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = []
+        while True:
+            chunk = list(islice(named_songs, chunk_size))
+            if chunk:
+                if writer.process_safe:
+                    pending.append(executor.submit(_write_chunk, render, writer, chunk))
+                else:
+                    pending.append(executor.submit(_render_chunk, render, chunk))
+            # Only keep a few chunks per worker in flight, so the songs waiting for a worker stay bounded
+            while pending and (not chunk or len(pending) >= processes * 2):
+                result = pending.pop(0).result()
+                if writer.process_safe:
+                    if timed:
+                        for filename, seconds, size in result:
+                            timed(filename, seconds, size)
+                    continue
+                for filename, data, seconds in result:
+                    started = time.perf_counter()
+                    writer.write(filename, data)
+                    if timed:
+                        timed(filename, seconds + time.perf_counter() - started, len(data))
+            if not chunk:
+                break
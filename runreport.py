@@ -0,0 +1,180 @@
+"""
+The :mod:`runreport` module collects statistics about a conversion run and writes them as a JSON report.
+
+The report contains the throughput of the import and export stages, histograms of the time spent per file, the
+slowest files with their sizes and block counts, the failures grouped by reason, and the number of bytes read and
+written. It is meant to size batch windows and to find pathological input files.
+"""
+import bisect
+import heapq
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds. The last bucket holds everything slower.
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0]
+DEFAULT_SLOWEST_COUNT = 10
+
+
+class StageStats(object):
+    """
+    The statistics of one stage: count, wall time, latency histogram and slowest items.
+    """
+
+    def __init__(self, slowest_count=DEFAULT_SLOWEST_COUNT):
+        self.count = 0
+        self.started = None
+        self.finished = None
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.slowest_count = slowest_count
+        self.slowest = []
+
+    def add(self, seconds, details):
+        """
+        Record one item which took ``seconds`` to process.
+
+        :param dict details: Stored with the item if it is among the slowest.
+        """
+        now = time.time()
+        if self.started is None:
+            self.started = now - seconds
+        self.finished = now
+        self.count += 1
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        entry = (seconds, self.count, details)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def to_dict(self):
+        wall_time = (self.finished - self.started) if self.count else 0.0
+        labels = ['<{ms:g}ms'.format(ms=bound * 1000) for bound in LATENCY_BUCKETS]
+        labels.append('>={ms:g}ms'.format(ms=LATENCY_BUCKETS[-1] * 1000))
+        slowest = []
+        for seconds, number, details in sorted(self.slowest, reverse=True):
+            item = dict(details)
+            item['seconds'] = round(seconds, 6)
+            slowest.append(item)
+        return {
+            'count': self.count,
+            'wall_time': round(wall_time, 3),
+            'per_second': round(self.count / wall_time, 1) if wall_time else None,
+            'latency_histogram': dict(zip(labels, self.histogram)),
+            'slowest': slowest
+        }
+
+
+class RunReport(object):
+    """
+    Collects the statistics of a run. The import and export stages may report from different threads.
+    """
+
+    def __init__(self, slowest_count=DEFAULT_SLOWEST_COUNT):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.parse = StageStats(slowest_count)
+        self.export = StageStats(slowest_count)
+        self.failures = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def file_imported(self, file_path, seconds, size, blocks):
+        """
+        Record a parsed source file.
+
+        :param file_path: The source file.
+        :param float seconds: The time spent reading and parsing it.
+        :param int size: The number of bytes read.
+        :param int blocks: The number of blocks in the file.
+        """
+        with self.lock:
+            self.bytes_read += size
+            self.parse.add(seconds, {'file': str(file_path), 'size': size, 'blocks': blocks})
+
+    def file_failed(self, failure):
+        """
+        Record a file which could not be imported.
+
+        :param failure: A :class:`songimport.ImportFailure`.
+        """
+        with self.lock:
+            failures = self.failures.setdefault(failure.category, [])
+            failures.append(failure.to_dict())
+
+    def file_exported(self, source, filename, seconds, size):
+        """
+        Record an output file.
+
+        :param source: The source file of the song.
+        :param str filename: The output file, relative to the export directory.
+        :param float seconds: The time spent rendering and writing it.
+        :param int size: The number of bytes written.
+        """
+        with self.lock:
+            self.bytes_written += size
+            self.export.add(seconds, {'file': str(source), 'output': filename, 'size': size})
+
+    def file_written(self, size):
+        """
+        Record a file written besides the song files, e.g. an OpenLP database or a search index.
+
+        :param int size: The number of bytes written.
+        """
+        with self.lock:
+            self.bytes_written += size
+
+    def timed(self, songs):
+        """
+        Pass the songs of an iterable on to an exporter, recording how long the exporter spends on each of them. Only
+        for the exporters which do not write a file per song, the others record every file with :meth:`file_exported`.
+        """
+        for song in songs:
+            started = time.time()
+            yield song
+            with self.lock:
+                self.export.add(time.time() - started, {'file': str(song.source_path)})
+
+    def to_dict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_time': round(time.time() - self.started, 3),
+            'import': self.parse.to_dict(),
+            'export': self.export.to_dict(),
+            'failures': {category: {'count': len(failures), 'files': failures}
+                         for category, failures in sorted(self.failures.items())},
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written
+        }
+
+    def write(self, report_path):
+        """
+        Write the report as JSON and return it.
+        """
+        report = self.to_dict()
+        with open(str(report_path), 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+        return report
+
+
+def print_summary(report):
+    """
+    Print a short summary of a report, as returned by :meth:`RunReport.write`.
+    """
+    print()
+    print('Run finished in {seconds:.1f}s'.format(seconds=report['wall_time']))
+    for stage in ('import', 'export'):
+        stats = report[stage]
+        print('  {stage}: {count} files, {rate} files/s'.format(stage=stage.capitalize(), count=stats['count'],
+                                                               rate=stats['per_second'] or '-'))
+    print('  Read {read:,} bytes, wrote {written:,} bytes'.format(read=report['bytes_read'],
+                                                                written=report['bytes_written']))
+    for category, failures in report['failures'].items():
+        print('  Failed ({category}): {count}'.format(category=category, count=failures['count']))
+    if report['import']['slowest']:
+        print('  Slowest files:')
+        for item in report['import']['slowest'][:5]:
+            print('    {seconds:.3f}s  {size:,} bytes  {blocks} blocks  {file}'.format(**item))
@@ -0,0 +1,167 @@
+"""
+The :mod:`shardlayout` module spreads the exported files over subdirectories of the export directory.
+
+Tens of thousands of files in one directory make listing, syncing and copying it slow on many filesystems. A
+:class:`ShardedLayout` puts every song in a subdirectory chosen by one of these schemes:
+
+* ``hash``: the first two hex digits of a hash of the song's source file name, so the songs are spread evenly over up
+  to 256 directories, e.g. ``3f/Amazing Grace (John Newton).txt``,
+* ``book``: the song book, e.g. ``Hymns/Hymns - Amazing Grace (John Newton).txt``, with ``_no_book`` for songs
+  without one,
+* ``letter``: the first letter or digit of the title, e.g. ``A/Amazing Grace (John Newton).txt``, with ``#`` for
+  titles starting with anything else.
+
+No directory gets more than ``max_entries`` files. Once it is full, the next songs go to ``A-2``, ``A-3`` and so on.
+
+Since a song's file can no longer be found from its title alone, a :class:`Manifest` at the top of the export
+directory maps each song to the path of its file.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from filenames import clean_filename
+from songwriters import TEMP_SUFFIX
+
+log = logging.getLogger(__name__)
+
+SHARD_SCHEMES = ('hash', 'book', 'letter')
+DEFAULT_MAX_ENTRIES = 1000
+MANIFEST_NAME = 'manifest.json'
+
+
+def source_identity(source, import_dir=None):
+    """
+    Returns the name a source file is known by in the manifest: its path relative to ``import_dir``, with ``/`` as
+    separator, so files of the same name in different subfolders are told apart. Without ``import_dir``, the name of
+    the file.
+    """
+    if import_dir is None:
+        return os.path.basename(str(source))
+    return os.path.relpath(str(source), str(import_dir)).replace(os.sep, '/')
+
+
+def song_identity(song, import_dir=None):
+    """
+    Returns the name a song is known by in the manifest: that of its source file, see :func:`source_identity`, or its
+    title if it has none.
+    """
+    if song.source_path is not None:
+        return source_identity(song.source_path, import_dir)
+    return song.title
+
+
+class ShardedLayout(object):
+    """
+    Chooses the subdirectory of the export directory for each song.
+    """
+
+    def __init__(self, scheme='hash', max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param str scheme: ``hash``, ``book`` or ``letter``.
+        :param int max_entries: The maximum number of files in one directory.
+        """
+        if scheme not in SHARD_SCHEMES:
+            raise ValueError('Unknown shard layout {scheme}, expected one of {schemes}'.format(
+                scheme=scheme, schemes=', '.join(SHARD_SCHEMES)))
+        self.scheme = scheme
+        self.max_entries = max_entries
+
+    def shard(self, song):
+        """
+        Returns the name of the directory a song belongs in, before directories which are full are taken into account.
+        """
+        if self.scheme == 'hash':
+            return hashlib.blake2b(song_identity(song).encode('utf-8'), digest_size=8).hexdigest()[:2]
+        if self.scheme == 'book':
+            book = clean_filename(song.song_book_name or '').strip(' .')
+            return book or '_no_book'
+        for character in song.title or '':
+            if character.isalnum():
+                return character.upper()
+        return '#'
+
+    def directory(self, song, names, parent=''):
+        """
+        Returns the directory to put the next file of a song in.
+
+        :param song: The song.
+        :param names: The :class:`filenames.FilenameIndex` of the export, which counts the files of each directory.
+        :param str parent: The directory the shards are in, relative to the export directory.
+        """
+        prefix = parent + '/' if parent else ''
+        shard = directory = self.shard(song)
+        number = 1
+        while names.count(prefix + directory) >= self.max_entries:
+            number += 1
+            directory = '{shard}-{number}'.format(shard=shard, number=number)
+        return directory
+
+
+class Manifest(object):
+    """
+    The ``manifest.json`` of a sharded export, which maps the identity of every song to the path of its file::
+
+        {"layout": "letter", "max_entries": 1000,
+         "songs": {"Hymns/amazing.sbsong": {"path": "A/Amazing Grace (John Newton).txt", "title": "Amazing Grace",
+                                      "ccli_number": "22025"}}}
+
+    A song exported in several output modes has ``paths``, the path for each mode, in place of ``path``. The entries of
+    an existing manifest are kept, so a resumed or repeated run adds to it.
+    """
+
+    def __init__(self, export_dir, layout, import_dir=None):
+        """
+        :param export_dir: The export directory, which the manifest is written to.
+        :param layout: The :class:`ShardedLayout` of the export.
+        :param import_dir: The import directory, the songs are known by their paths relative to it.
+        """
+        self.export_dir = str(export_dir)
+        self.import_dir = import_dir
+        self.path = os.path.join(self.export_dir, MANIFEST_NAME)
+        self.layout = layout
+        self.songs = {}
+        try:
+            with open(self.path, encoding='utf-8') as manifest_file:
+                self.songs = json.load(manifest_file).get('songs', {})
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError):
+            log.warning('Ignoring the damaged manifest {path}'.format(path=self.path))
+
+    def add(self, song, path):
+        """
+        Record the file a song was written to.
+
+        :param song: The song.
+        :param path: The path of the file, relative to the export directory. When a song is exported in several output
+            modes, a dictionary of the path for each mode, which is written as ``paths``.
+        """
+        entry = {'title': song.title, 'ccli_number': song.ccli_number}
+        if isinstance(path, dict):
+            entry['paths'] = path
+        else:
+            entry['path'] = path
+        self.songs[song_identity(song, self.import_dir)] = entry
+
+    def discard(self, source):
+        """
+        Forget the song of a source file, e.g. after it has been deleted.
+        """
+        self.songs.pop(source_identity(source, self.import_dir), None)
+
+    def write(self):
+        """
+        Write the manifest, leaving out the songs whose files no longer exist.
+        """
+        songs = {}
+        for identity, entry in sorted(self.songs.items()):
+            paths = entry['paths'].values() if 'paths' in entry else [entry['path']]
+            if any(os.path.isfile(os.path.join(self.export_dir, path)) for path in paths):
+                songs[identity] = entry
+        temp_path = self.path + TEMP_SUFFIX
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'layout': self.layout.scheme, 'max_entries': self.layout.max_entries, 'songs': songs},
+                      manifest_file, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
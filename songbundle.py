@@ -0,0 +1,124 @@
+"""
+The :mod:`songbundle` module streams exported songs into a single archive instead of writing one small file per song.
+
+The archive is a plain tar stream, optionally compressed on the fly. Next to it an index is written which maps every
+member name to the offset of its header and data inside the (uncompressed) tar stream, so consumers can seek straight
+to a song in an uncompressed bundle without walking the archive.
+"""
+import io
+import json
+import logging
+import tarfile
+import time
+
+from songwriters import SongWriter
+
+log = logging.getLogger(__name__)
+
+BUNDLE_FORMATS = {
+    'tar': 'w|',
+    'tar.gz': 'w|gz',
+    'tar.bz2': 'w|bz2',
+    'tar.xz': 'w|xz'
+}
+
+
+class SongBundle(SongWriter):
+    """
+    Sequentially writes exported songs into a single tar archive.
+
+    Members are written in the order they are added and nothing is held in memory apart from the index, so a library
+    of any size is exported as one sequential write.
+    """
+
+    def __init__(self, bundle_path, bundle_format='tar'):
+        """
+        Open the bundle for writing.
+
+        :param bundle_path: The path of the archive to create.
+        :param bundle_format: One of the keys of ``BUNDLE_FORMATS``.
+        """
+        if bundle_format not in BUNDLE_FORMATS:
+            raise ValueError('Unknown bundle format "{format}"'.format(format=bundle_format))
+        self.bundle_path = bundle_path
+        self.bundle_format = bundle_format
+        self.index = []
+        self.names = set()
+        self.mtime = time.time()
+        self.bundle_file = open(str(bundle_path), 'wb')
+        self.tar = tarfile.open(fileobj=self.bundle_file, mode=BUNDLE_FORMATS[bundle_format], format=tarfile.PAX_FORMAT,
+                                encoding='utf-8')
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def write(self, name, data):
+        """
+        Append a member to the archive.
+
+        :param str name: The member name, i.e. the file name the song would have had on disk.
+        :param bytes data: The encoded file contents.
+        """
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = len(data)
+        tar_info.mtime = self.mtime
+        header_offset = self.tar.offset
+        self.tar.addfile(tar_info, io.BytesIO(data))
+        # The data is padded to the tar block size, so the payload starts that far before the current offset.
+        blocks, remainder = divmod(tar_info.size, tarfile.BLOCKSIZE)
+        if remainder:
+            blocks += 1
+        data_offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+        self.index.append({'name': name, 'offset': header_offset, 'data_offset': data_offset, 'size': tar_info.size})
+        self.names.add(name)
+
+    def close(self):
+        """
+        Finish the archive and write the member index next to it.
+        """
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.bundle_file.close()
+        self.tar = None
+        with open(index_path(self.bundle_path), 'w', encoding='utf-8') as index_file:
+            json.dump({'format': self.bundle_format, 'members': self.index}, index_file, ensure_ascii=False, indent=1)
+        log.info('wrote {count} songs to {path}'.format(count=len(self.index), path=self.bundle_path))
+
+
+def index_path(bundle_path):
+    """
+    Returns the path of the index file belonging to ``bundle_path``.
+    """
+    return '{path}.index.json'.format(path=bundle_path)
+
+
+def load_index(bundle_path):
+    """
+    Load the member index of a bundle.
+
+    :param bundle_path: The path of the archive.
+    :return: A dictionary mapping member names to their index entries.
+    """
+    with open(index_path(bundle_path), encoding='utf-8') as index_file:
+        index = json.load(index_file)
+    return {member['name']: member for member in index['members']}
+
+
+def read_member(bundle_path, name):
+    """
+    Read a single member from an uncompressed bundle using its index, without scanning the archive.
+
+    :param bundle_path: The path of the archive.
+    :param str name: The member name.
+    :return: The member's contents.
+    :rtype: bytes
+    """
+    with open(index_path(bundle_path), encoding='utf-8') as index_file:
+        index = json.load(index_file)
+    if index['format'] != 'tar':
+        raise ValueError('Members can only be read directly from uncompressed bundles')
+    member = {member['name']: member for member in index['members']}[name]
+    with open(str(bundle_path), 'rb') as bundle_file:
+        bundle_file.seek(member['data_offset'])
+        return bundle_file.read(member['size'])
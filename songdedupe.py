@@ -0,0 +1,293 @@
+"""
+The :mod:`songdedupe` module finds exact and near-duplicate songs in a library.
+
+Every song's lyrics are normalized, split into overlapping word shingles and summarized by a MinHash signature. The
+signatures are computed with one-permutation hashing: each shingle is hashed once and only the smallest hash per bin
+is kept, so building a signature is linear in the length of the lyrics. Locality-sensitive hashing then buckets the
+signatures band by band; only songs sharing a bucket are compared, which keeps the whole search roughly linear in the
+number of songs instead of comparing every pair.
+
+Two songs are duplicates if the Jaccard similarity of their shingles reaches ``threshold``, or if most of the shorter
+song's shingles are also in the longer one, its containment. The second catches medleys and partial copies: a medley
+of songs A and B shares only about half of its shingles with A alone, but contains nearly all of A.
+"""
+import hashlib
+import logging
+
+from songxml import SongXML
+from utils import clean_string
+
+log = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_CONTAINMENT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 64
+# Two rows per band, so pairs with a similarity of 0.3 to 0.5, such as a medley and one of its songs, are still
+# compared
+DEFAULT_BANDS = 32
+DEFAULT_SHINGLE_SIZE = 3
+# Shorter lyrics, e.g. a common two line tag, are only compared by similarity, not by containment
+MIN_CONTAINED_SHINGLES = 12
+# Buckets larger than this are not expanded into pairs, they only hold very common, e.g. very short, lyrics
+MAX_BUCKET_SIZE = 1000
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class DuplicateCluster(object):
+    """
+    A group of songs which are duplicates of each other.
+
+    ``titles`` holds the titles of the songs in the order they were added and ``indexes`` their positions in that
+    order, ``exact`` tells whether all of them have identical (normalized) lyrics, ``similarity`` is the lowest
+    estimated similarity of a linked pair and ``contained`` whether a pair was only linked because one contains the
+    other. Only the titles are kept, not the songs, so finding duplicates does not hold the whole library in memory.
+    ``duplicates`` holds the indexes of the songs which are exact or near duplicates of an earlier song of the cluster,
+    not just contained in one or containing one.
+    """
+
+    def __init__(self, titles, exact, similarity, indexes=None, contained=False, duplicates=None):
+        self.titles = titles
+        self.exact = exact
+        self.similarity = similarity
+        self.indexes = indexes if indexes is not None else list(range(len(titles)))
+        self.contained = contained
+        self.duplicates = duplicates if duplicates is not None else self.indexes[1:]
+
+    def __repr__(self):
+        return 'DuplicateCluster({titles!r}, exact={exact}, similarity={similarity:.2f})'.format(
+            titles=self.titles, exact=self.exact, similarity=self.similarity)
+
+
+class DuplicateFinder(object):
+    """
+    Collects songs and groups them into clusters of exact and near duplicates.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, bands=DEFAULT_BANDS,
+                 shingle_size=DEFAULT_SHINGLE_SIZE, containment_threshold=DEFAULT_CONTAINMENT_THRESHOLD):
+        """
+        :param float threshold: The estimated Jaccard similarity of the lyrics above which two songs are duplicates.
+        :param int num_perm: The length of the MinHash signatures.
+        :param int bands: The number of LSH bands. ``num_perm`` must be a multiple of it. More bands find more
+            candidates with a lower similarity, which are then checked against ``threshold``.
+        :param int shingle_size: The number of words per shingle.
+        :param float containment_threshold: The estimated share of the shingles of the shorter song which are also in
+            the longer one, above which two songs are duplicates.
+        """
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.threshold = threshold
+        self.containment_threshold = containment_threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.sxml = SongXML()
+        self.titles = []
+        self.signatures = []
+        self.content_hashes = []
+        self.shingle_counts = []
+        self.buckets = {}
+
+    def words(self, song):
+        """
+        Returns the words of a song's lyrics, normalized for comparison.
+        """
+        words = []
+        for verse in self.sxml.get_verses(song.lyrics):
+            words.extend(clean_string(verse[1]).split())
+        return words
+
+    def shingles(self, words):
+        """
+        Returns the set of word shingles of a list of words.
+        """
+        if len(words) < self.shingle_size:
+            return {' '.join(words)} if words else set()
+        size = self.shingle_size
+        return {' '.join(words[index:index + size]) for index in range(len(words) - size + 1)}
+
+    def signature(self, shingles):
+        """
+        Build the one-permutation MinHash signature of a set of shingles.
+        """
+        bins = [None] * self.num_perm
+        for shingle in shingles:
+            value, position = divmod(_hash(shingle), self.num_perm)
+            if bins[position] is None or value < bins[position]:
+                bins[position] = value
+        # Fill empty bins from the next non-empty bin to the right, marking how far it was borrowed from, so that
+        # similar sets still end up with equal values in the same positions.
+        if not shingles:
+            return None
+        signature = list(bins)
+        for index in range(self.num_perm):
+            if signature[index] is None:
+                distance = 1
+                while bins[(index + distance) % self.num_perm] is None:
+                    distance += 1
+                signature[index] = (distance << 64) | bins[(index + distance) % self.num_perm]
+        return signature
+
+    def add(self, song):
+        """
+        Add a song to the search.
+
+        :return: The song's index, as used in :meth:`clusters`.
+        """
+        index = len(self.titles)
+        words = self.words(song)
+        shingles = self.shingles(words)
+        signature = self.signature(shingles)
+        self.titles.append(song.title)
+        self.signatures.append(signature)
+        self.content_hashes.append(_hash(' '.join(words)))
+        self.shingle_counts.append(len(shingles))
+        if signature is not None:
+            for band in range(self.bands):
+                key = (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+                self.buckets.setdefault(key, []).append(index)
+        return index
+
+    def scan(self, songs):
+        """
+        Add every song of an iterable while passing it on, so duplicates can be found during an export.
+        """
+        for song in songs:
+            self.add(song)
+            yield song
+
+    def similarity(self, first, second):
+        """
+        Estimate the Jaccard similarity of the lyrics of two added songs.
+        """
+        first_signature = self.signatures[first]
+        second_signature = self.signatures[second]
+        return sum(1 for a, b in zip(first_signature, second_signature) if a == b) / self.num_perm
+
+    def containment(self, first, second, similarity=None):
+        """
+        Estimate the share of the shingles of the shorter of two added songs which are also in the longer one, from
+        their similarity and their numbers of shingles.
+        """
+        if similarity is None:
+            similarity = self.similarity(first, second)
+        first_count, second_count = self.shingle_counts[first], self.shingle_counts[second]
+        if min(first_count, second_count) < MIN_CONTAINED_SHINGLES:
+            return 0.0
+        # |A & B| = J * (|A| + |B|) / (1 + J)
+        common = similarity * (first_count + second_count) / (1 + similarity)
+        return min(1.0, common / min(first_count, second_count))
+
+    def clusters(self):
+        """
+        Group the added songs into duplicate clusters.
+
+        :return: A list of :class:`DuplicateCluster`, each with at least two songs, in the order of their first song.
+        """
+        parent = list(range(len(self.titles)))
+        # The same for the pairs linked by their similarity only, which can be collapsed
+        similar_parent = list(range(len(self.titles)))
+        lowest = {}
+        contained = set()
+
+        def find(index, parent=parent):
+            while parent[index] != index:
+                parent[index] = parent[parent[index]]
+                index = parent[index]
+            return index
+
+        def union(first, second, parent=parent):
+            first_root, second_root = find(first, parent), find(second, parent)
+            if first_root != second_root:
+                parent[max(first_root, second_root)] = min(first_root, second_root)
+
+        checked = set()
+        for members in self.buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) > MAX_BUCKET_SIZE:
+                log.warning('Skipping a bucket of {count} songs with near identical lyrics'.format(count=len(members)))
+                continue
+            for position, first in enumerate(members):
+                for second in members[position + 1:]:
+                    if (first, second) in checked:
+                        continue
+                    checked.add((first, second))
+                    similarity = self.similarity(first, second)
+                    by_containment = False
+                    if similarity < self.threshold:
+                        if self.containment(first, second, similarity) < self.containment_threshold:
+                            continue
+                        by_containment = True
+                    if not by_containment:
+                        union(first, second, similar_parent)
+                    first_root, second_root = find(first), find(second)
+                    union(first, second)
+                    lowest[find(first)] = min(similarity, lowest.get(first_root, 1.0), lowest.get(second_root, 1.0))
+                    if by_containment or first_root in contained or second_root in contained:
+                        contained.add(find(first))
+        groups = {}
+        for index in range(len(self.titles)):
+            groups.setdefault(find(index), []).append(index)
+        clusters = []
+        for root in sorted(groups):
+            members = groups[root]
+            if len(members) < 2:
+                continue
+            exact = len(set(self.content_hashes[index] for index in members)) == 1
+            duplicates = [index for index in members if find(index, similar_parent) != index]
+            clusters.append(DuplicateCluster([self.titles[index] for index in members], exact, lowest.get(root, 1.0),
+                                             members, root in contained, duplicates))
+        return clusters
+
+
+def find_duplicates(songs, threshold=DEFAULT_THRESHOLD, containment_threshold=DEFAULT_CONTAINMENT_THRESHOLD):
+    """
+    Find the duplicate clusters in a list of songs.
+
+    :param songs: An iterable of songs.
+    :param float threshold: See :class:`DuplicateFinder`.
+    :param float containment_threshold: See :class:`DuplicateFinder`.
+    :return: A list of :class:`DuplicateCluster`.
+    """
+    finder = DuplicateFinder(threshold, containment_threshold=containment_threshold)
+    for song in songs:
+        finder.add(song)
+    return finder.clusters()
+
+
+def collapse_duplicates(songs, clusters):
+    """
+    Remove all but the first song of every group of exact or near duplicates. Partial duplicates are kept, since
+    neither song of a medley and one of its songs has all the lyrics of the other, but copies of either are removed.
+
+    :param songs: The songs the clusters were built from, in the same order. They are matched by position, so they
+        can be read again from a :class:`songstore.SpillingSongStore`, which returns new copies every time.
+    :param clusters: The clusters returned by :func:`find_duplicates`.
+    :return: An iterator of the songs to keep, in their original order.
+    """
+    dropped = set()
+    for cluster in clusters:
+        dropped.update(cluster.duplicates)
+    return (song for index, song in enumerate(songs) if index not in dropped)
+
+
+def print_duplicates(clusters):
+    """
+    Print a report of the duplicate clusters.
+    """
+    for cluster in clusters:
+        if cluster.exact:
+            kind = 'Exact duplicates'
+        elif cluster.contained:
+            kind = 'Partial duplicates, e.g. a medley and one of its songs ({similarity:.0%} similar)'.format(
+                similarity=cluster.similarity)
+        else:
+            kind = 'Near duplicates ({similarity:.0%} similar)'.format(similarity=cluster.similarity)
+        print('{kind}:'.format(kind=kind))
+        for title in cluster.titles:
+            print('    {title}'.format(title=title))
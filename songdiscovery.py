@@ -0,0 +1,112 @@
+"""
+The :mod:`songdiscovery` module finds the song files to convert.
+
+A :class:`SongDiscovery` walks the import directory with :func:`os.scandir` and, with ``recursive``, its subfolders,
+which is where SongShow Plus installations spread over several shares tend to keep their songs. The paths are handed
+out while the walk is still going, so the import starts with the first folder instead of after the last one::
+
+    for song_path in SongDiscovery('../Songs', include=['*.sbsong'], exclude=['Archive', '*.bak*']):
+        ...
+
+``include`` patterns are matched against file names, ``exclude`` patterns against the names of files and folders
+and against their paths relative to the import directory, e.g. ``Old/*``. An excluded folder is not entered at all.
+With ``sort``, the entries of every folder are sorted by name and the folders are walked depth first, so the order is
+the same on every run and for a flat folder matches ``sorted(os.listdir())``, while the walk still streams folder by
+folder.
+"""
+import fnmatch
+import logging
+import os
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INCLUDE = ('*.sbsong',)
+
+
+class SongDiscovery(object):
+    """
+    The song files in a directory, found while they are being iterated.
+    """
+
+    def __init__(self, import_dir, include=DEFAULT_INCLUDE, exclude=(), recursive=False, sort=True, stats=False):
+        """
+        :param import_dir: The directory to search.
+        :param include: The patterns of the file names to convert.
+        :param exclude: The patterns of the files and folders to skip, matched against their names and their paths
+            relative to ``import_dir``.
+        :param bool recursive: Also search the subfolders.
+        :param bool sort: Hand out the files of every folder sorted by name, so the order does not depend on the
+            filesystem.
+        :param bool stats: Keep the modification time and size of every file found, in :attr:`stats`.
+        """
+        self.import_dir = str(import_dir)
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.recursive = recursive
+        self.sort = sort
+        self.keep_stats = stats
+        # (modification time in ns, size) by path, of the files found by the last walk, with stats
+        self.stats = {}
+
+    def _excluded(self, name, relative_path):
+        return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern)
+                   for pattern in self.exclude)
+
+    def matches(self, path):
+        """
+        Returns whether a path below the import directory is one of the song files, e.g. for a file which has just
+        been created. Folders are not checked for existence.
+        """
+        relative_path = os.path.relpath(str(path), self.import_dir).replace(os.sep, '/')
+        if relative_path.startswith('../') or (not self.recursive and '/' in relative_path):
+            return False
+        parts = relative_path.split('/')
+        for depth in range(1, len(parts) + 1):
+            if self._excluded(parts[depth - 1], '/'.join(parts[:depth])):
+                return False
+        return any(fnmatch.fnmatch(parts[-1], pattern) for pattern in self.include)
+
+    def __iter__(self):
+        """
+        Walk the import directory and return the paths of the song files as :class:`~pathlib.Path` objects.
+        """
+        self.stats = {}
+        return self._walk(self.import_dir, '')
+
+    def _walk(self, directory, relative_dir):
+        try:
+            with os.scandir(directory) as scan:
+                entries = list(scan) if self.sort else scan
+                if self.sort:
+                    entries.sort(key=lambda entry: entry.name)
+                for entry in self._entries(entries, relative_dir):
+                    yield entry
+        except OSError as error:
+            if not relative_dir:
+                raise
+            # An unreadable subfolder, e.g. on a share which went away, must not end the whole conversion
+            log.warning('Cannot read {path}: {error}'.format(path=directory, error=error))
+
+    def _entries(self, entries, relative_dir):
+        for entry in entries:
+            relative_path = relative_dir + '/' + entry.name if relative_dir else entry.name
+            if self.exclude and self._excluded(entry.name, relative_path):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                song_file = (not is_dir and any(fnmatch.fnmatch(entry.name, pattern) for pattern in self.include)
+                             and entry.is_file())
+                if song_file and self.keep_stats:
+                    # Cached by scandir on Windows, a single stat call elsewhere
+                    stat = entry.stat()
+                    self.stats[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError as error:
+                # E.g. a file deleted since the folder was listed, which must not end the walk
+                log.debug('Skipping {path}: {error}'.format(path=entry.path, error=error))
+                continue
+            if is_dir:
+                if self.recursive:
+                    yield from self._walk(entry.path, relative_path)
+            elif song_file:
+                yield Path(entry.path)
@@ -0,0 +1,536 @@
+"""
+The :mod:`songfuzz` module compares two versions of the importer and exporters on randomized song files.
+
+Faster parsing and export code is only safe to use if it gives exactly the same results as the code it replaces. This
+harness keeps a frozen copy of the converter as the reference, feeds the reference and the current code the same
+generated ``.sbsong`` files, and compares, for every file, the fields of the imported songs, the import failures and
+the exported OpenLyrics and text files byte for byte.
+
+The inputs are generated from a seed, so every run, and every mismatch, can be reproduced:
+
+* well formed songs with random titles, authors, verses, custom verses, verse orders and unknown blocks, using every
+  kind of length descriptor, with text full of formatting tags, XML special characters and non-ASCII characters,
+* mutations of these or of real song files: truncated files, flipped bytes, odd or lying length descriptors, block
+  offsets pointing anywhere, inserted, removed and repeated bytes.
+
+Both versions run in their own pool of worker processes, which each import one version of the modules. Freeze the
+current code once, before changing it, then compare as often as needed::
+
+    python ./songfuzz.py freeze ../songs_reference
+    python ./songfuzz.py run ../songs_reference --cases 1000000 --corpus ../Songs --failures ../fuzz_failures
+
+For every mismatch, the input file and a diff of the results are written to the ``--failures`` directory. A
+reference older than the current code is only compared on what it produces: the search fields are left out if it
+leaves them empty, and if it does not record failed files, only whether a file failed is compared, since it raised
+an exception where the current code records the failure.
+"""
+import argparse
+import copy
+import difflib
+import hashlib
+import io
+import logging
+import os
+import pprint
+import random
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CASES = 10000
+DEFAULT_BATCH_SIZE = 200
+# Per file, for the lenient parsing mode, which can loop forever on some damaged files
+DEFAULT_CASE_SECONDS = 5
+# The song's modification time is the time the module was imported, which differs between the two versions
+LAST_MODIFIED = '2000-01-01 00:00:00'
+
+# The block keys of the SongShow Plus format, see songshowplus.SongShowPlusImport
+TITLE = 1
+AUTHOR = 2
+COPYRIGHT = 3
+CCLI_NO = 5
+VERSE = 12
+CHORUS = 20
+BRIDGE = 24
+TOPIC = 29
+COMMENTS = 30
+VERSE_ORDER = 31
+SONG_BOOK = 35
+SONG_NUMBER = 36
+CUSTOM_VERSE = 37
+TEXT_BLOCKS = (TITLE, AUTHOR, COPYRIGHT, CCLI_NO, TOPIC, COMMENTS, VERSE_ORDER, SONG_BOOK)
+# Block keys the importer does not know, which it skips using the block's offset
+UNKNOWN_BLOCKS = (4, 6, 7, 26, 40, 0xFFFF)
+
+WORDS = ['Amazing', 'grace', 'how', 'sweet', 'the', 'sound', 'Gnade', 'Ehre', 'сила', 'слава', 'Señor', 'père',
+         '&', '<b>', '"quoted"', "it's", ']]>', '{r}', '{/r}', '{st}', '{/st}', '[---]', '(live)', '/', ' / ', ', ',
+         ' ', '’', '\u0085', '\x7f', '\x01', '￾', '\U0001F600', '  ', '\t', '\r\n']
+VERSE_NAMES = ['Verse', 'Verse 2', 'verse 10', 'Chorus', 'chorus 2', 'Bridge', 'Pre-Chorus', 'pre-chorus 3', 'Tag',
+               'Ending', 'Intro 1', 'Coda 2.5', 'v1', 'c', '', ' ', '1', 'Verse x', 'Outro\n', 'Слово 1']
+# The values of the length descriptor size byte which the importer treats specially, and a few others
+DESCRIPTOR_SIZES = (0, 1, 2, 3, 9, 12, 20, 255)
+SPECIAL_NUMBERS = (0, 1, 2, 3, 4, 254, 255, 256, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF)
+
+
+class CaseTimeout(BaseException):
+    """
+    Raised when a file takes longer than the per file limit of the harness.
+    """
+    pass
+
+
+class FuzzSongFile(object):
+    """
+    A generated song file, which the importer can open like a :class:`~pathlib.Path`.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def open(self, mode='rb'):
+        return io.BytesIO(self.data)
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+
+def _text(rng, words=8):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, words)))
+
+
+def _lyrics(rng):
+    return '\n'.join(_text(rng) for _ in range(rng.randint(0, 5)))
+
+
+def _data_block(rng, key, data, prefix=b''):
+    """
+    Build a block holding ``data``, with one of the length descriptor forms the importer accepts.
+    """
+    form = rng.random()
+    if len(data) == 1 and form < 0.1:
+        body = prefix + bytes([2]) + data
+    elif not data and form < 0.1:
+        body = prefix + bytes([9])
+    elif len(data) < 256 and form < 0.7:
+        size = rng.choice([1, 3, 4, 8, 255])
+        body = prefix + bytes([size, len(data)]) + data
+    else:
+        body = prefix + bytes([rng.choice([12, 20])]) + struct.pack('I', len(data)) + data
+    return struct.pack('II', key, len(body)) + body
+
+
+def generate_song(rng):
+    """
+    Returns the contents of a well formed song file with random contents.
+    """
+    blocks = []
+    if rng.random() < 0.95:
+        blocks.append(_data_block(rng, TITLE, _text(rng, 5).encode('utf-8')))
+    for _ in range(rng.randint(0, 3)):
+        key = rng.choice(TEXT_BLOCKS)
+        if key == AUTHOR:
+            text = rng.choice([' / ', ', ', ' and ']).join(_text(rng, 3) for _ in range(rng.randint(1, 3)))
+        elif key == CCLI_NO:
+            text = rng.choice(['', 'CCLI ', '#', 'x']) + str(rng.randint(0, 10 ** rng.randint(1, 12)))
+        elif key == VERSE_ORDER:
+            text = rng.choice(VERSE_NAMES)
+        else:
+            text = _text(rng)
+        blocks.append(_data_block(rng, key, text.encode('utf-8')))
+    for _ in range(rng.randint(0, 8)):
+        kind = rng.random()
+        lyrics = _lyrics(rng).encode('utf-8')
+        if kind < 0.6:
+            blocks.append(_data_block(rng, rng.choice((VERSE, CHORUS, BRIDGE)), lyrics,
+                                      bytes([0, rng.choice([0, 1, 2, 3, 9, 10, 255])])))
+        elif kind < 0.85:
+            name = rng.choice(VERSE_NAMES).encode('utf-8')
+            blocks.append(_data_block(rng, CUSTOM_VERSE, lyrics, bytes([0, len(name)]) + name))
+        elif kind < 0.95:
+            blocks.append(_data_block(rng, VERSE_ORDER, rng.choice(VERSE_NAMES).encode('utf-8')))
+        else:
+            size = rng.choice([1, 2, 4])
+            number = rng.randint(0, 256 ** size - 1).to_bytes(size, 'little')
+            body = bytes([len(number) + 1]) + number
+            blocks.append(struct.pack('II', SONG_NUMBER, len(body)) + body)
+    for _ in range(rng.randint(0, 2)):
+        position = rng.randint(0, len(blocks))
+        data = bytes(rng.randint(0, 255) for _ in range(rng.randint(0, 40)))
+        blocks.insert(position, _data_block(rng, rng.choice(UNKNOWN_BLOCKS), data))
+    if rng.random() < 0.2:
+        rng.shuffle(blocks)
+    return b''.join(blocks) + b'\0\0\0\0'
+
+
+def mutate(rng, data):
+    """
+    Returns a damaged copy of a song file.
+    """
+    data = bytearray(data)
+    for _ in range(rng.randint(1, 4)):
+        kind = rng.random()
+        position = rng.randint(0, max(0, len(data) - 1))
+        if kind < 0.2:
+            # Truncated file
+            del data[rng.randint(0, len(data)):]
+        elif kind < 0.4 and data:
+            # Flipped bits
+            data[position] ^= 1 << rng.randint(0, 7)
+        elif kind < 0.55:
+            # A block offset or a long length descriptor with an odd value
+            data[position:position + 4] = struct.pack('I', rng.choice(SPECIAL_NUMBERS))
+        elif kind < 0.7 and data:
+            # An odd length descriptor size or short length descriptor
+            data[position] = rng.choice(DESCRIPTOR_SIZES + SPECIAL_NUMBERS[:6])
+        elif kind < 0.8:
+            data[position:position] = bytes(rng.randint(0, 255) for _ in range(rng.randint(1, 16)))
+        elif kind < 0.9:
+            del data[position:position + rng.randint(1, 16)]
+        else:
+            end = min(len(data), position + rng.randint(1, 64))
+            data[position:position] = data[position:end] * rng.randint(1, 4)
+    return bytes(data)
+
+
+def generate_case(seed, number, corpus=()):
+    """
+    Returns the contents of the song file for case ``number`` of a run with ``seed``.
+    """
+    rng = random.Random('{seed}:{number}'.format(seed=seed, number=number))
+    kind = rng.random()
+    if corpus and kind < 0.4:
+        return mutate(rng, rng.choice(corpus))
+    data = generate_song(rng)
+    if kind < 0.7:
+        return mutate(rng, data)
+    return data
+
+
+def load_corpus(corpus_dir):
+    """
+    Returns the contents of the song files in ``corpus_dir``, sorted by name, so both versions see the same corpus.
+    """
+    if not corpus_dir:
+        return ()
+    return tuple(path.read_bytes() for path in sorted(Path(corpus_dir).glob('*.sbsong')))
+
+
+def freeze(reference_dir, revision=None, source_dir=None):
+    """
+    Copy the modules of the converter to ``reference_dir``, to compare later versions with.
+
+    :param reference_dir: The directory to copy to. It must not exist yet.
+    :param str revision: A git revision to take the modules from instead of the working tree.
+    :param source_dir: The directory of the converter. Defaults to the directory of this module.
+    """
+    source_dir = Path(source_dir or os.path.dirname(os.path.abspath(__file__)))
+    reference_dir = Path(reference_dir)
+    reference_dir.mkdir(parents=True)
+    if revision is None:
+        for path in sorted(source_dir.glob('*.py')):
+            shutil.copy2(str(path), str(reference_dir / path.name))
+        return
+    names = subprocess.run(['git', 'ls-tree', '--name-only', revision], cwd=str(source_dir), check=True,
+                           stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    for name in names:
+        if name.endswith('.py'):
+            data = subprocess.run(['git', 'show', '{revision}:{name}'.format(revision=revision, name=name)],
+                                  cwd=str(source_dir), check=True, stdout=subprocess.PIPE).stdout
+            (reference_dir / name).write_bytes(data)
+
+
+# The version of the converter a worker process runs, set up by _start_engine
+_engine = None
+
+
+class Engine(object):
+    """
+    One version of the importer and exporters, imported from a directory in a worker process.
+    """
+
+    def __init__(self, engine_dir, corpus_dir=None, guarded=False, case_seconds=DEFAULT_CASE_SECONDS,
+                 options=None):
+        sys.path.insert(0, str(engine_dir))
+        # The modules must come from engine_dir, never from the other version
+        for name in ('songshowplus', 'songimport', 'songxml', 'utils', 'openlyricsxml', 'parallelexport', 'blockscan'):
+            sys.modules.pop(name, None)
+        import songimport
+        import songshowplus
+        import utils
+        from openlyricsxml import OpenLyrics
+        try:
+            from parallelexport import render_text, text_title
+        except ImportError:
+            render_text = text_title = None
+        self.songshowplus = songshowplus
+        self.song_class = utils.Song
+        # Older versions do not record the files which failed
+        self.records_failures = hasattr(songimport, 'ImportFailure')
+        self.open_lyrics = OpenLyrics()
+        self.render_text = render_text
+        self.text_title = text_title
+        self.guarded = guarded
+        self.case_seconds = case_seconds
+        self.corpus = load_corpus(corpus_dir)
+        # Further importer options, e.g. to turn on a faster code path. Older versions ignore options they do not know.
+        self.options = options or {}
+        self.importer = None
+
+    def _new_importer(self):
+        limits = self.songshowplus.ParseLimits() if self.guarded else None
+        return self.songshowplus.SongShowPlusImport(file_paths=[], store=[], limits=limits, **self.options)
+
+    def _time_limit(self):
+        """
+        Limit the time of a case in the lenient mode. The guarded mode has a limit of its own.
+        """
+        if self.guarded or not self.case_seconds:
+            return
+
+        def timeout(signum, frame):
+            raise CaseTimeout()
+
+        signal.signal(signal.SIGALRM, timeout)
+        signal.setitimer(signal.ITIMER_REAL, self.case_seconds)
+
+    def parts(self):
+        """
+        Returns what this version produces: the names of the song fields, and ``verse_plan``, ``text`` and
+        ``failures`` if it has verse plans, the text export and records failed files. Only the parts both versions
+        produce are compared.
+        """
+        fields = set(name for name, value in vars(self.song_class).items()
+                     if not name.startswith('_') and not callable(value))
+        if not self._fills_search_fields():
+            # Older versions have the fields but leave them empty
+            fields -= {'search_title', 'search_lyrics'}
+        parts = {'field:' + name for name in fields - {'verse_plan', 'last_modified'}}
+        if 'verse_plan' in fields:
+            parts.add('verse_plan')
+        if self.render_text is not None:
+            parts.add('text')
+        if self.records_failures:
+            parts.add('failures')
+        return parts
+
+    def _fills_search_fields(self):
+        importer = self._new_importer()
+        rng = random.Random(0)
+        importer.import_source = [FuzzSongFile('probe.sbsong', generate_song(rng)) for _ in range(10)]
+        importer.store = []
+        importer.do_import()
+        return any(song.search_title for song in importer.store)
+
+    def result(self, name, data, parts=None):
+        """
+        Import and export one file and return everything the two versions must agree on.
+
+        :param parts: The parts of the result to include, see :meth:`parts`. Defaults to all this version produces.
+        """
+        if parts is None:
+            parts = self.parts()
+        if self.importer is None:
+            self.importer = self._new_importer()
+        importer = self.importer
+        importer.import_source = [FuzzSongFile(name, data)]
+        importer.store = []
+        importer.failures = []
+        result = {}
+        try:
+            self._time_limit()
+            try:
+                importer.do_import()
+            finally:
+                if not self.guarded and self.case_seconds:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except CaseTimeout:
+            # Left in the middle of a file, so the importer may still hold parts of this song
+            self.importer = None
+            result['error'] = 'Timeout'
+        except Exception as error:
+            self.importer = None
+            result['error'] = '{name}: {error}'.format(name=type(error).__name__, error=error)
+        if 'failures' in parts:
+            result['failures'] = [failure.to_dict() if hasattr(failure, 'to_dict') else str(failure)
+                                  for failure in importer.failures]
+        elif 'error' in result or any(failure.category != 'Incomplete song' for failure in importer.failures):
+            # Older versions raised where newer ones record the file as failed, and left out incomplete songs
+            # silently, so only whether the file failed can be compared
+            result['error'] = 'Failed'
+        result['songs'] = [self._song_result(song, parts) for song in importer.store]
+        return result
+
+    def _song_result(self, song, parts):
+        song.last_modified = LAST_MODIFIED
+        # The fields of the Song class, so a field only one version has does not count as a mismatch
+        fields = {name: value for name, value in sorted(vars(song).items()) if 'field:' + name in parts}
+        song_result = {'fields': fields}
+        verse_plan = getattr(song, 'verse_plan', None)
+        if 'verse_plan' in parts and verse_plan is not None:
+            song_result['verse_plan'] = {name: value for name, value in sorted(vars(verse_plan).items())}
+        try:
+            song_result['xml'] = self.open_lyrics.song_to_xml(song)
+            if 'text' in parts:
+                text_song = copy.copy(song)
+                text_song.title = self.text_title(song.title)
+                song_result['text'] = self.render_text(text_song)
+        except Exception as error:
+            song_result['export_error'] = '{name}: {error}'.format(name=type(error).__name__, error=error)
+        return song_result
+
+
+def _start_engine(engine_dir, corpus_dir, guarded, case_seconds, options):
+    global _engine
+    logging.disable(logging.CRITICAL)
+    # The importer prints every file name
+    sys.stdout = open(os.devnull, 'w')
+    _engine = Engine(engine_dir, corpus_dir, guarded, case_seconds, options)
+
+
+def _case_name(seed, number):
+    return 'case-{seed}-{number}.sbsong'.format(seed=seed, number=number)
+
+
+def engine_parts():
+    """
+    Returns the parts of the results of the version a worker process runs, see :meth:`Engine.parts`.
+    """
+    return _engine.parts()
+
+
+def run_batch(seed, start, count, parts=None):
+    """
+    Run cases ``start`` to ``start + count`` in a worker process and return a digest of the result of each.
+    """
+    digests = []
+    for number in range(start, start + count):
+        data = generate_case(seed, number, _engine.corpus)
+        result = _engine.result(_case_name(seed, number), data, parts)
+        digests.append(hashlib.blake2b(repr(result).encode('utf-8'), digest_size=16).digest())
+    return digests
+
+
+def explain_case(seed, number, parts=None):
+    """
+    Returns the input and the full result of one case, to report a mismatch.
+    """
+    data = generate_case(seed, number, _engine.corpus)
+    return data, _engine.result(_case_name(seed, number), data, parts)
+
+
+def _report(failures_dir, seed, number, data, reference, candidate):
+    """
+    Write the input of a mismatch and a diff of the two results.
+    """
+    name = _case_name(seed, number)
+    diff = ''.join(difflib.unified_diff(pprint.pformat(reference, width=120).splitlines(True),
+                                        pprint.pformat(candidate, width=120).splitlines(True),
+                                        'reference', 'candidate'))
+    print('Mismatch in {name}:\n{diff}'.format(name=name, diff=diff[:2000]), file=sys.stderr)
+    if failures_dir:
+        os.makedirs(str(failures_dir), exist_ok=True)
+        Path(failures_dir, name).write_bytes(data)
+        Path(failures_dir, name + '.diff').write_text(diff, encoding='utf-8')
+
+
+def compare(reference_dir, candidate_dir=None, cases=DEFAULT_CASES, seed=0, corpus_dir=None, processes=None,
+            failures_dir=None, guarded=False, batch_size=DEFAULT_BATCH_SIZE, case_seconds=DEFAULT_CASE_SECONDS,
+            max_mismatches=20, candidate_options=None):
+    """
+    Run the same cases through the reference and the candidate version and compare the results.
+
+    :param reference_dir: The directory of the frozen reference, see :func:`freeze`.
+    :param candidate_dir: The directory of the version to check. Defaults to the directory of this module.
+    :param int cases: The number of files to generate.
+    :param int seed: The seed of the generated files.
+    :param corpus_dir: A directory of real song files to mutate, besides generated ones.
+    :param int processes: The number of worker processes of each version. Defaults to half the number of CPUs.
+    :param failures_dir: The directory to write the input and diff of every mismatch to.
+    :param bool guarded: Import in the guarded parsing mode instead of the lenient one.
+    :param int batch_size: The number of cases handed to a worker at once.
+    :param float case_seconds: In the lenient mode, the time after which a file counts as a timeout.
+    :param int max_mismatches: Stop after this many mismatches.
+    :param dict candidate_options: Further keyword arguments for the candidate's importer, e.g. ``block_scan=True``.
+    :return: The numbers of the cases whose results differ.
+    """
+    # Started fresh, so the workers do not inherit modules the parent has imported
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    candidate_dir = candidate_dir or os.path.dirname(os.path.abspath(__file__))
+    processes = processes or max(1, (os.cpu_count() or 2) // 2)
+    context = multiprocessing.get_context('spawn')
+    pools = [ProcessPoolExecutor(processes, mp_context=context, initializer=_start_engine,
+                                 initargs=(str(engine_dir), corpus_dir, guarded, case_seconds, options))
+             for engine_dir, options in ((reference_dir, None), (candidate_dir, candidate_options))]
+    mismatches = []
+    started = time.time()
+    done = 0
+    try:
+        # E.g. an older reference has no verse plans or text export, which are then left out on both sides
+        parts = set.intersection(*[pool.submit(engine_parts).result() for pool in pools])
+        batches = []
+        for start in range(0, cases, batch_size):
+            count = min(batch_size, cases - start)
+            batches.append((start, [pool.submit(run_batch, seed, start, count, parts) for pool in pools]))
+        for start, (reference_future, candidate_future) in batches:
+            for offset, (reference, candidate) in enumerate(zip(reference_future.result(),
+                                                                candidate_future.result())):
+                if reference == candidate:
+                    continue
+                number = start + offset
+                mismatches.append(number)
+                data, reference_result = pools[0].submit(explain_case, seed, number, parts).result()
+                data, candidate_result = pools[1].submit(explain_case, seed, number, parts).result()
+                _report(failures_dir, seed, number, data, reference_result, candidate_result)
+            done += len(reference_future.result())
+            if len(mismatches) >= max_mismatches:
+                print('Stopping after {count} mismatches'.format(count=len(mismatches)), file=sys.stderr)
+                break
+            if done % (batch_size * 50) == 0:
+                print('{done} cases, {count} mismatches, {rate:.0f} cases/s'.format(
+                    done=done, count=len(mismatches), rate=done / (time.time() - started)))
+    finally:
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+    print('{done} cases in {seconds:.1f}s, {count} mismatches'.format(done=done, seconds=time.time() - started,
+                                                                      count=len(mismatches)))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two versions of the converter on randomized song files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    freeze_parser = commands.add_parser('freeze', help='Copy the current converter to use as the reference')
+    freeze_parser.add_argument('reference_dir', help='The directory to copy to')
+    freeze_parser.add_argument('--revision', help='Take the modules from this git revision')
+    run_parser = commands.add_parser('run', help='Compare the current converter with the reference')
+    run_parser.add_argument('reference_dir', help='The directory of the frozen reference')
+    run_parser.add_argument('--candidate', help='The directory of the version to check (default: this one)')
+    run_parser.add_argument('--cases', type=int, default=DEFAULT_CASES,
+                            help='The number of files (default: %(default)s)')
+    run_parser.add_argument('--seed', type=int, default=0,
+                            help='The seed of the generated files (default: %(default)s)')
+    run_parser.add_argument('--corpus', help='A directory of song files to mutate')
+    run_parser.add_argument('--processes', type=int, default=None, help='The number of worker processes per version')
+    run_parser.add_argument('--failures', help='The directory to write mismatching files and their diffs to')
+    run_parser.add_argument('--guarded', action='store_true', help='Import in the guarded parsing mode')
+    run_parser.add_argument('--block-scan', action='store_true',
+                            help='Let the candidate find the blocks with NumPy, see blockscan.py')
+    args = parser.parse_args()
+    if args.command == 'freeze':
+        freeze(args.reference_dir, args.revision)
+    else:
+        sys.exit(1 if compare(args.reference_dir, args.candidate, args.cases, args.seed, args.corpus, args.processes,
+                              args.failures, args.guarded,
+                              candidate_options={'block_scan': True} if args.block_scan else None) else 0)
@@ -20,15 +20,71 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>. #
 ##########################################################################
 
+import functools
 import logging
 import re
 
-from utils import VerseType, normalize_str, Song
-from openlyricsxml import SongXML
+from utils import VerseType, VersePlan, clean_lyrics, clean_title, normalize_str, Song
+from songxml import SongXML
 
 
 log = logging.getLogger(__name__)
 
+# How many distinct field values the parsing functions remember the result for. A library repeats the same author and
+# verse names in thousands of songs.
+PARSE_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def split_authors(text):
+    """
+    Split an author field by '&' and comma, turning 'Mr and Mrs Smith' into 'Mr Smith' and 'Mrs Smith'.
+
+    :return: A tuple of the author names, which may contain duplicates.
+    """
+    names = []
+    for author in text.split(','):
+        authors = author.split('&')
+        for i in range(len(authors)):
+            author2 = authors[i].strip()
+            if author2.find(' ') == -1 and i < len(authors) - 1:
+                author2 = author2 + ' ' + authors[i + 1].strip().split(' ')[-1]
+            if author2.endswith('.'):
+                author2 = author2[:-1]
+            if author2:
+                names.append(author2)
+    return tuple(names)
+
+
+class ImportFailure(object):
+    """
+    A file which could not be imported. For a corrupt file, ``offset`` and ``block_key`` tell where parsing stopped.
+    """
+
+    def __init__(self, file_path, reason, offset=None, block_key=None):
+        self.file_path = file_path
+        self.reason = reason
+        self.offset = offset
+        self.block_key = block_key
+
+    @property
+    def category(self):
+        """
+        The part of the reason before the first colon, e.g. ``Corrupt file``.
+        """
+        return self.reason.split(':')[0]
+
+    def to_dict(self):
+        failure = {'file': str(self.file_path), 'reason': self.reason}
+        if self.offset is not None:
+            failure['offset'] = self.offset
+        if self.block_key is not None:
+            failure['block_key'] = self.block_key
+        return failure
+
+    def __repr__(self):
+        return 'ImportFailure({failure!r})'.format(failure=self.to_dict())
+
 
 class SongImport():
     """
@@ -66,6 +122,12 @@ class SongImport():
         self.song = None
         self.store = kwargs['store']
         self.stop_import_flag = False
+        # The file currently being imported, recorded on its song
+        self.source_path = None
+        # An ImportFailure for every file which could not be imported
+        self.failures = []
+        # An optional runreport.RunReport which collects per-file statistics
+        self.run_report = kwargs.get('run_report')
         self.set_defaults()
 
     def set_defaults(self):
@@ -92,16 +154,22 @@ class SongImport():
         self.verse_counts = {}
         self.copyright_string = 'Copyright'
 
-    def log_error(self, file_path, reason='Unknown error'):
+    def log_error(self, file_path, reason='Unknown error', offset=None, block_key=None):
         """
         This should be called, when a song could not be imported.
 
         :param file_path: This should be the file path if ``self.import_source`` is a list with different files. If it
             is not a list, but a single file (for instance a database), then this should be the song's title.
         :param reason: The reason why the import failed. The string should be as informative as possible.
+        :param int offset: The position in the file where parsing failed, if known.
+        :param int block_key: The key of the block which could not be parsed, if known.
         """
         self.set_defaults()
-        log.error('Failed to import song: "{reason}"'.format(reason=reason))
+        failure = ImportFailure(file_path, reason, offset, block_key)
+        self.failures.append(failure)
+        log.error('Failed to import song {path}: "{reason}"'.format(path=file_path, reason=reason))
+        if self.run_report:
+            self.run_report.file_failed(failure)
 
     def stop_import(self):
         """
@@ -211,16 +279,8 @@ class SongImport():
         Add the author. OpenLP stores them individually so split by 'and', '&' and comma. However need to check
         for 'Mr and Mrs Smith' and turn it to 'Mr Smith' and 'Mrs Smith'.
         """
-        for author in text.split(','):
-            authors = author.split('&')
-            for i in range(len(authors)):
-                author2 = authors[i].strip()
-                if author2.find(' ') == -1 and i < len(authors) - 1:
-                    author2 = author2 + ' ' + authors[i + 1].strip().split(' ')[-1]
-                if author2.endswith('.'):
-                    author2 = author2[:-1]
-                if author2:
-                    self.add_author(author2)
+        for author in split_authors(text):
+            self.add_author(author)
 
     def add_author(self, author, type=None):
         """
@@ -308,15 +368,16 @@ class SongImport():
         log.info('committing song {title} to store'.format(title=self.title))
         song = Song()
         song.title = self.title
+        song.source_path = self.source_path
         song.alternate_title = self.alternate_title
-        # Values will be set when cleaning the song.
-        song.search_title = ''
-        song.search_lyrics = ''
+        song.search_title = clean_title(self.title, self.alternate_title)
         song.verse_order = ''
         song.song_number = self.song_number
         verses_changed_to_other = {}
         sxml = SongXML()
         other_count = 1
+        verse_defs = []
+        verse_texts = []
         for (verse_def, verse_text, lang) in self.verses:
             if verse_def[0].lower() in VerseType.tags:
                 verse_tag = verse_def[0].lower()
@@ -327,12 +388,17 @@ class SongImport():
                 verse_tag = VerseType.tags[VerseType.Other]
                 log.info('Versetype {old} changing to {new}'.format(old=verse_def, new=new_verse_def))
                 verse_def = new_verse_def
-            sxml.add_verse_to_lyrics(verse_tag, verse_def[1:], normalize_str(verse_text), lang)
+            verse_text = normalize_str(verse_text)
+            sxml.add_verse_to_lyrics(verse_tag, verse_def[1:], verse_text, lang)
+            verse_defs.append(verse_tag + verse_def[1:])
+            verse_texts.append(verse_text)
         song.lyrics = str(sxml.extract_xml(), 'utf-8')
+        song.search_lyrics = clean_lyrics(verse_texts)
         if not self.verse_order_list and self.verse_order_list_generated_useful:
             self.verse_order_list = self.verse_order_list_generated
         self.verse_order_list = [verses_changed_to_other.get(v, v) for v in self.verse_order_list]
         song.verse_order = ' '.join(self.verse_order_list)
+        song.verse_plan = VersePlan(verse_defs, song.verse_order)
         song.copyright = self.copyright
         song.comments = self.comments
         song.theme_name = self.theme_name
@@ -347,7 +413,7 @@ class SongImport():
             song.topics.append(topic_text)
         # We need to save the song now, before adding the media files, so that
         # we know where to save the media files to.
-        if isinstance(self.store, list):
+        if hasattr(self.store, 'append'):
             self.store.append(song)
 
         self.set_defaults()
@@ -0,0 +1,244 @@
+"""
+The :mod:`songpack` module stores a folder of song files in one indexed pack file.
+
+Converting a library of tens of thousands of small ``.sbsong`` files costs an ``open``, ``stat`` and ``close`` for
+every file, which on a cold cache or network storage takes longer than parsing it. A pack holds all the files in one
+file, which is read sequentially through a memory map, with an index to find any song by name::
+
+    header      magic, offset and size of the index, number of songs, checksum of the index
+    data        the contents of the song files, one after the other
+    index       for every song: the name, the offset and size of its contents and their CRC-32
+
+The checksum of a song is checked every time it is read, so a damaged pack is reported as an unreadable song file
+instead of being imported as a damaged song. The files are found like those of a folder, by a
+:class:`songdiscovery.SongDiscovery`, so a library in nested folders is packed with ``--recursive``, and each song is
+named by its path relative to the folder, e.g. ``Hymns/Amazing Grace.sbsong``. The songs are kept in the order of the
+walk, which for a flat folder is sorted by name. Pack a folder from the command line::
+
+    python ./songpack.py pack ../Songs ../songs.sbpack --recursive --exclude Archive
+
+and set ``IMPORT_DIR`` to the pack file. ``INCLUDE``, ``EXCLUDE`` and ``RECURSIVE`` then select songs of the pack like
+those of a folder. The pack is not updated when the folder changes, pack it again instead.
+"""
+import argparse
+import io
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+from songdiscovery import DEFAULT_INCLUDE, SongDiscovery
+from songwriters import TEMP_SUFFIX
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SBSPACK\x01'
+# magic, index offset, index size, number of songs, CRC-32 of the index
+HEADER = struct.Struct('<8sQQII')
+# name length, then the name, then offset, size and CRC-32 of the contents
+NAME_LENGTH = struct.Struct('<H')
+ENTRY = struct.Struct('<QII')
+PACK_EXTENSION = 'sbpack'
+
+# The packs opened in this process, by path
+_packs = {}
+
+
+class PackError(ValueError):
+    """
+    Raised when a file is not a pack or its index is damaged.
+    """
+    pass
+
+
+class ChecksumError(OSError):
+    """
+    Raised when the contents of a song in a pack do not match their checksum. Like any read error, the importer
+    reports the song as unreadable.
+    """
+    pass
+
+
+def pack_directory(import_dir, pack_path, include=DEFAULT_INCLUDE, exclude=(), recursive=False):
+    """
+    Write the song files of a folder into a pack.
+
+    :param import_dir: The folder of the song files.
+    :param pack_path: The pack file to write. It is replaced once the new pack is complete.
+    :param include: The patterns of the names of the song files, see :class:`songdiscovery.SongDiscovery`.
+    :param exclude: The patterns of the names or relative paths of the files and folders to skip.
+    :param bool recursive: Also pack the song files in the subfolders, named by their relative paths.
+    :return: The number of packed songs.
+    """
+    temp_path = str(pack_path) + TEMP_SUFFIX
+    index = []
+    count = 0
+    with open(temp_path, 'wb') as pack_file:
+        pack_file.write(bytes(HEADER.size))
+        for song_path in SongDiscovery(import_dir, include, exclude, recursive):
+            name = os.path.relpath(str(song_path), str(import_dir)).replace(os.sep, '/')
+            with song_path.open('rb') as song_file:
+                data = song_file.read()
+            index.append(NAME_LENGTH.pack(len(name.encode('utf-8'))) + name.encode('utf-8') +
+                         ENTRY.pack(pack_file.tell(), len(data), zlib.crc32(data)))
+            pack_file.write(data)
+            count += 1
+        index = b''.join(index)
+        index_offset = pack_file.tell()
+        pack_file.write(index)
+        pack_file.seek(0)
+        pack_file.write(HEADER.pack(MAGIC, index_offset, len(index), count, zlib.crc32(index)))
+    os.replace(temp_path, str(pack_path))
+    return count
+
+
+def open_pack(pack_path):
+    """
+    Returns the :class:`SongPack` of a pack file, opening it only once per process.
+    """
+    key = os.path.abspath(str(pack_path))
+    if key not in _packs:
+        _packs[key] = SongPack(pack_path)
+    return _packs[key]
+
+
+def is_pack(path):
+    """
+    Returns whether ``path`` is a pack file rather than a folder.
+    """
+    return os.path.isfile(str(path))
+
+
+class SongPack(object):
+    """
+    A pack file, mapped into memory, with random access to its songs by name.
+    """
+
+    def __init__(self, pack_path):
+        """
+        :param pack_path: The path of the pack file.
+        :raises PackError: If the file is not a pack or its index is damaged.
+        """
+        self.pack_path = str(pack_path)
+        with open(self.pack_path, 'rb') as pack_file:
+            if os.fstat(pack_file.fileno()).st_size < HEADER.size:
+                raise PackError('{path} is not a song pack'.format(path=self.pack_path))
+            self.data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_size, count, index_checksum = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise PackError('{path} is not a song pack'.format(path=self.pack_path))
+        index = self.data[index_offset:index_offset + index_size]
+        if len(index) != index_size or zlib.crc32(index) != index_checksum:
+            raise PackError('The index of {path} is damaged'.format(path=self.pack_path))
+        # Songs are usually read in order, which the operating system can read ahead for
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.data.madvise(mmap.MADV_SEQUENTIAL)
+        self.entries = {}
+        position = 0
+        for _ in range(count):
+            name_length, = NAME_LENGTH.unpack_from(index, position)
+            position += NAME_LENGTH.size
+            name = index[position:position + name_length].decode('utf-8')
+            position += name_length
+            self.entries[name] = ENTRY.unpack_from(index, position)
+            position += ENTRY.size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        """
+        Returns the names of the songs, in the order they were packed.
+        """
+        return list(self.entries)
+
+    def read(self, name):
+        """
+        Returns the contents of a song file.
+
+        :raises KeyError: If the pack has no song of that name.
+        :raises ChecksumError: If the contents are damaged.
+        """
+        offset, size, checksum = self.entries[name]
+        data = self.data[offset:offset + size]
+        if len(data) != size or zlib.crc32(data) != checksum:
+            raise ChecksumError('{name} is damaged in {path}'.format(name=name, path=self.pack_path))
+        return data
+
+    def song_files(self, discovery=None):
+        """
+        Returns a :class:`PackedSongFile` for every song, in the order they were packed, for the importer.
+
+        :param discovery: A :class:`songdiscovery.SongDiscovery` of the pack, whose ``include``, ``exclude`` and
+            ``recursive`` select the songs as if the pack were the folder it was made from. Defaults to all songs.
+        """
+        names = self.entries
+        if discovery is not None:
+            names = [name for name in names if discovery.matches(os.path.join(discovery.import_dir, name))]
+        return [PackedSongFile(self.pack_path, name) for name in names]
+
+    def close(self):
+        self.data.close()
+        _packs.pop(os.path.abspath(self.pack_path), None)
+
+
+class PackedSongFile(object):
+    """
+    A song file in a pack, which the importer can open like a :class:`~pathlib.Path`. It only holds the path of the
+    pack and the name of the song, so songs which refer to it can be pickled, e.g. to send them to worker processes.
+    """
+
+    def __init__(self, pack_path, name):
+        self.pack_path = str(pack_path)
+        self.name = name
+
+    def open(self, mode='rb'):
+        return io.BytesIO(open_pack(self.pack_path).read(self.name))
+
+    def __str__(self):
+        return os.path.join(self.pack_path, self.name)
+
+    def __repr__(self):
+        return 'PackedSongFile({path!r}, {name!r})'.format(path=self.pack_path, name=self.name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a folder of SongShow Plus files into one indexed file.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    pack_parser = commands.add_parser('pack', help='Pack the song files of a folder')
+    pack_parser.add_argument('import_dir', help='The folder of the song files')
+    pack_parser.add_argument('pack_path', help='The pack file to write, e.g. songs.{ext}'.format(ext=PACK_EXTENSION))
+    pack_parser.add_argument('--recursive', action='store_true', help='Also pack the song files of the subfolders')
+    pack_parser.add_argument('--include', action='append',
+                             help='A pattern of the names of the song files to pack (default: {include})'.format(
+                                 include=DEFAULT_INCLUDE[0]))
+    pack_parser.add_argument('--exclude', action='append', default=[],
+                             help='A pattern of the names or relative paths of the files and folders to skip')
+    list_parser = commands.add_parser('list', help='List the songs of a pack')
+    list_parser.add_argument('pack_path')
+    verify_parser = commands.add_parser('verify', help='Check the checksums of all songs of a pack')
+    verify_parser.add_argument('pack_path')
+    args = parser.parse_args()
+    if args.command == 'pack':
+        print('Packed {count} songs'.format(count=pack_directory(args.import_dir, args.pack_path,
+                                                                 args.include or DEFAULT_INCLUDE, args.exclude,
+                                                                 args.recursive)))
+    elif args.command == 'list':
+        pack = SongPack(args.pack_path)
+        for name in pack.names():
+            print(name)
+    else:
+        pack = SongPack(args.pack_path)
+        damaged = 0
+        for name in pack.names():
+            try:
+                pack.read(name)
+            except ChecksumError as error:
+                damaged += 1
+                print(error)
+        print('{count} songs, {damaged} damaged'.format(count=len(pack), damaged=damaged))
+        raise SystemExit(1 if damaged else 0)
@@ -0,0 +1,137 @@
+"""
+The :mod:`songpipeline` module connects an importer, an optional transform stage and an exporter with bounded queues.
+
+Each stage runs in its own thread, so reading and parsing the source files overlaps with building and writing the
+output files. Because every queue is bounded, a fast stage blocks as soon as it is ``queue_size`` songs ahead of the
+next one, which keeps the number of songs held in memory constant regardless of the size of the library.
+"""
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 64
+
+# Marks the end of a stage's output.
+_DONE = object()
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised inside a stage when the downstream stages have stopped consuming.
+    """
+    pass
+
+
+class SongQueue(object):
+    """
+    A bounded store which hands finished songs over to the next pipeline stage.
+
+    It can be passed as ``store`` to a :class:`SongImport`, and iterating over it yields the songs in the order they
+    were appended until the producing stage has finished.
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.cancelled = threading.Event()
+
+    def append(self, song):
+        """
+        Hand a song to the next stage, blocking while the queue is full.
+        """
+        self._put(song)
+
+    def close(self):
+        """
+        Signal the consuming stage that no more songs will follow.
+        """
+        self._put(_DONE)
+
+    def cancel(self):
+        """
+        Stop accepting songs and unblock the producing and the consuming stage.
+        """
+        self.cancelled.set()
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise PipelineCancelled()
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                # The producer of a cancelled queue may never close it, e.g. when it is itself blocked upstream
+                if self.cancelled.is_set():
+                    return
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+
+def _run_stage(target, output, errors):
+    """
+    Run ``target`` and close ``output`` afterwards, recording any error for the pipeline runner.
+    """
+    try:
+        target()
+    except PipelineCancelled:
+        pass
+    except Exception as error:
+        log.exception('Pipeline stage failed')
+        errors.append(error)
+    try:
+        output.close()
+    except PipelineCancelled:
+        pass
+
+
+def run_pipeline(importer, export, transform=None, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Import and export songs concurrently.
+
+    :param importer: A :class:`SongImport` instance. Its ``store`` is replaced by the pipeline's input queue.
+    :param export: A callable which takes an iterable of songs, e.g. ``export_songs_txt``. It runs in the calling
+        thread.
+    :param transform: An optional callable which takes a song and returns the (possibly modified) song to export. It
+        runs in its own stage between the importer and the exporter.
+    :param queue_size: The maximum number of songs waiting between two stages.
+    """
+    imported = SongQueue(queue_size)
+    importer.store = imported
+    errors = []
+    queues = [imported]
+    threads = [threading.Thread(target=_run_stage, args=(importer.do_import, imported, errors), name='song-import',
+                                daemon=True)]
+    songs = imported
+    if transform:
+        transformed = SongQueue(queue_size)
+
+        def transform_songs():
+            for song in imported:
+                transformed.append(transform(song))
+
+        queues.append(transformed)
+        threads.append(threading.Thread(target=_run_stage, args=(transform_songs, transformed, errors),
+                                        name='song-transform', daemon=True))
+        songs = transformed
+    for thread in threads:
+        thread.start()
+    try:
+        export(songs)
+    finally:
+        # Release any stage still blocked on a full queue, e.g. when the exporter failed.
+        for song_queue in queues:
+            song_queue.cancel()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
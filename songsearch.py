@@ -0,0 +1,248 @@
+"""
+The :mod:`songsearch` module builds a persistent full-text index over a converted library and searches it.
+
+The index covers the words of every song's title, its authors, its CCLI number and its lyrics, all normalized the
+same way as OpenLP's ``search_title`` and ``search_lyrics``. It is stored in a single file which is memory-mapped for
+searching, so a lookup only touches the few pages it needs, no matter how large the library is::
+
+    header
+    term offsets        (term_count + 1) x uint64, into the term blob
+    term blob           the UTF-8 encoded terms, sorted by their bytes
+    posting offsets     (term_count + 1) x uint64, counted in entries of the postings
+    postings            uint32 song numbers, ascending per term
+    document offsets    (document_count + 1) x uint64, into the document blob
+    document blob       one JSON object per song
+
+A term is found with a binary search over the sorted terms. Queries match songs containing all of their words; songs
+in which the query also appears as a phrase, such as a remembered lyric line, are ranked first.
+
+The index can also be searched from the command line::
+
+    python ./songsearch.py ../songs_exported/songs.index amazing grace how sweet
+"""
+import json
+import logging
+import mmap
+import struct
+import sys
+from array import array
+
+from utils import clean_string, clean_title
+
+log = logging.getLogger(__name__)
+
+INDEX_MAGIC = b'SONGIDX1'
+HEADER = struct.Struct('<8sII6Q')
+UINT64 = struct.Struct('<Q')
+UINT32 = struct.Struct('<I')
+
+
+def _uint32_array():
+    values = array('I')
+    # The postings are written as 4 byte integers, which 'I' is on every platform Python supports
+    assert values.itemsize == 4
+    return values
+
+
+def _song_terms(song):
+    """
+    Returns the set of index terms of a song.
+    """
+    terms = set()
+    search_title = song.search_title or clean_title(song.title, song.alternate_title)
+    terms.update(search_title.replace('@', ' ').split())
+    for author in song.authors:
+        terms.update(clean_string(author).split())
+    if song.ccli_number:
+        terms.add(str(song.ccli_number))
+    terms.update(song.search_lyrics.split())
+    return terms
+
+
+class SearchIndexBuilder(object):
+    """
+    Collects songs and writes the search index file.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = []
+
+    def add(self, song):
+        """
+        Add a song to the index.
+
+        :param song: A :class:`utils.Song`, with ``search_title`` and ``search_lyrics`` set by the import.
+        """
+        song_number = len(self.documents)
+        for term in _song_terms(song):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = _uint32_array()
+            postings.append(song_number)
+        document = {'title': song.title, 'authors': list(song.authors), 'ccli_number': str(song.ccli_number or ''),
+                    'song_book_name': song.song_book_name, 'search_title': song.search_title,
+                    'search_lyrics': song.search_lyrics}
+        self.documents.append(json.dumps(document, ensure_ascii=False).encode('utf-8'))
+
+    def scan(self, songs):
+        """
+        Add every song of an iterable while passing it on, so the index can be built during an export.
+        """
+        for song in songs:
+            self.add(song)
+            yield song
+
+    def write(self, index_path):
+        """
+        Write the index file.
+        """
+        terms = sorted(self.postings, key=lambda term: term.encode('utf-8'))
+        with open(str(index_path), 'wb') as index_file:
+            index_file.write(b'\0' * HEADER.size)
+
+            def write_offsets(lengths):
+                position = 0
+                offsets = [0]
+                for length in lengths:
+                    position += length
+                    offsets.append(position)
+                index_file.write(struct.pack('<{count}Q'.format(count=len(offsets)), *offsets))
+
+            encoded_terms = [term.encode('utf-8') for term in terms]
+            sections = [index_file.tell()]
+            write_offsets(len(term) for term in encoded_terms)
+            sections.append(index_file.tell())
+            for term in encoded_terms:
+                index_file.write(term)
+            sections.append(index_file.tell())
+            write_offsets(len(self.postings[term]) for term in terms)
+            sections.append(index_file.tell())
+            for term in terms:
+                postings = self.postings[term]
+                if sys.byteorder == 'big':
+                    postings = array(postings.typecode, postings)
+                    postings.byteswap()
+                index_file.write(postings.tobytes())
+            sections.append(index_file.tell())
+            write_offsets(len(document) for document in self.documents)
+            sections.append(index_file.tell())
+            for document in self.documents:
+                index_file.write(document)
+            index_file.seek(0)
+            index_file.write(HEADER.pack(INDEX_MAGIC, len(terms), len(self.documents), *sections))
+        log.info('indexed {count} songs in {path}'.format(count=len(self.documents), path=index_path))
+
+
+class SearchIndex(object):
+    """
+    Searches a memory-mapped index file.
+    """
+
+    def __init__(self, index_path):
+        self.index_file = open(str(index_path), 'rb')
+        self.data = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.term_count, self.document_count, *sections = HEADER.unpack_from(self.data, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{path} is not a song search index'.format(path=index_path))
+        # The file offsets of the sections
+        (self.term_offsets_at, self.terms_at, self.posting_offsets_at, self.postings_at, self.document_offsets_at,
+         self.documents_at) = sections
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.index_file.close()
+
+    def _offset(self, table, number):
+        return UINT64.unpack_from(self.data, table + number * UINT64.size)[0]
+
+    def _term(self, number):
+        start = self.terms_at + self._offset(self.term_offsets_at, number)
+        end = self.terms_at + self._offset(self.term_offsets_at, number + 1)
+        return self.data[start:end]
+
+    def find_term(self, term):
+        """
+        Returns the number of a term, or ``None`` if it is not in the index.
+        """
+        term = term.encode('utf-8')
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self._term(low) == term:
+            return low
+        return None
+
+    def postings(self, term):
+        """
+        Returns the numbers of the songs containing ``term``, in ascending order.
+        """
+        number = self.find_term(term)
+        if number is None:
+            return _uint32_array()
+        start = self.postings_at + self._offset(self.posting_offsets_at, number) * UINT32.size
+        end = self.postings_at + self._offset(self.posting_offsets_at, number + 1) * UINT32.size
+        postings = _uint32_array()
+        postings.frombytes(self.data[start:end])
+        if sys.byteorder == 'big':
+            postings.byteswap()
+        return postings
+
+    def document(self, song_number):
+        """
+        Returns the stored fields of a song.
+        """
+        start = self.documents_at + self._offset(self.document_offsets_at, song_number)
+        end = self.documents_at + self._offset(self.document_offsets_at, song_number + 1)
+        return json.loads(self.data[start:end].decode('utf-8'))
+
+    def search(self, query, limit=20):
+        """
+        Find the songs containing every word of ``query`` in their title, authors, CCLI number or lyrics.
+
+        :param str query: The words to look for, e.g. a line of the lyrics.
+        :param int limit: The maximum number of results.
+        :return: The stored fields of the matching songs, phrase matches first.
+        """
+        words = clean_string(query).split()
+        if not words:
+            return []
+        # Intersect the shortest posting lists first
+        posting_lists = sorted((self.postings(word) for word in set(words)), key=len)
+        matches = set(posting_lists[0])
+        for postings in posting_lists[1:]:
+            if not matches:
+                break
+            matches.intersection_update(postings)
+        phrase = ' '.join(words)
+        phrase_matches = []
+        other_matches = []
+        for song_number in sorted(matches):
+            document = self.document(song_number)
+            if phrase in document['search_lyrics'] or phrase in document['search_title']:
+                phrase_matches.append(document)
+            else:
+                other_matches.append(document)
+            if len(phrase_matches) >= limit:
+                break
+        return (phrase_matches + other_matches)[:limit]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: python songsearch.py <index file> <words>')
+        sys.exit(1)
+    with SearchIndex(sys.argv[1]) as search_index:
+        for result in search_index.search(' '.join(sys.argv[2:])):
+            print('{title} ({authors}) {ccli}'.format(title=result['title'], authors=', '.join(result['authors']),
+                                                      ccli=result['ccli_number']).strip())
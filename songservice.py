@@ -0,0 +1,405 @@
+"""
+The :mod:`songservice` module runs a small local HTTP service which converts SongShow Plus files on demand.
+
+Tools which need a conversion now and then can post the ``.sbsong`` bytes to the service instead of starting
+``song_converter.py``, and so do not pay for the interpreter and lxml start-up on every call. The songs are converted
+in a pool of worker processes which are started, and have their importer and OpenLyrics converter set up, before the
+service accepts requests. Recent results are cached by the hash of the file contents.
+
+Endpoints::
+
+    POST /convert?format=xml            the body is one .sbsong file, the response the OpenLyrics XML
+    POST /convert?format=text           ... or the text export
+    POST /convert/batch?format=xml      the body is {"files": [{"name": "...", "data": "<base64>"}, ...]}, the
+                                        response {"results": [{"name": "...", "output": "..."}, ...]}, with "error"
+                                        and "status" in place of "output" for files which could not be converted
+    GET  /health                        the pool, queue and cache statistics
+
+A request which finds ``queue_size`` conversions pending from other requests is answered with ``503 Service
+Unavailable``. A batch of more files than that is handed to the workers in pieces of ``queue_size`` files. The
+files are parsed in the guarded mode of :class:`songshowplus.SongShowPlusImport`, so a damaged file fails with the
+offset where parsing stopped, and with a time limit per file and an optional memory limit per worker, so a single file
+cannot stall or exhaust the workers. A song which cannot be converted is answered with ``422 Unprocessable Entity``,
+and one which made its worker fail with ``500 Internal Server Error``. A worker which died, e.g. at the memory limit,
+is replaced along with the rest of the pool. Start the service from the command line::
+
+    python ./songservice.py --port 8765 --processes 4
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from parallelexport import prepare_renderers, render_openlyrics, render_text, text_title
+from songshowplus import ParseLimits, SongShowPlusImport
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the worker memory limit is not enforced
+    resource = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_CACHE_SIZE = 1024
+# Larger request bodies are refused, no song file comes close to this
+MAX_BODY_SIZE = 64 * 1024 * 1024
+OUTPUT_FORMATS = {'xml': 'application/xml', 'text': 'text/plain; charset=utf-8'}
+
+
+class ServiceBusy(Exception):
+    """
+    Raised when other requests leave no room for the conversions of a request.
+    """
+    pass
+
+
+class MemorySongFile(object):
+    """
+    A song file held in memory, which the importer can open like a :class:`~pathlib.Path`.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def open(self, mode='rb'):
+        return io.BytesIO(self.data)
+
+    def __str__(self):
+        return self.name
+
+
+# The importer of a worker process, created by _start_worker
+_importer = None
+
+
+def _start_worker(memory_limit=None):
+    """
+    Set up a worker process.
+
+    :param int memory_limit: The address space the worker may use, in bytes. A file which needs more fails with a
+        ``MemoryError`` instead of exhausting the memory of the machine.
+    """
+    global _importer
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    # The files come from other programs, so they are parsed in the guarded mode, with a time limit per file
+    _importer = SongShowPlusImport(file_paths=[], store=[], limits=ParseLimits())
+    prepare_renderers()
+
+
+def _ping():
+    return os.getpid()
+
+
+def convert_song(name, data, output_format):
+    """
+    Convert one song file in a worker process.
+
+    :param str name: The file name, used in messages.
+    :param bytes data: The contents of the ``.sbsong`` file.
+    :param str output_format: ``xml`` or ``text``.
+    :return: ``(True, file contents)`` or ``(False, failure)``, where ``failure`` is the dictionary of a
+        :class:`songimport.ImportFailure`. If the conversion raised an exception, ``failure`` also has ``internal``.
+    """
+    try:
+        if _importer is None:
+            _start_worker()
+        _importer.import_source = [MemorySongFile(name, data)]
+        _importer.store = []
+        _importer.failures = []
+        _importer.do_import()
+        if not _importer.store:
+            if _importer.failures:
+                return False, _importer.failures[0].to_dict()
+            return False, {'file': name, 'reason': 'No song found'}
+        song = _importer.store[0]
+        if output_format == 'text':
+            song.title = text_title(song.title)
+            return True, render_text(song)
+        return True, render_openlyrics(song)
+    except Exception as error:
+        # Only the message is sent back, the exceptions of lxml cannot be pickled
+        log.exception('Failed to convert {name}'.format(name=name))
+        return False, _internal_failure(name, error)
+
+
+def _internal_failure(name, error):
+    return {'file': name, 'reason': str(error) or type(error).__name__, 'internal': True}
+
+
+def failure_status(failure):
+    """
+    Returns the HTTP status of a failed conversion: 500 if the service failed, 422 if the file could not be converted.
+    """
+    return 500 if failure.get('internal') else 422
+
+
+class ConversionService(object):
+    """
+    Converts songs in a pool of warm worker processes, with a bounded number of pending conversions and an LRU cache.
+    """
+
+    def __init__(self, processes=None, queue_size=DEFAULT_QUEUE_SIZE, cache_size=DEFAULT_CACHE_SIZE,
+                 memory_limit=None):
+        """
+        :param int processes: The number of worker processes. Defaults to the number of CPUs.
+        :param int queue_size: The maximum number of conversions waiting for or running in a worker.
+        :param int cache_size: The number of results to keep.
+        :param int memory_limit: The memory each worker process may use, in bytes.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.memory_limit = memory_limit
+        self.queue_size = queue_size
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # Notified when pending conversions finish
+        self.available = threading.Condition(self.lock)
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.executor = None
+
+    def start(self):
+        """
+        Start the worker processes and wait until all of them are ready.
+        """
+        self.executor = self._new_executor()
+        pids = set(future.result() for future in [self.executor.submit(_ping) for _ in range(self.processes)])
+        log.info('Started {count} worker processes'.format(count=len(pids)))
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(self.processes, initializer=_start_worker, initargs=(self.memory_limit,))
+
+    def _replace_executor(self, broken):
+        """
+        Replace a pool which broke because a worker died, unless another request already did.
+        """
+        with self.lock:
+            if self.executor is not broken:
+                return
+            log.warning('A worker process died, restarting the worker processes')
+            self.executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _cached(self, key):
+        with self.lock:
+            result = self.cache.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def _store(self, key, result):
+        with self.lock:
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _reserve(self, count, wait):
+        """
+        Reserve room for ``count`` conversions in the queue, waiting for other requests to finish if ``wait`` is set.
+        """
+        with self.available:
+            while self.pending + count > self.queue_size:
+                if not wait:
+                    raise ServiceBusy()
+                self.available.wait()
+            self.pending += count
+
+    def _release(self, count):
+        with self.available:
+            self.pending -= count
+            self.available.notify_all()
+
+    def convert(self, files, output_format):
+        """
+        Convert song files.
+
+        :param files: A list of ``(name, data)`` pairs.
+        :param str output_format: ``xml`` or ``text``.
+        :return: A list of ``(True, file contents)`` or ``(False, failure)`` results, in the order of ``files``. See
+            :func:`convert_song` for the failures.
+        :raises ServiceBusy: If other requests fill the queue. Once the first files of a request are converted, the
+            rest wait for room instead.
+        """
+        results = [None] * len(files)
+        missing = []
+        for number, (name, data) in enumerate(files):
+            key = (hashlib.blake2b(data).digest(), output_format)
+            results[number] = self._cached(key)
+            if results[number] is None:
+                missing.append((number, name, data, key))
+        if not missing:
+            return results
+        # A batch larger than the queue is converted in pieces, never holding more than one piece of the queue
+        for start in range(0, len(missing), self.queue_size):
+            piece = missing[start:start + self.queue_size]
+            self._reserve(len(piece), wait=start > 0)
+            try:
+                self._convert_missing(piece, output_format, results)
+            finally:
+                self._release(len(piece))
+        return results
+
+    def _convert_missing(self, missing, output_format, results):
+        """
+        Convert ``(number, name, data, cache key)`` tuples in the workers, into ``results[number]``.
+        """
+        executor = self.executor
+        futures = []
+        for number, name, data, key in missing:
+            try:
+                future = executor.submit(convert_song, name, data, output_format)
+            except BrokenProcessPool:
+                self._replace_executor(executor)
+                executor = self.executor
+                future = executor.submit(convert_song, name, data, output_format)
+            futures.append((number, name, key, executor, future))
+        for number, name, key, executor, future in futures:
+            try:
+                results[number] = future.result()
+            except BrokenProcessPool as error:
+                self._replace_executor(executor)
+                results[number] = False, _internal_failure(name, error)
+            except Exception as error:
+                results[number] = False, _internal_failure(name, error)
+            # A failure of the service may not happen again, so it is not cached
+            ok, result = results[number]
+            if ok or not result.get('internal'):
+                self._store(key, results[number])
+
+    def statistics(self):
+        with self.lock:
+            return {'processes': self.processes, 'pending': self.pending, 'queue_size': self.queue_size,
+                    'cached': len(self.cache), 'cache_hits': self.hits, 'cache_misses': self.misses}
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the service. The :class:`ConversionService` is ``self.server.service``.
+    """
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            self._send(404, {'error': 'Not found'})
+            return
+        self._send(200, self.server.service.statistics())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ('/convert', '/convert/batch'):
+            self._send(404, {'error': 'Not found'})
+            return
+        output_format = parse_qs(url.query).get('format', ['xml'])[0]
+        if output_format not in OUTPUT_FORMATS:
+            self._send(400, {'error': 'Unknown format {format}'.format(format=output_format)})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            self._send(413, {'error': 'Request too large'})
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+        if url.path == '/convert':
+            files = [('request.sbsong', body)]
+        else:
+            try:
+                files = [(item.get('name', 'file{number}.sbsong'.format(number=number)),
+                          base64.b64decode(item['data'])) for number, item in enumerate(json.loads(body)['files'])]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self._send(400, {'error': 'Expected {"files": [{"name": ..., "data": <base64>}, ...]}'})
+                return
+        try:
+            results = self.server.service.convert(files, output_format)
+        except ServiceBusy:
+            self._send(503, {'error': 'Too many pending conversions'}, headers={'Retry-After': '1'})
+            return
+        except Exception as error:
+            log.exception('Failed to convert {count} files'.format(count=len(files)))
+            self._send(500, {'error': str(error)})
+            return
+        if url.path == '/convert':
+            ok, result = results[0]
+            if ok:
+                self._send(200, result, OUTPUT_FORMATS[output_format])
+            else:
+                self._send(failure_status(result), {'error': result})
+            return
+        response = []
+        for (name, data), (ok, result) in zip(files, results):
+            if ok:
+                response.append({'name': name, 'output': result.decode('utf-8')})
+            else:
+                response.append({'name': name, 'error': result, 'status': failure_status(result)})
+        self._send(200, {'results': response})
+
+
+def run_service(host='127.0.0.1', port=DEFAULT_PORT, processes=None, queue_size=DEFAULT_QUEUE_SIZE,
+                cache_size=DEFAULT_CACHE_SIZE, memory_limit=None):
+    """
+    Start the worker pool and serve requests until interrupted.
+    """
+    service = ConversionService(processes, queue_size, cache_size, memory_limit)
+    service.start()
+    server = ThreadingHTTPServer((host, port), ConversionRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    print('Converting songs on http://{host}:{port}/convert'.format(host=host, port=server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert SongShow Plus files over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1', help='The address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='The port to listen on (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None, help='The number of worker processes')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='The maximum number of pending conversions (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='The number of converted songs to cache (default: %(default)s)')
+    parser.add_argument('--memory-mb', type=int, default=None, help='The memory each worker process may use, in MB')
+    args = parser.parse_args()
+    run_service(args.host, args.port, args.processes, args.queue_size, args.cache_size,
+                args.memory_mb * 1024 * 1024 if args.memory_mb else None)
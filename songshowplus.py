@@ -23,11 +23,17 @@
 The :mod:`songshowplus` module provides the functionality for importing SongShow Plus songs into the OpenLP
 database.
 """
+import functools
 import logging
 import re
+import signal
 import struct
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
 
-from songimport import SongImport
+from songimport import PARSE_CACHE_SIZE, SongImport, split_authors
 
 
 TITLE = 1
@@ -43,10 +49,135 @@ VERSE_ORDER = 31
 SONG_BOOK = 35
 SONG_NUMBER = 36
 CUSTOM_VERSE = 37
+# The blocks whose contents are used. The others are skipped, using the offset of the next block in their header.
+KNOWN_BLOCKS = (TITLE, AUTHOR, COPYRIGHT, CCLI_NO, VERSE, CHORUS, BRIDGE, TOPIC, COMMENTS, VERSE_ORDER, SONG_BOOK,
+                CUSTOM_VERSE)
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+# The defaults of the guarded parsing mode. Real song files are a few kilobytes.
+MAX_FILE_SIZE = 16 * 1024 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_SECONDS = 10
+
+
+# The verse tags of the verse names OpenLP knows. Any other name becomes an 'o' verse numbered per song.
+VERSE_TYPE_TAGS = {'verse': 'v', 'chorus': 'c', 'bridge': 'b', 'pre-chorus': 'p'}
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def author_names(text):
+    """
+    Returns the authors of an AUTHOR block, which separates them by ' / ' and may give them as 'Last, First'.
+    """
+    names = []
+    for author in text.split(" / "):
+        if author.find(",") != -1:
+            author_parts = author.split(", ")
+            try:
+                author = author_parts[1] + " " + author_parts[0]
+            except Exception:
+                author = author_parts[0]
+        names.extend(split_authors(author))
+    return tuple(names)
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def ccli_number(text):
+    """
+    Returns the first number in the text of a CCLI_NO block, or ``None``.
+    """
+    match = re.search(r'\d+', text)
+    return int(match.group()) if match else None
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def verse_type(verse_name):
+    """
+    Returns the verse tag and number of a verse name, e.g. ``('c', '2')`` for ``Chorus 2``. The tag is ``None`` for
+    names OpenLP does not know, whose number depends on the other names of the song.
+    """
+    # Have we got any digits? If so, verse number is everything from the digits to the end (OpenLP does not have
+    # concept of part verses, so just ignore any non integers on the end (including floats))
+    match = re.match(r'(\D*)(\d+)', verse_name)
+    if match:
+        type_name = match.group(1).strip()
+        verse_number = match.group(2)
+    else:
+        # otherwise we assume number 1 and take the whole prefix as the verse tag
+        type_name = verse_name
+        verse_number = '1'
+    return VERSE_TYPE_TAGS.get(type_name.lower()), verse_number
+
+
+class ParseLimits(object):
+    """
+    The limits of the guarded parsing mode, for files from untrusted or damaged sources.
+    """
+
+    def __init__(self, max_file_size=MAX_FILE_SIZE, max_block_size=MAX_BLOCK_SIZE, max_seconds=MAX_SECONDS):
+        """
+        :param int max_file_size: Larger files are rejected without being parsed.
+        :param int max_block_size: Blocks announcing more data than this are rejected.
+        :param float max_seconds: Parsing a file is abandoned after this long. The time is checked before every block
+            in any thread, and in the main thread of a process on platforms with ``signal.setitimer`` also within a
+            block. ``None`` for no limit.
+        """
+        self.max_file_size = max_file_size
+        self.max_block_size = max_block_size
+        self.max_seconds = max_seconds
+
+
+class BlockError(ValueError):
+    """
+    A block of a song file which cannot be parsed safely.
+    """
+
+    def __init__(self, message, offset, block_key=None):
+        super(BlockError, self).__init__('{message} at offset {offset}'.format(message=message, offset=offset))
+        self.offset = offset
+        self.block_key = block_key
+
+
+class ParseTimeout(BaseException):
+    """
+    Raised when parsing a file takes longer than the limit of the guarded parsing mode. Like ``KeyboardInterrupt`` it
+    can be raised anywhere, so it does not derive from ``Exception``, where it would be caught by the parser itself.
+    """
+    pass
+
+
+@contextmanager
+def _time_limit(seconds):
+    """
+    Raise :class:`ParseTimeout` in the block if it runs longer than ``seconds``. Signals only reach the main thread, so
+    elsewhere, e.g. in the import thread of a pipeline or in a service, this does nothing and the importer relies on
+    checking its deadline between blocks, see :func:`_check_deadline`.
+    """
+    if not seconds or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def timeout(signum, frame):
+        raise ParseTimeout('Parsing took longer than {seconds}s'.format(seconds=seconds))
+
+    previous_handler = signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def _check_deadline(deadline, seconds):
+    """
+    Raise :class:`ParseTimeout` if the time of a file is up. Checked before every block, which works in any thread.
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        raise ParseTimeout('Parsing took longer than {seconds}s'.format(seconds=seconds))
+
 
 class SongShowPlusImport(SongImport):
     """
@@ -83,114 +214,208 @@ class SongShowPlusImport(SongImport):
     def __init__(self, **kwargs):
         """
         Initialise the SongShow Plus importer.
+
+        :param limits: A :class:`ParseLimits` to parse in the guarded mode, which checks every size and offset read
+            from a file before using it.
+        :param block_scan: Find the blocks of many files at once with :mod:`blockscan`, if NumPy is installed.
         """
         super(SongShowPlusImport, self).__init__(**kwargs)
+        self.limits = kwargs.get('limits')
+        self.block_scan = kwargs.get('block_scan', False)
+        self.file_size = 0
+
+    def _read(self, song_file, size, block_key):
+        """
+        Read ``size`` bytes of a block, checking the size against the limits in the guarded mode.
+        """
+        if self.limits is None:
+            return song_file.read(size)
+        offset = song_file.tell()
+        if size > self.limits.max_block_size:
+            raise BlockError('Block of {size} bytes exceeds the limit'.format(size=size), offset, block_key)
+        # Reading allocates the requested size up front, so never ask for more than is left. A truncated file then
+        # ends prematurely, just like in the normal mode.
+        return song_file.read(max(0, min(size, self.file_size - offset)))
 
     def do_import(self):
         """
-        Receive a single file or a list of files to import.
+        Receive a single file or a list of files to import. The files can also be an iterator, e.g. one which finds them
+        while the import runs.
         """
-        if not isinstance(self.import_source, list):
+        if not isinstance(self.import_source, (list, Iterator)):
             log.debug('import_source is not an instance of <list>')
             return
-        for file_path in self.import_source:
+        sources = ((file_path, None) for file_path in self.import_source)
+        if self.block_scan:
+            try:
+                from blockscan import scan_sources
+            except ImportError:
+                log.info('NumPy is not installed, reading the song files block by block')
+            else:
+                sources = scan_sources(self.import_source, self.limits)
+        for file_path, scanned_song in sources:
+            if self.stop_import_flag:
+                log.info('Import stopped before {path}'.format(path=file_path))
+                break
 
+            self.source_path = file_path
             self.ssp_verse_order_list = []
             self.other_count = 0
             self.other_list = {}
 
             print('Now importing: ' + str(file_path))
 
-            with file_path.open('rb') as song_file:
-                while True:
-                    try:
-                        block_key, = struct.unpack("I", song_file.read(4))
-                        log.debug('block_key: %d' % block_key)
-                    except Exception:
-                        # If the read failed, assume we hit the end prematurely and try to finalize
-                        log.warning('File ended prematurely. Import may be incomplete.')
-                        break
-                    # The file ends with 4 NULL's
-                    if block_key == 0:
-                        break
-                    next_block_starts, = struct.unpack("I", song_file.read(4))
-                    next_block_starts += song_file.tell()
-                    if block_key in (VERSE, CHORUS, BRIDGE):
-                        null, verse_no, = struct.unpack("BB", song_file.read(2))
-                    elif block_key == CUSTOM_VERSE:
-                        null, verse_name_length, = struct.unpack("BB", song_file.read(2))
-                        verse_name = self.decode(song_file.read(verse_name_length))
-                    length_descriptor_size, = struct.unpack("B", song_file.read(1))
-                    log.debug('length_descriptor_size: %d' % length_descriptor_size)
-                    # In the case of song_numbers the number is in the data from the
-                    # current position to the next block starts
-                    if block_key == SONG_NUMBER:
-                        sn_bytes = song_file.read(length_descriptor_size - 1)
-                        self.song_number = int.from_bytes(sn_bytes, byteorder='little')
-                        continue
-                    # Detect if/how long the length descriptor is
-                    if length_descriptor_size == 12 or length_descriptor_size == 20:
-                        length_descriptor, = struct.unpack("I", song_file.read(4))
-                    elif length_descriptor_size == 2:
-                        length_descriptor = 1
-                    elif length_descriptor_size == 9:
-                        length_descriptor = 0
-                    else:
-                        length_descriptor, = struct.unpack("B", song_file.read(1))
-                    log.debug('length_descriptor: %d' % length_descriptor)
-                    data = song_file.read(length_descriptor)
-                    log.debug(data)
-                    if block_key == TITLE:
-                        self.title = self.decode(data)
-                    elif block_key == AUTHOR:
-                        authors = self.decode(data).split(" / ")
-                        for author in authors:
-                            if author.find(",") != -1:
-                                author_parts = author.split(", ")
-                                try:
-                                    author = author_parts[1] + " " + author_parts[0]
-                                except Exception:
-                                    author = author_parts[0]
-                            self.parse_author(author)
-                    elif block_key == COPYRIGHT:
-                        self.add_copyright(self.decode(data))
-                    elif block_key == CCLI_NO:
-                        # Try to get the CCLI number even if the field contains additional text
-                        match = re.search(r'\d+', self.decode(data))
-                        if match:
-                            self.ccli_number = int(match.group())
+            started = time.time()
+            max_seconds = self.limits.max_seconds if self.limits is not None else None
+            deadline = time.monotonic() + max_seconds if max_seconds else None
+            blocks = 0
+            block_key = None
+            try:
+                if scanned_song is not None:
+                    # The blocks have already been found, only their contents are left to decode
+                    with _time_limit(self.limits and self.limits.max_seconds):
+                        self.file_size = len(scanned_song.data)
+                        for block_key, verse_no, verse_name, data in scanned_song.blocks():
+                            _check_deadline(deadline, max_seconds)
+                            blocks += 1
+                            if verse_name is not None:
+                                verse_name = self.decode(verse_name)
+                            self._import_block(block_key, data, verse_no, verse_name)
+                        if scanned_song.null_terminated:
+                            block_key = 0
+                    # Outside of the time limit, so a timeout cannot interrupt storing the song
+                    self._finish_file(file_path, started, self.file_size, blocks)
+                    continue
+                with file_path.open('rb') as song_file, _time_limit(self.limits and self.limits.max_seconds):
+                    if self.limits is not None:
+                        self.file_size = song_file.seek(0, 2)
+                        song_file.seek(0)
+                        if self.file_size > self.limits.max_file_size:
+                            raise BlockError('File of {size} bytes exceeds the limit'.format(size=self.file_size), 0)
+                    verse_no = verse_name = None
+                    while True:
+                        _check_deadline(deadline, max_seconds)
+                        try:
+                            block_key, = struct.unpack("I", song_file.read(4))
+                            log.debug('block_key: %d' % block_key)
+                        except Exception:
+                            # If the read failed, assume we hit the end prematurely and try to finalize
+                            log.warning('File ended prematurely. Import may be incomplete.')
+                            break
+                        # The file ends with 4 NULL's
+                        if block_key == 0:
+                            break
+                        blocks += 1
+                        next_block_starts, = struct.unpack("I", song_file.read(4))
+                        next_block_starts += song_file.tell()
+                        if block_key in (VERSE, CHORUS, BRIDGE):
+                            null, verse_no, = struct.unpack("BB", song_file.read(2))
+                        elif block_key == CUSTOM_VERSE:
+                            null, verse_name_length, = struct.unpack("BB", song_file.read(2))
+                            verse_name = self.decode(self._read(song_file, verse_name_length, block_key))
+                        length_descriptor_size, = struct.unpack("B", song_file.read(1))
+                        log.debug('length_descriptor_size: %d' % length_descriptor_size)
+                        # In the case of song_numbers the number is in the data from the
+                        # current position to the next block starts
+                        if block_key == SONG_NUMBER:
+                            sn_bytes = self._read(song_file, length_descriptor_size - 1, block_key)
+                            self._import_block(block_key, sn_bytes)
+                            continue
+                        # Detect if/how long the length descriptor is
+                        if length_descriptor_size == 12 or length_descriptor_size == 20:
+                            length_descriptor, = struct.unpack("I", song_file.read(4))
+                        elif length_descriptor_size == 2:
+                            length_descriptor = 1
+                        elif length_descriptor_size == 9:
+                            length_descriptor = 0
+                        else:
+                            length_descriptor, = struct.unpack("B", song_file.read(1))
+                        log.debug('length_descriptor: %d' % length_descriptor)
+                        data = self._read(song_file, length_descriptor, block_key)
+                        log.debug(data)
+                        if block_key in KNOWN_BLOCKS:
+                            self._import_block(block_key, data, verse_no, verse_name)
                         else:
-                            log.warning("Can't parse CCLI Number from string: {text}".format(text=self.decode(data)))
-                    elif block_key == VERSE:
-                        self.add_verse(self.decode(data), "{tag}{number}".format(tag='v',
-                                                                                 number=verse_no))
-                    elif block_key == CHORUS:
-                        self.add_verse(self.decode(data), "{tag}{number}".format(tag='c',
-                                                                                 number=verse_no))
-                    elif block_key == BRIDGE:
-                        self.add_verse(self.decode(data), "{tag}{number}".format(tag='b',
-                                                                                 number=verse_no))
-                    elif block_key == TOPIC:
-                        self.topics.append(self.decode(data))
-                    elif block_key == COMMENTS:
-                        self.comments = self.decode(data)
-                    elif block_key == VERSE_ORDER:
-                        verse_tag = self.to_openlp_verse_tag(self.decode(data), True)
-                        if verse_tag:
-                            if not isinstance(verse_tag, str):
-                                verse_tag = self.decode(verse_tag)
-                            self.ssp_verse_order_list.append(verse_tag)
-                    elif block_key == SONG_BOOK:
-                        self.song_book_name = self.decode(data)
-                    elif block_key == CUSTOM_VERSE:
-                        verse_tag = self.to_openlp_verse_tag(verse_name)
-                        self.add_verse(self.decode(data), verse_tag)
-                    else:
-                        log.debug("Unrecognised blockKey: {key}, data: {data}".format(key=block_key, data=data))
-                        song_file.seek(next_block_starts)
-                self.verse_order_list = self.ssp_verse_order_list
-                if not self.finish():
-                    self.log_error(file_path)
+                            log.debug("Unrecognised blockKey: {key}, data: {data}".format(key=block_key, data=data))
+                            if self.limits is not None and next_block_starts < song_file.tell():
+                                raise BlockError('Next block offset does not advance', song_file.tell(), block_key)
+                            song_file.seek(next_block_starts)
+                    size = song_file.seek(0, 2)
+                self._finish_file(file_path, started, size, blocks)
+            # A broken file must not end the whole import
+            except OSError as error:
+                self.log_error(file_path, 'Unreadable file: {error}'.format(error=error))
+            except BlockError as error:
+                self.log_error(file_path, 'Corrupt file: {error}'.format(error=error), error.offset, error.block_key)
+            except (struct.error, UnicodeDecodeError, ValueError) as error:
+                self.log_error(file_path, 'Corrupt file: {error}'.format(error=error), block_key=block_key)
+            except ParseTimeout as error:
+                self.log_error(file_path, 'Timeout: {error}'.format(error=error), block_key=block_key)
+            except MemoryError:
+                self.log_error(file_path, 'Out of memory: the file needs more memory than is available',
+                               block_key=block_key)
+
+    def _import_block(self, block_key, data, verse_no=None, verse_name=None):
+        """
+        Take over the contents of one block of a known kind.
+
+        :param int block_key: The kind of block.
+        :param bytes data: The contents of the block.
+        :param int verse_no: The number of a verse, chorus or bridge.
+        :param str verse_name: The name of a custom verse.
+        """
+        if block_key == SONG_NUMBER:
+            self.song_number = int.from_bytes(data, byteorder='little')
+        elif block_key == TITLE:
+            self.title = self.decode(data)
+        elif block_key == AUTHOR:
+            for author in author_names(self.decode(data)):
+                self.add_author(author)
+        elif block_key == COPYRIGHT:
+            self.add_copyright(self.decode(data))
+        elif block_key == CCLI_NO:
+            # Try to get the CCLI number even if the field contains additional text
+            number = ccli_number(self.decode(data))
+            if number is not None:
+                self.ccli_number = number
+            else:
+                log.warning("Can't parse CCLI Number from string: {text}".format(
+                    text=self.decode(data)))
+        elif block_key == VERSE:
+            self.add_verse(self.decode(data), "{tag}{number}".format(tag='v',
+                                                                     number=verse_no))
+        elif block_key == CHORUS:
+            self.add_verse(self.decode(data), "{tag}{number}".format(tag='c',
+                                                                     number=verse_no))
+        elif block_key == BRIDGE:
+            self.add_verse(self.decode(data), "{tag}{number}".format(tag='b',
+                                                                     number=verse_no))
+        elif block_key == TOPIC:
+            self.topics.append(self.decode(data))
+        elif block_key == COMMENTS:
+            self.comments = self.decode(data)
+        elif block_key == VERSE_ORDER:
+            verse_tag = self.to_openlp_verse_tag(self.decode(data), True)
+            if verse_tag:
+                if not isinstance(verse_tag, str):
+                    verse_tag = self.decode(verse_tag)
+                self.ssp_verse_order_list.append(verse_tag)
+        elif block_key == SONG_BOOK:
+            self.song_book_name = self.decode(data)
+        elif block_key == CUSTOM_VERSE:
+            verse_tag = self.to_openlp_verse_tag(verse_name)
+            self.add_verse(self.decode(data), verse_tag)
+
+    def _finish_file(self, file_path, started, size, blocks):
+        """
+        Turn the blocks read from a file into a song.
+        """
+        self.verse_order_list = self.ssp_verse_order_list
+        reason = 'Incomplete song: no title' if not self.title else 'Incomplete song: no verses'
+        if not self.finish():
+            self.log_error(file_path, reason)
+        if self.run_report:
+            self.run_report.file_imported(file_path, time.time() - started, size, blocks)
 
     def to_openlp_verse_tag(self, verse_name, ignore_unique=False):
         """
@@ -200,26 +425,9 @@ class SongShowPlusImport(SongImport):
         :param ignore_unique: Ignore if unique
         :return: The verse tags and verse number concatenated
         """
-        # Have we got any digits? If so, verse number is everything from the digits to the end (OpenLP does not have
-        # concept of part verses, so just ignore any non integers on the end (including floats))
-        match = re.match(r'(\D*)(\d+)', verse_name)
-        if match:
-            verse_type = match.group(1).strip()
-            verse_number = match.group(2)
-        else:
-            # otherwise we assume number 1 and take the whole prefix as the verse tag
-            verse_type = verse_name
-            verse_number = '1'
-        verse_type = verse_type.lower()
-        if verse_type == "verse":
-            verse_tag = 'v'
-        elif verse_type == "chorus":
-            verse_tag = 'c'
-        elif verse_type == "bridge":
-            verse_tag = 'b'
-        elif verse_type == "pre-chorus":
-            verse_tag = 'p'
-        else:
+        verse_tag, verse_number = verse_type(verse_name)
+        if verse_tag is None:
+            # The numbers of the other verses are counted per song, so they are not remembered with the name
             if verse_name not in self.other_list:
                 if ignore_unique:
                     return None
@@ -0,0 +1,99 @@
+"""
+The :mod:`songstore` module provides a song store with a memory budget, for converting libraries larger than the
+memory of the machine.
+"""
+import logging
+import pickle
+import struct
+import tempfile
+import zlib
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+RECORD_LENGTH = struct.Struct('<I')
+# Rough per-song overhead of the Song object, its dictionary and the string objects, in bytes
+SONG_OVERHEAD = 1024
+
+
+def estimate_size(song):
+    """
+    Estimate the memory used by a song, based on the length of its strings.
+    """
+    size = SONG_OVERHEAD
+    for value in song.__dict__.values():
+        if isinstance(value, str):
+            size += len(value) + 50
+        elif isinstance(value, list):
+            size += sum(len(str(item)) + 50 for item in value)
+    return size
+
+
+class SpillingSongStore(object):
+    """
+    A store which keeps the most recently added songs in memory and spills older ones to a compressed log on disk
+    once the estimated size of the songs in memory exceeds ``memory_budget``.
+
+    It can be passed as ``store`` to a :class:`SongImport`. Iterating over it yields all songs in the order they were
+    added, reading the spilled songs back from the log, so the exporters can consume it like a list. Songs read back
+    from the log are copies: changes an exporter makes to them are not kept.
+    """
+
+    def __init__(self, memory_budget, spill_dir=None):
+        """
+        :param int memory_budget: The number of bytes the songs in memory may use, roughly.
+        :param spill_dir: The directory for the log file. Defaults to the system's temporary directory.
+        """
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_file = None
+        self.spilled = 0
+        self.hot = deque()
+        self.hot_size = 0
+
+    def append(self, song):
+        """
+        Add a song, spilling the oldest songs in memory if the budget is exceeded.
+        """
+        size = estimate_size(song)
+        self.hot.append((song, size))
+        self.hot_size += size
+        while self.hot_size > self.memory_budget and len(self.hot) > 1:
+            self._spill()
+
+    def _spill(self):
+        song, size = self.hot.popleft()
+        self.hot_size -= size
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='songs-', suffix='.log', dir=self.spill_dir)
+            log.info('Memory budget exceeded, spilling songs to disk')
+        record = zlib.compress(pickle.dumps(song, pickle.HIGHEST_PROTOCOL), 1)
+        # Reading the songs back moves the file position, so always append at the end
+        self.spill_file.seek(0, 2)
+        self.spill_file.write(RECORD_LENGTH.pack(len(record)))
+        self.spill_file.write(record)
+        self.spilled += 1
+
+    def __len__(self):
+        return self.spilled + len(self.hot)
+
+    def __iter__(self):
+        if self.spill_file is not None:
+            end = self.spill_file.seek(0, 2)
+            position = 0
+            while position < end:
+                self.spill_file.seek(position)
+                length, = RECORD_LENGTH.unpack(self.spill_file.read(RECORD_LENGTH.size))
+                record = self.spill_file.read(length)
+                position += RECORD_LENGTH.size + length
+                yield pickle.loads(zlib.decompress(record))
+        for song, size in list(self.hot):
+            yield song
+
+    def close(self):
+        """
+        Remove the log file.
+        """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
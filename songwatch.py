@@ -0,0 +1,215 @@
+"""
+The :mod:`songwatch` module keeps an export directory in step with a directory of SongShow Plus files.
+
+A :class:`SongWatcher` notices new, modified and deleted ``.sbsong`` files, in the subfolders too if its
+:class:`songdiscovery.SongDiscovery` is recursive. If the optional ``watchdog`` package is
+installed, it is told about changes by the operating system and only looks at the files which changed. Otherwise it
+falls back to polling the directory, comparing the modification time and size of every file with the previous scan.
+Either way a change is only reported once the file has stopped changing for ``debounce`` seconds, so a song which is
+saved in several steps is converted once.
+
+An :class:`OutputMap` remembers which output files were written for which source file, so they can be replaced when
+the source changes and removed when it is deleted.
+"""
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from songdiscovery import SongDiscovery
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.25
+DEFAULT_DEBOUNCE = 0.3
+# With watchdog, the whole directory is still scanned this often, in case an event was lost
+DEFAULT_RESCAN_INTERVAL = 60.0
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def snapshot(discovery):
+    """
+    Returns the modification time and size of every song file found by a :class:`songdiscovery.SongDiscovery`, by
+    path.
+    """
+    discovery.keep_stats = True
+    for _ in discovery:
+        pass
+    return discovery.stats
+
+
+class SongWatcher(object):
+    """
+    Reports changed and deleted song files in a directory.
+    """
+
+    def __init__(self, import_dir, pattern='*.sbsong', interval=DEFAULT_INTERVAL, debounce=DEFAULT_DEBOUNCE,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL, discovery=None):
+        """
+        :param import_dir: The directory to watch.
+        :param str pattern: The file names to watch.
+        :param float interval: How often to check for changes, in seconds.
+        :param float debounce: How long a file must stay unchanged before it is reported, in seconds.
+        :param float rescan_interval: How often to scan the whole directory when ``watchdog`` is used, in seconds.
+        :param discovery: The :class:`songdiscovery.SongDiscovery` which finds the song files, in place of
+            ``pattern``, e.g. to watch the subfolders too.
+        """
+        self.import_dir = str(import_dir)
+        self.discovery = discovery or SongDiscovery(self.import_dir, include=[pattern], sort=False)
+        self.interval = interval
+        self.debounce = debounce
+        self.rescan_interval = rescan_interval
+        self.known = snapshot(self.discovery)
+        # Changes which are waiting for the file to settle: path -> (stat, time the stat was first seen)
+        self.pending = {}
+        self.touched = set()
+        self.touched_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.observer = None
+        self.last_scan = time.monotonic()
+
+    def _touch(self, path):
+        if self.discovery.matches(path):
+            with self.touched_lock:
+                self.touched.add(os.path.join(self.import_dir, os.path.relpath(path, self.import_dir)))
+            self.wake.set()
+
+    def start(self):
+        """
+        Start receiving change events from the operating system, if ``watchdog`` is installed.
+        """
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            log.info('watchdog is not installed, polling {path} for changes'.format(path=self.import_dir))
+            return
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.is_directory:
+                    return
+                watcher._touch(event.src_path)
+                if getattr(event, 'dest_path', None):
+                    watcher._touch(event.dest_path)
+
+        self.observer = Observer()
+        # A folder moved in or out only shows up as one event, so it is picked up by the next full scan
+        self.observer.schedule(Handler(), self.import_dir, recursive=self.discovery.recursive)
+        self.observer.start()
+
+    def stop(self):
+        """
+        Make :meth:`run` return after the current round.
+        """
+        self.stopped = True
+        self.wake.set()
+        if self.observer is not None:
+            self.observer.stop()
+
+    def _current(self):
+        """
+        Returns the current stat of the files which may have changed, ``None`` for deleted ones.
+        """
+        now = time.monotonic()
+        if self.observer is None or now - self.last_scan >= self.rescan_interval:
+            self.last_scan = now
+            with self.touched_lock:
+                self.touched.clear()
+            current = snapshot(self.discovery)
+            for path in self.known:
+                current.setdefault(path, None)
+            return current
+        with self.touched_lock:
+            touched, self.touched = self.touched, set()
+        return {path: _stat(path) for path in touched | set(self.pending)}
+
+    def poll(self):
+        """
+        Check for changes once.
+
+        :return: The paths of the changed (including new) files and of the deleted files, both only once they have
+            settled.
+        """
+        now = time.monotonic()
+        for path, stat in self._current().items():
+            if stat == self.known.get(path):
+                self.pending.pop(path, None)
+            elif path not in self.pending or self.pending[path][0] != stat:
+                self.pending[path] = (stat, now)
+        changed = []
+        deleted = []
+        for path, (stat, since) in list(self.pending.items()):
+            if now - since < self.debounce:
+                continue
+            del self.pending[path]
+            if stat is None:
+                self.known.pop(path, None)
+                deleted.append(path)
+            else:
+                self.known[path] = stat
+                changed.append(path)
+        return sorted(changed), sorted(deleted)
+
+    def run(self, on_changes):
+        """
+        Watch the directory until :meth:`stop` is called.
+
+        :param on_changes: Called with the lists of changed and deleted :class:`~pathlib.Path` objects.
+        """
+        self.start()
+        try:
+            while not self.stopped:
+                # While a change is settling, check again as soon as it may have settled
+                timeout = min(self.interval, self.debounce) if self.pending else self.interval
+                if self.observer is not None and not self.pending:
+                    timeout = self.rescan_interval
+                self.wake.wait(timeout)
+                self.wake.clear()
+                changed, deleted = self.poll()
+                if changed or deleted:
+                    on_changes([Path(path) for path in changed], [Path(path) for path in deleted])
+        finally:
+            if self.observer is not None:
+                self.observer.stop()
+                self.observer.join()
+
+
+class OutputMap(object):
+    """
+    Remembers the output files of every source file. It is passed to a :class:`checkpoint.JournalingWriter` in place
+    of a journal.
+    """
+
+    def __init__(self):
+        self.outputs = {}
+        self.current_source = None
+
+    def track(self, songs):
+        """
+        Pass the songs of an iterable on to an exporter, attributing the files written meanwhile to their source.
+        """
+        for song in songs:
+            self.current_source = str(song.source_path)
+            self.outputs[self.current_source] = []
+            yield song
+        self.current_source = None
+
+    def output_written(self, filename, size):
+        self.outputs[self.current_source].append(filename)
+
+    def pop(self, source):
+        """
+        Forget the output files of ``source`` and return them.
+        """
+        return self.outputs.pop(str(source), [])
@@ -0,0 +1,190 @@
+"""
+The :mod:`songwriters` module provides the backends the exporters hand their finished files to.
+
+Every exporter renders a song into a single ``bytes`` buffer and passes it to :meth:`SongWriter.write` in one call. The
+backend decides where and how the data ends up:
+
+* :class:`BufferedWriter` writes each file straight to the export directory with a single ``write`` call.
+* :class:`AtomicWriter` writes each file under a temporary name and renames it once complete, so an interrupted run
+  never leaves a partially written file behind. Optionally the files are synced to disk in batches.
+* :class:`MemoryWriter` keeps the files in a dictionary, which is useful for tests.
+* :class:`songbundle.SongBundle` streams the files into a single archive.
+"""
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# Appended to the file name while an AtomicWriter is still writing it.
+TEMP_SUFFIX = '.partial'
+
+
+class SongWriter(object):
+    """
+    The base class of the writer backends.
+    """
+    # Whether several worker processes may write through their own copy of this writer at the same time
+    process_safe = False
+
+    def existing_names(self):
+        """
+        Returns the file names which are already taken in the output, so the exporters do not overwrite them.
+        """
+        return []
+
+    def write(self, filename, data):
+        """
+        Write a complete file.
+
+        :param str filename: The file name, relative to the output.
+        :param bytes data: The file contents.
+        """
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Make sure the files written so far are complete in the output.
+        """
+        pass
+
+    def close(self):
+        """
+        Finish writing. Called once after the last file.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BufferedWriter(SongWriter):
+    """
+    Writes every file directly to its final path in a single call.
+    """
+    process_safe = True
+
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        # The subdirectories known to exist
+        self.directories = set()
+
+    def existing_names(self):
+        """
+        Returns the names in the export directory and, as ``directory/name``, those in its subdirectories.
+        """
+        names = []
+        pending = ['']
+        while pending:
+            directory = pending.pop()
+            try:
+                entries = list(os.scandir(os.path.join(str(self.export_dir), directory)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                name = '{directory}/{name}'.format(directory=directory, name=entry.name) if directory else entry.name
+                names.append(name)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(name)
+        return names
+
+    def _path(self, filename):
+        """
+        Returns the full path of a file, creating its subdirectory if the name has one.
+        """
+        directory, name = os.path.split(filename)
+        if directory and directory not in self.directories:
+            os.makedirs(os.path.join(str(self.export_dir), directory), exist_ok=True)
+            self.directories.add(directory)
+        return os.path.join(str(self.export_dir), filename)
+
+    def write(self, filename, data):
+        with open(self._path(filename), 'wb') as out_file:
+            out_file.write(data)
+
+
+class AtomicWriter(BufferedWriter):
+    """
+    Writes every file under a temporary name first and renames it to its final name once it is complete.
+
+    With ``fsync_batch`` set, every file is synced to disk through the handle it was written with, and the renames are
+    held back until that many files have been written. The batch is then renamed and the directory entries synced, so
+    a crash can lose at most the files of one batch, but never leaves a torn file under its final name.
+    """
+
+    def __init__(self, export_dir, fsync_batch=0):
+        """
+        :param export_dir: The directory to write to.
+        :param int fsync_batch: Sync to disk after this many files. ``0`` renames immediately without syncing.
+        """
+        super(AtomicWriter, self).__init__(export_dir)
+        self.fsync_batch = fsync_batch
+        self.pending = []
+
+    @property
+    def process_safe(self):
+        # The copy in each worker would sync its part of a batch at the end of every chunk, so with fsync_batch the
+        # workers only render the files and this writer keeps the batches
+        return not self.fsync_batch
+
+    def write(self, filename, data):
+        path = self._path(filename)
+        temp_path = path + TEMP_SUFFIX
+        with open(temp_path, 'wb') as out_file:
+            out_file.write(data)
+            if self.fsync_batch:
+                out_file.flush()
+                os.fsync(out_file.fileno())
+        if not self.fsync_batch:
+            os.replace(temp_path, path)
+            return
+        self.pending.append((temp_path, path))
+        if len(self.pending) >= self.fsync_batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Move the pending files, which are already synced to disk, to their final names.
+        """
+        for temp_path, path in self.pending:
+            os.replace(temp_path, path)
+        directories = set(os.path.dirname(path) for temp_path, path in self.pending)
+        self.pending = []
+        for directory in directories:
+            self._sync_directory(directory)
+
+    def _sync_directory(self, directory):
+        if os.name == 'nt':
+            # Directories cannot be opened to sync them on Windows
+            return
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.pending:
+            self.flush()
+
+
+class MemoryWriter(SongWriter):
+    """
+    Keeps all files in memory, in the ``files`` dictionary.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def existing_names(self):
+        return list(self.files)
+
+    def write(self, filename, data):
+        self.files[filename] = data
@@ -0,0 +1,121 @@
+"""
+The :mod:`songxml` module builds and parses the XML OpenLP uses to store the lyrics of a song, e.g.::
+
+    <?xml version='1.0' encoding='UTF-8'?>
+    <song version="1.0"><lyrics><verse type="v" label="1"><![CDATA[...]]></verse></lyrics></song>
+
+It only needs the standard library, so importing and converting songs for the text export does not load lxml.
+"""
+import logging
+import re
+from xml.etree import ElementTree
+
+log = logging.getLogger(__name__)
+
+XML_DECLARATION = '<?xml version=\'1.0\' encoding=\'UTF-8\'?>\n'
+# The characters XML 1.0 does not allow, which lxml refuses as well
+INVALID_XML_CHARS = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\uFFFE\uFFFF]')
+ATTRIBUTE_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\n': '&#10;', '\r': '&#13;',
+                     '\t': '&#9;'}
+ATTRIBUTE_SPECIAL_CHARS = re.compile('[&<>"\n\r\t]')
+
+# The lyrics parsed last by song_verses and their verses
+_last_verses = (None, None)
+
+
+def _check(text):
+    if INVALID_XML_CHARS.search(text):
+        raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+    return text
+
+
+def _attribute(text):
+    return ATTRIBUTE_SPECIAL_CHARS.sub(lambda match: ATTRIBUTE_ESCAPES[match.group()], _check(text))
+
+
+def _cdata(text):
+    # "]]>" would end the section, so it is split over two sections
+    return '<![CDATA[{text}]]>'.format(text=_check(text).replace(']]>', ']]]]><![CDATA[>'))
+
+
+class SongXML(object):
+    """
+    This class builds and parses the XML used to describe songs.
+    """
+    log.info('SongXML Loaded')
+
+    def __init__(self):
+        """
+        Set up the default variables.
+        """
+        self.verses = []
+
+    def add_verse_to_lyrics(self, type, number, content, lang=None):
+        """
+        Add a verse to the ``<lyrics>`` tag.
+
+        :param type:  A string denoting the type of verse. Possible values are *v*, *c*, *b*, *p*, *i*, *e* and *o*.
+            Any other type is **not** allowed, this also includes translated types.
+        :param number: An integer denoting the number of the item, for example: verse 1.
+        :param content: The actual text of the verse to be stored.
+        :param lang:  The verse's language code (ISO-639). This is not required, but should be added if available.
+        """
+        verse = '<verse type="{type}" label="{label}"'.format(type=_attribute(str(type)), label=_attribute(str(number)))
+        if lang:
+            verse += ' lang="{lang}"'.format(lang=_attribute(lang))
+        self.verses.append('{verse}>{content}</verse>'.format(verse=verse, content=_cdata(content)))
+
+    def extract_xml(self):
+        """
+        Extract our newly created XML song.
+        """
+        if self.verses:
+            lyrics = '<lyrics>{verses}</lyrics>'.format(verses=''.join(self.verses))
+        else:
+            lyrics = '<lyrics/>'
+        return '{declaration}<song version="1.0">{lyrics}</song>'.format(declaration=XML_DECLARATION,
+                                                                        lyrics=lyrics).encode('utf-8')
+
+    def get_verses(self, xml):
+        """
+        Iterates through the verses in the XML and returns a list of verses and their attributes.
+
+        :param xml: The XML of the song to be parsed.
+
+        The returned list has the following format::
+
+            [[{'type': 'v', 'label': '1'}, u"optional slide split 1[---]optional slide split 2"],
+            [{'lang': 'en', 'type': 'c', 'label': '1'}, u"English chorus"]]
+        """
+        verse_list = []
+        if xml.startswith('<?xml'):
+            xml = xml[38:]
+        try:
+            song_xml = ElementTree.fromstring(xml)
+        except ElementTree.ParseError:
+            log.exception('Invalid xml {text}'.format(text=xml))
+            return verse_list
+        for element in song_xml.iter('verse'):
+            verse_list.append([element.attrib, element.text or ''])
+        return verse_list
+
+    def dump_xml(self):
+        """
+        Debugging aid to dump XML so that we can see what we have.
+        """
+        print(self.extract_xml().decode('utf-8'))
+
+
+def song_verses(lyrics):
+    """
+    Returns the verses of a song's lyrics, like :meth:`SongXML.get_verses`. The verses of the last lyrics are kept, so
+    a song which is exported in several formats one after the other is only parsed once. The list must not be changed.
+
+    :param str lyrics: The XML of the song's lyrics.
+    """
+    global _last_verses
+    last_lyrics, verse_list = _last_verses
+    if lyrics is not last_lyrics and lyrics != last_lyrics:
+        verse_list = SongXML().get_verses(lyrics)
+        _last_verses = (lyrics, verse_list)
+    return verse_list
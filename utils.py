@@ -22,7 +22,6 @@
 
 import re
 from datetime import datetime
-from pprint import pprint
 
 class VerseType(object):
     """
@@ -58,6 +57,133 @@ def normalize_str(irregular_string):
     irregular_string = NEW_LINE_REGEX.sub('\n', irregular_string)
     return WHITESPACE_REGEX.sub(' ', irregular_string)
 
+WHITESPACE = re.compile(r'[\W_]+')
+APOSTROPHE = re.compile(r'[\'`\u2019\u02bb\u2032]')
+FORMATTING_TAGS = re.compile(r'\{/?\w+\}')
+
+
+def clean_string(string):
+    """
+    Strips punctuation from the passed string to assist searching.
+
+    :param str string: The string to clean
+    :return: A clean string
+    :rtype: str
+    """
+    return WHITESPACE.sub(' ', APOSTROPHE.sub('', string)).lower()
+
+
+def clean_title(title, alternate_title=''):
+    """
+    Build OpenLP's search title from a song's title and alternate title.
+    """
+    return clean_string(title) + '@' + clean_string(alternate_title)
+
+
+def clean_lyrics(verse_texts):
+    """
+    Build OpenLP's search lyrics from the texts of a song's verses, without formatting tags.
+    """
+    return ' '.join([clean_string(FORMATTING_TAGS.sub('', verse_text)) for verse_text in verse_texts])
+
+
+VERSE_DEF_MAP = {
+    'v': 'Verse',
+    'c': 'Chorus',
+    'b': 'Bridge',
+    't': 'Tag',
+    'o': 'Other',
+    'p': 'Pre-Chorus'
+}
+
+
+def compute_verse_name(verse_def):
+    """
+    Turn a verse def such as ``c1a`` into the display name used by the text export, e.g. ``Chorus 1a``.
+
+    :param str verse_def: The verse def.
+    :return: The display name
+    :rtype: str
+    """
+    prefix = verse_def[0:1]
+    suffix = verse_def[1:]
+
+    try:
+        verse_type = VERSE_DEF_MAP[prefix]
+    except Exception:
+        verse_type = VERSE_DEF_MAP['o']
+
+    return '{prefix} {suffix}'.format(prefix=verse_type, suffix=suffix)
+
+
+class VersePlan(object):
+    """
+    The labels of a song's verses and its play order, computed once per song and shared by every exporter.
+
+    ``verse_defs`` holds the unique verse defs in order of appearance. ``labels`` and ``names`` hold one entry per verse
+    in the lyrics: verse defs which occur more than once get a suffix letter (``c1a``, ``c1b``), and ``names`` are the
+    matching display names. ``play_order`` holds the display names of the expanded verse order.
+    """
+
+    def __init__(self, verse_defs, verse_order=''):
+        """
+        :param verse_defs: The verse def (type and number, e.g. ``v1``) of every verse, in lyrics order.
+        :param str verse_order: The song's space separated verse order.
+        """
+        counts = {}
+        for verse_def in verse_defs:
+            counts[verse_def] = counts.get(verse_def, 0) + 1
+        self.verse_defs = list(counts)
+        self.labels = []
+        seen = {}
+        for verse_def in verse_defs:
+            if counts[verse_def] > 1:
+                # Create the letter from the number of duplicates
+                duplicates = seen.get(verse_def, 0)
+                seen[verse_def] = duplicates + 1
+                verse_def += chr(97 + (duplicates % 26))
+            self.labels.append(verse_def)
+        self.names = [compute_verse_name(label) for label in self.labels]
+        self.play_order = self._expand_verse_order(verse_order.split(' '))
+
+    @staticmethod
+    def _expand_verse_order(verse_order_list):
+        """
+        Name the entries of the verse order, giving directly repeated entries a suffix letter each.
+        """
+        play_order = []
+        duplicate_verse_count = 0
+        previous_value = None
+        for num, verse_def in enumerate(verse_order_list):
+            if num > 0:
+                previous_value = verse_order_list[num - 1]
+            if verse_def == '':
+                continue
+            next_value = verse_order_list[num + 1] if num < len(verse_order_list) - 1 else None
+
+            if previous_value and not previous_value.startswith(verse_def):
+                duplicate_verse_count = 0
+
+            if (next_value == verse_def) or (previous_value == verse_def):
+                suffix = chr(97 + (duplicate_verse_count % 26))
+                play_order.append(compute_verse_name(verse_def + suffix))
+                duplicate_verse_count += 1
+            else:
+                play_order.append(compute_verse_name(verse_def))
+                duplicate_verse_count = 0
+        return play_order
+
+    @classmethod
+    def from_verse_list(cls, verse_list, verse_order=''):
+        """
+        Build the plan from the output of :meth:`SongXML.get_verses`, for songs that do not have one yet.
+        """
+        return cls([verse[0]['type'][0].lower() + verse[0]['label'] for verse in verse_list], verse_order)
+
+    def __repr__(self):
+        return 'VersePlan({labels!r}, {play_order!r})'.format(labels=self.labels, play_order=self.play_order)
+
+
 class Song():
     title = ''
     alternate_title = ''
@@ -73,6 +199,10 @@ class Song():
     authors = []
     topics = []
     song_book_name = ''
+    # The VersePlan computed during import
+    verse_plan = None
+    # The file the song was imported from
+    source_path = None
 
     last_modified = str(datetime.now())
 